@@ -1,12 +1,2088 @@
 
 import tkinter as tk
-from tkinter import messagebox, simpledialog
+from tkinter import messagebox, simpledialog, filedialog, ttk
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import requests
+from requests.adapters import HTTPAdapter
 from scipy import stats
+import os
+import glob
+import hashlib
+import json
+import math
+import shutil
+import queue
+import random
+import re
+import threading
+import time
+import zipfile
+from collections import deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    # Optional: only needed for Arrow-backed text columns (see ARROW_STRING_COLUMNS) and snapshots (SnapshotStore)
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+# Number of rows requested from the CMS datastore per page
+PAGE_LIMIT = 500
+# Bounds for the adaptive page size (see AdaptivePageSizer)
+MIN_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 8000
+# Page sizes are grown while a page comes back faster than this, and shrunk when it takes much longer
+TARGET_PAGE_SECONDS = 2.0
+# ...or when a single page's body gets bigger than this
+MAX_PAGE_BYTES = 8 * 1024 * 1024
+# After this many quick pages in a row at the ceiling, the ceiling is raised again (after a failed probe or errors)
+CEILING_RECOVERY_PAGES = 20
+# Cap on the number of rows pulled in by a normal load
+MAX_RECORDS = 30000
+# Number of pages fetched at the same time (1 reproduces the old one-page-at-a-time loop)
+DEFAULT_FETCH_WORKERS = 8
+
+# Where downloaded pages are kept on disk during a full-dataset load
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".open_payments_cache")
+
+# Raw API responses are cached here so repeat loads of the same pages come from disk
+RESPONSE_CACHE_DIR = os.path.join(CACHE_DIR, "responses")
+# Cached responses newer than this are used without asking the server (the yearly publications rarely change)
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+# Oldest-used responses are deleted once the cache grows past this size
+RESPONSE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Incremental refresh keeps its local copy of the records here
+RECORD_STORE_DIR = os.path.join(CACHE_DIR, "records")
+
+# Cleaned datasets are saved here so a later session can reopen them without downloading (see SnapshotStore)
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, "snapshots")
+# Schema metadata key the snapshot description is stored under
+SNAPSHOT_METADATA_KEY = b'open_payments_snapshot'
+
+# Payments above this are never kept (see drop_invalid_payments), and clean_data keeps payments between these
+# percentiles of the amount. Both are the defaults for the cleaning rules, see DEFAULT_CLEANING_STAGES
+MAX_PAYMENT_AMOUNT = 1000000
+TRIM_PERCENTILES = (0.05, 0.95)
+# Loads keep a QuantileSketch of the amount as pages arrive. Up to this many values it holds them all and its
+# percentiles are exact; past it, it compacts them into a KLL sketch whose size is set by QUANTILE_SKETCH_K
+# (rank error about 0.7% at 400, see QuantileSketch.rank_error)
+EXACT_QUANTILE_MAX_ROWS = 1000000
+QUANTILE_SKETCH_K = 400
+# clean_data's rules are read from this file next to the program when it exists (see CleaningPipeline), and
+# can be swapped with File > Load Cleaning Rules
+CLEANING_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cleaning_rules.json")
+# Field the datastore uses to identify a payment record, and the one CMS uses to flag corrected records
+RECORD_KEY = 'record_id'
+CHANGE_COLUMN = 'change_type'
+# Record IDs looked up per request when fetching new/changed records
+RECORD_FETCH_BATCH = 100
+
+# The only fields we keep from each research payment record. The datastore is asked for just these
+# (a "projection"), so the other ~90% of every record never crosses the network.
+DESIRED_COLUMNS = [
+    'total_amount_of_payment_usdollars', 'principal_investigator_1_state',
+    'form_of_payment_or_transfer_of_value', 'name_of_drug_or_biological_or_device_or_medical_supply_1',
+    'product_category_or_therapeutic_area_1',
+    'principal_investigator_1_primary_type_1',
+    'principal_investigator_1_specialty_1', 'submitting_applicable_manufacturer_or_applicable_gpo_name',
+    'principal_investigator_1_profile_id', 'principal_investigator_1_first_name', 'principal_investigator_1_last_name',
+    'clinicaltrials_gov_identifier'
+]
+
+# CMS lists every published dataset here; used to look up the query URL of registry entries without a pinned URL
+METASTORE_DATASETS_URL = "https://openpaymentsdata.cms.gov/api/1/metastore/schemas/dataset/items"
+DATASTORE_QUERY_URL = "https://openpaymentsdata.cms.gov/api/1/datastore/query/{identifier}/0"
+
+# General and ownership records name their fields differently from research records. These maps say which source
+# field feeds each of our (research) column names; None means the payment type has no such field and the column
+# is left blank. Field names follow the CMS Open Payments data dictionary for program years 2021 onwards.
+GENERAL_PAYMENT_FIELDS = {
+    'principal_investigator_1_state': 'recipient_state',
+    'principal_investigator_1_primary_type_1': 'covered_recipient_primary_type_1',
+    'principal_investigator_1_specialty_1': 'covered_recipient_specialty_1',
+    'principal_investigator_1_profile_id': 'covered_recipient_profile_id',
+    'principal_investigator_1_first_name': 'covered_recipient_first_name',
+    'principal_investigator_1_last_name': 'covered_recipient_last_name',
+    'clinicaltrials_gov_identifier': None,
+}
+OWNERSHIP_PAYMENT_FIELDS = {
+    'total_amount_of_payment_usdollars': 'total_amount_invested_usdollars',
+    'principal_investigator_1_state': 'recipient_state',
+    'form_of_payment_or_transfer_of_value': None,
+    'name_of_drug_or_biological_or_device_or_medical_supply_1': None,
+    'product_category_or_therapeutic_area_1': None,
+    'principal_investigator_1_primary_type_1': 'physician_primary_type',
+    'principal_investigator_1_specialty_1': 'physician_specialty',
+    'submitting_applicable_manufacturer_or_applicable_gpo_name':
+        'applicable_manufacturer_or_applicable_gpo_making_payment_name',
+    'principal_investigator_1_profile_id': 'physician_profile_id',
+    'principal_investigator_1_first_name': 'physician_first_name',
+    'principal_investigator_1_last_name': 'physician_last_name',
+    'clinicaltrials_gov_identifier': None,
+}
+PAYMENT_TYPE_FIELDS = {'research': {}, 'general': GENERAL_PAYMENT_FIELDS, 'ownership': OWNERSHIP_PAYMENT_FIELDS}
+PAYMENT_TYPE_TITLES = {'research': "Research Payment", 'general': "General Payment", 'ownership': "Ownership Payment"}
+
+
+def build_dataset_registry(years=(2023, 2022, 2021)):
+    """
+    Every dataset the app can load, keyed by the name shown in the dropdown.
+
+    Each entry has the program year, payment type and either a pinned query URL or None, in which case
+    the URL is looked up by title in the CMS metastore the first time it is needed (resolve_dataset_url).
+    """
+    registry = {}
+    for payment_type in ('research', 'general', 'ownership'):
+        for year in years:
+            registry[f"{year} {payment_type.title()} Payments API"] = {
+                'program_year': year, 'payment_type': payment_type, 'url': None}
+    # The dataset the app was built around keeps its known URL
+    registry["2023 Research Payments API"]['url'] = \
+        "https://openpaymentsdata.cms.gov/api/1/datastore/query/60f290ea-f990-5ef0-845f-68b3a91f45a1"
+    return registry
+
+
+DATASET_REGISTRY = build_dataset_registry()
+
+
+def dataset_source_columns(spec, columns=DESIRED_COLUMNS):
+    """The source field names to request from a registry dataset, in the order of columns (blank ones left out)."""
+    fields = PAYMENT_TYPE_FIELDS[spec['payment_type']]
+    return [fields.get(column, column) for column in columns if fields.get(column, column) is not None]
+
+
+def to_canonical_columns(frame, spec, columns=DESIRED_COLUMNS):
+    """Rename a registry dataset's fields to our column names, adding blank columns for fields it doesn't have."""
+    fields = PAYMENT_TYPE_FIELDS[spec['payment_type']]
+    if not fields:
+        return frame
+    renamed = frame.rename(columns={source: column for column, source in fields.items() if source is not None})
+    return renamed.reindex(columns=list(columns))
+
+
+def resolve_dataset_url(client, spec):
+    """
+    Query URL for a registry entry, looking it up in the CMS metastore by program year and payment type.
+
+    Raises:
+    - DatastoreError if no published dataset matches.
+    """
+    if spec['url']:
+        return spec['url']
+    title = PAYMENT_TYPE_TITLES[spec['payment_type']].lower()
+    for dataset in client.get_json(METASTORE_DATASETS_URL, {}):
+        dataset_title = str(dataset.get('title', '')).lower()
+        if str(spec['program_year']) in dataset_title and title in dataset_title:
+            spec['url'] = DATASTORE_QUERY_URL.format(identifier=dataset['identifier'])
+            return spec['url']
+    raise DatastoreError(f"No {spec['program_year']} {spec['payment_type']} payments dataset is published by CMS.")
+
+
+# Column holding the payment amount, the one every cleaning rule works on
+AMOUNT_COLUMN = 'total_amount_of_payment_usdollars'
+
+# Column types of a loaded DataFrame that differ from the datastore's text (see ColumnBuffers)
+LOADED_DTYPES = {AMOUNT_COLUMN: 'float64'}
+
+# After cleaning, text columns with at most this share of distinct values are stored as categoricals
+# (state, form of payment, specialty, manufacturer, ...), see optimize_dtypes
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+# High-cardinality text columns that are held as Arrow-backed strings instead of Python str objects when pyarrow
+# is installed and the option is on (see loaded_dtypes): one contiguous buffer per column instead of an object
+# per value, and .str methods (e.g. the search's str.contains) run vectorized in Arrow
+ARROW_STRING_COLUMNS = [
+    'principal_investigator_1_first_name', 'principal_investigator_1_last_name',
+    'name_of_drug_or_biological_or_device_or_medical_supply_1', 'clinicaltrials_gov_identifier'
+]
+ARROW_STRING_DTYPE = 'string[pyarrow]'
+# ...and the payment amount as float32. That keeps about 7 significant digits (to the cent up to roughly
+# $100,000, to the dollar above), which is plenty for the percentiles, stats and histograms
+COMPACT_AMOUNT_DTYPE = 'float32'
+
+# Investigator attributes that clean_data moves out of the payment rows into one row per investigator
+# (see InvestigatorDimension); the payment rows keep an integer INVESTIGATOR_KEY instead
+INVESTIGATOR_ID_COLUMN = 'principal_investigator_1_profile_id'
+INVESTIGATOR_COLUMNS = [
+    INVESTIGATOR_ID_COLUMN, 'principal_investigator_1_first_name', 'principal_investigator_1_last_name',
+    'principal_investigator_1_primary_type_1', 'principal_investigator_1_specialty_1', 'principal_investigator_1_state'
+]
+INVESTIGATOR_KEY = 'investigator_key'
+# The specialty is a NUCC taxonomy path, "grouping|classification|specialization" (e.g. "Allopathic & Osteopathic
+# Physicians|Internal Medicine|Cardiovascular Disease"). clean_data splits it into these investigator columns,
+# and the specialty column keeps the path below the grouping (see parse_specialties)
+SPECIALTY_COLUMN = 'principal_investigator_1_specialty_1'
+SPECIALTY_LEVEL_COLUMNS = [
+    'principal_investigator_1_specialty_grouping', 'principal_investigator_1_specialty_classification',
+    'principal_investigator_1_specialty_specialization'
+]
+
+# The cleaning stages CleaningPipeline knows, with their options and defaults. Row stages only narrow down which
+# payments are kept; the kept rows are then copied once (the 'take_rows' step) before the table stages run.
+ROW_CLEANING_STAGES = {
+    # Drop blank payments, and 0 and over-max_amount ones (max_amount null: no upper limit)
+    'invalid_payments': {'drop_zero': True, 'max_amount': MAX_PAYMENT_AMOUNT},
+    # Keep payments between these percentiles of the amounts still kept
+    'trim_percentiles': {'lower': TRIM_PERCENTILES[0], 'upper': TRIM_PERCENTILES[1]},
+}
+TABLE_CLEANING_STAGES = {
+    # Split the specialty into its taxonomy levels; strip_grouping also drops the grouping from the specialty
+    'specialty_levels': {'strip_grouping': True},
+    # Repeated text as categoricals, amount as float32 (see optimize_dtypes)
+    'optimize_dtypes': {'max_unique_ratio': CATEGORY_MAX_UNIQUE_RATIO},
+}
+DEFAULT_CLEANING_STAGES = [{'stage': name} for name in [*ROW_CLEANING_STAGES, *TABLE_CLEANING_STAGES]]
+
+# Operators the datastore's conditions parameter understands (see FilterSpec)
+PUSHDOWN_OPERATORS = {'=', '<>', '<', '<=', '>', '>=', 'in', 'not in', 'like', 'between'}
+# Datastore field types the server compares as numbers. Fields of any other type are compared as text, where
+# '9' > '10' and '0.00' <> '0', so conditions with a numeric value on them are applied locally instead.
+NUMERIC_FIELD_TYPES = {'int', 'integer', 'bigint', 'serial', 'numeric', 'decimal', 'float', 'double'}
+
+# Rows read at a time from a local bulk CSV file
+BULK_CSV_CHUNKSIZE = 200000
+# Explicit dtypes for the bulk CSV: the amount is parsed straight to float, everything else stays text
+# (IDs such as the profile ID are compared as strings, like they come from the API)
+BULK_CSV_DTYPES = {column: str for column in DESIRED_COLUMNS}
+BULK_CSV_DTYPES[AMOUNT_COLUMN] = 'float64'
+
+# Retry settings for datastore requests (see RetryPolicy)
+RETRY_MAX_ATTEMPTS = 6
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 60.0
+# Requests per second allowed across all fetch workers together (see TokenBucket)
+REQUESTS_PER_SECOND = 10.0
+
+# How often (ms) the Tk main loop checks the background load for progress
+INGEST_POLL_MS = 100
+
+
+class DatastoreError(Exception):
+    """Raised when the CMS datastore answers a page request with a non-200 status."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MissingColumnsError(ValueError):
+    """Raised when a dataset or file lacks some of the columns we need."""
+
+
+class CleaningConfigError(ValueError):
+    """Raised when a cleaning rules file can't be used."""
+
+
+class IngestCancelled(Exception):
+    """Raised inside a background load when the user presses Cancel."""
+
+
+class IngestMetrics:
+    """
+    Running counters for one load, updated by the worker thread and read through snapshot().
+
+    expected_rows is the number of rows the load is expected to produce, or None when that isn't known,
+    in which case no ETA is given. When the DatastoreClient doing the load is given, the retries it makes
+    during the load are reported too.
+    """
+
+    def __init__(self, expected_rows=None, client=None):
+        self.expected_rows = expected_rows
+        self.rows = 0
+        self.pages = 0
+        self.client = client
+        self.retries_before = client.retries if client is not None else 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record_page(self, rows, pages=1):
+        with self.lock:
+            self.rows += rows
+            self.pages += pages
+
+    def snapshot(self):
+        """A plain dict copy of the counters plus rates and ETA, safe to pass to another thread."""
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            rows, pages = self.rows, self.pages
+        rows_per_second = rows / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.expected_rows and rows_per_second > 0:
+            eta = max(0.0, (self.expected_rows - rows) / rows_per_second)
+        return {
+            'rows': rows,
+            'pages': pages,
+            'elapsed': elapsed,
+            'pages_per_second': pages / elapsed if elapsed > 0 else 0.0,
+            'expected_rows': self.expected_rows,
+            'eta': eta,
+            'retries': self.client.retries - self.retries_before if self.client is not None else 0,
+        }
+
+
+def format_progress(snapshot):
+    """One-line progress text, e.g. '12,500 records | 8.3 pages/s | ETA 0:12'."""
+    text = f"{snapshot['rows']:,} records | {snapshot['pages_per_second']:.1f} pages/s"
+    if snapshot['eta'] is not None:
+        minutes, seconds = divmod(int(round(snapshot['eta'])), 60)
+        text += f" | ETA {minutes}:{seconds:02d}"
+    if snapshot.get('retries'):
+        text += f" | {snapshot['retries']} retries"
+    return text
+
+
+def plan_load(total_rows, page_limit=PAGE_LIMIT, workers=DEFAULT_FETCH_WORKERS, max_records=None):
+    """
+    Evenly sized (offset, limit) partitions covering the first total_rows rows, or the first max_records of them.
+
+    Pages hold at most page_limit rows, and a small load is still cut into one page per worker (as long as pages
+    stay at least MIN_PAGE_LIMIT rows) so every worker has something to do. All pages are the same size give or
+    take one row, so the last worker isn't left with a ragged page. total_rows comes from a count query
+    (DatastoreClient.fetch_count).
+    """
+    rows = total_rows if max_records is None else min(total_rows, max_records)
+    if rows <= 0:
+        return []
+    pages = max(math.ceil(rows / page_limit), min(workers, math.ceil(rows / MIN_PAGE_LIMIT)))
+    size, extra = divmod(rows, pages)
+    partitions = []
+    offset = 0
+    for index in range(pages):
+        limit = size + 1 if index < extra else size
+        partitions.append((offset, limit))
+        offset += limit
+    return partitions
+
+
+def page_partitions(start, stop, limit):
+    """
+    Lazily split rows [start, stop) into (offset, limit) pages; stop=None keeps going forever.
+
+    limit is either a fixed page size or a callable giving the size to use for the next page, which lets an
+    AdaptivePageSizer change the page size while a download is running.
+    """
+    next_limit = limit if callable(limit) else (lambda: limit)
+    offset = start
+    while stop is None or offset < stop:
+        size = next_limit()
+        if stop is not None:
+            size = min(size, stop - offset)
+        yield offset, size
+        offset += size
+
+
+class AdaptivePageSizer:
+    """
+    Picks the page size (rows per request) for one API URL from what the server actually does.
+
+    This class:
+    1. Probes the server with growing page sizes (probe) to find the largest size it returns in full, without
+       errors, within TARGET_PAGE_SECONDS and MAX_PAGE_BYTES. A page that comes back short means the server
+       capped it, so nothing bigger is ever used.
+    2. During a download (record_success / record_failure) halves the size when pages get slow, large or fail,
+       and grows it back towards the probed ceiling when pages are quick again. A page the server cut short
+       (record_cap, see DatastoreClient.fetch_partition) lowers the ceiling to what it sent.
+    3. Doubles the ceiling itself after CEILING_RECOVERY_PAGES quick, full pages in a row at the ceiling, so a
+       burst of errors doesn't keep the pages small for good. It never goes past full_size, the largest page
+       that has actually come back full, nor past a cap the server showed. (A probe that got no full page at
+       all leaves full_size None; DataAnalysisApp.page_sizer probes such a URL again on the next load.)
+
+    The size only ever changes for pages not yet requested, and each page covers exactly the rows it asked
+    for, so the offsets stay contiguous whatever the size does.
+    """
+
+    def __init__(self, initial=PAGE_LIMIT, minimum=MIN_PAGE_LIMIT, maximum=MAX_PAGE_LIMIT,
+                 target_seconds=TARGET_PAGE_SECONDS, max_bytes=MAX_PAGE_BYTES):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        # Largest page size known to come back in full; we never ask for more than this
+        self.ceiling = initial
+        self.limit = initial
+        # Rows the server returned at most when asked for more (None if it never capped a page)
+        self.server_cap = None
+        # Largest page size that has come back full (None until one has)
+        self.full_size = None
+        self.quick_pages = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        with self.lock:
+            return self.limit
+
+    def probe(self, client, api_url, columns=None):
+        """
+        Try page sizes initial, 2x, 4x ... maximum at offset 0 and settle on the largest good one.
+
+        Returns the chosen page size. Errors, timeouts, short pages, slow or oversized pages end the probe.
+        """
+        size = self.limit
+        best = None
+        while size <= self.maximum:
+            stats = {}
+            started = time.monotonic()
+            try:
+                results = client.fetch_page(api_url, 0, size, columns, stats=stats)
+            except (DatastoreError, requests.exceptions.RequestException):
+                break
+            seconds = time.monotonic() - started
+
+            if len(results) < size:
+                # Either the server caps pages at len(results) or the whole dataset is that small
+                if results:
+                    best = len(results)
+                    self.server_cap = best
+                break
+            best = size
+            if seconds > self.target_seconds or stats.get('bytes', 0) > self.max_bytes:
+                break
+            size *= 2
+
+        with self.lock:
+            self.ceiling = max(self.minimum, best or self.minimum)
+            self.limit = self.ceiling
+            self.full_size = best
+        print(f"Page size for {api_url}: {self.limit} rows")
+        return self.limit
+
+    def record_success(self, limit, seconds, nbytes, rows=None):
+        """
+        Adjust the size after a page of limit rows took seconds and nbytes to come back with rows rows (None:
+        all of them). Only full pages count towards growing the size.
+        """
+        with self.lock:
+            full = rows is None or rows >= limit
+            if full:
+                self.full_size = max(self.full_size or 0, limit)
+            if seconds > 2 * self.target_seconds or nbytes > self.max_bytes:
+                self.quick_pages = 0
+                new_limit = max(self.minimum, self.limit // 2)
+            elif seconds < self.target_seconds / 2 and full and limit >= self.limit:
+                if self.limit == self.ceiling:
+                    self.quick_pages += 1
+                    highest = min(self.maximum, self.server_cap or self.maximum, self.full_size)
+                    if self.quick_pages < CEILING_RECOVERY_PAGES or self.ceiling >= highest:
+                        return
+                    self.quick_pages = 0
+                    self.ceiling = min(highest, self.ceiling * 2)
+                new_limit = min(self.ceiling, self.limit * 2)
+            else:
+                return
+            if new_limit != self.limit:
+                print(f"Page size changed from {self.limit} to {new_limit} rows ({seconds:.1f} s, {nbytes:,} bytes)")
+                self.limit = new_limit
+
+    def record_cap(self, rows):
+        """The server sent only rows rows of a bigger page although more followed: it caps pages at rows."""
+        with self.lock:
+            self.quick_pages = 0
+            self.server_cap = rows if self.server_cap is None else min(self.server_cap, rows)
+            self.full_size = rows if self.full_size is None else min(self.full_size, rows)
+            self.ceiling = max(self.minimum, min(self.ceiling, rows))
+            self.limit = min(self.limit, self.ceiling)
+            print(f"Server cut a page to {rows} rows, page size is now {self.limit} rows")
+
+    def record_failure(self, limit):
+        """Halve the size (and the ceiling) after a page of limit rows errored or timed out."""
+        with self.lock:
+            self.quick_pages = 0
+            self.ceiling = max(self.minimum, min(self.ceiling, limit // 2))
+            self.limit = min(self.limit, self.ceiling)
+            print(f"Page of {limit} rows failed, page size is now {self.limit} rows")
+
+
+def decode_page(results, columns=DESIRED_COLUMNS):
+    """
+    Turn one page of datastore results into a DataFrame.
+
+    Datastore records are flat {field: value} dicts with the same fields in every record, so when the first
+    record has all our columns as plain values the columns are built directly as lists (one pass per column)
+    instead of going through pd.json_normalize, which walks every record looking for nesting. Anything else
+    (nested dicts/lists, or our columns missing) falls back to pd.json_normalize so that case behaves as before.
+    """
+    first = results[0]
+    if not all(column in first and not isinstance(first[column], (dict, list)) for column in columns):
+        return pd.json_normalize(results)
+    missing = float('nan')
+    return pd.DataFrame({column: [record.get(column, missing) for record in results] for column in columns})
+
+
+def drop_invalid_payments(frame, drop_zero=True, max_amount=MAX_PAYMENT_AMOUNT):
+    """
+    Make the payment amount numeric and drop rows where it is blank, 0 or above $1,000,000 (the rules of the
+    'invalid_payments' cleaning stage, see valid_payment_mask).
+
+    These rules only look at one row at a time, so they can be applied to each page or file chunk as it is
+    read; the percentile trim in clean_data needs the whole dataset and runs afterwards.
+    """
+    amounts = pd.to_numeric(frame[AMOUNT_COLUMN], errors='coerce')
+    keep = pd.Series(valid_payment_mask(amounts.to_numpy(dtype='float64', na_value=np.nan), drop_zero, max_amount),
+                     index=frame.index)
+    if keep.all() and frame[AMOUNT_COLUMN].dtype == amounts.dtype:
+        # Already numeric and nothing to drop (e.g. rows that came through filter_pages), so skip the copy
+        return frame
+    frame = frame.loc[keep].copy()
+    frame[AMOUNT_COLUMN] = amounts[keep]
+    return frame
+
+
+class QuantileSketch:
+    """
+    Mergeable summary of a stream of numbers that answers quantile queries (a KLL sketch).
+
+    update() takes a whole page of values at a time and merge() combines sketches built separately (e.g. one
+    per dataset). While at most exact_limit values have been added they are all kept and quantiles() is exact,
+    the same as numpy's (and pandas') linear interpolation. After that the values are compacted: a level that
+    outgrows its capacity is sorted and every other value (from a random start) moves up a level, where it
+    counts twice. Only a few thousand values are kept however many go in, and a quantile's rank is off by at most
+    about rank_error (k=400: 0.7%) with high probability.
+    """
+
+    def __init__(self, k=QUANTILE_SKETCH_K, exact_limit=EXACT_QUANTILE_MAX_ROWS, seed=None):
+        self.k = k
+        self.exact_limit = exact_limit
+        self.levels = [np.empty(0)]
+        # Pages added since the last compaction or query, joined onto level 0 only when needed (joining them one
+        # at a time would copy level 0 for every page)
+        self.pending = []
+        self.count = 0
+        self.random = np.random.default_rng(seed)
+
+    @property
+    def exact(self):
+        """Whether every value is still held as it was added (nothing compacted yet)."""
+        return len(self.levels) == 1
+
+    @property
+    def rank_error(self):
+        """Rank error of quantiles() as a fraction of count: 0 while exact, else DataSketches' empirical KLL bound."""
+        return 0.0 if self.exact else 2.296 / self.k ** 0.9723
+
+    def update(self, values):
+        """Add values (NaNs are skipped)."""
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.pending.append(values)
+        self.count += len(values)
+        if self.count > self.exact_limit:
+            self.compress()
+
+    def flush(self):
+        if self.pending:
+            self.levels[0] = np.concatenate([self.levels[0], *self.pending])
+            self.pending = []
+
+    def merge(self, other):
+        """Add everything other has seen."""
+        other.flush()
+        for height, level in enumerate(other.levels):
+            if height == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[height] = np.concatenate([self.levels[height], level])
+        self.count += other.count
+        if self.count > self.exact_limit:
+            self.compress()
+
+    def capacity(self, height):
+        # Lower levels get geometrically smaller capacities (2/3 per level), the top level gets k
+        return max(2, int(self.k * (2 / 3) ** (len(self.levels) - 1 - height)))
+
+    def compress(self):
+        self.flush()
+        height = 0
+        while height < len(self.levels):
+            level = self.levels[height]
+            if len(level) > self.capacity(height):
+                if height + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                level = np.sort(level)
+                # With an odd number of values the smallest one stays behind
+                odd = len(level) % 2
+                promoted = level[odd + self.random.integers(2)::2]
+                self.levels[height] = level[:odd]
+                self.levels[height + 1] = np.concatenate([self.levels[height + 1], promoted])
+            height += 1
+
+    def quantiles(self, qs):
+        """The values at quantiles qs (each between 0 and 1), as a numpy array."""
+        if not self.count:
+            return np.full(len(qs), np.nan)
+        self.flush()
+        if self.exact:
+            return np.quantile(self.levels[0], qs)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** height) for height, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        ranks = np.cumsum(weights[order])
+        positions = np.searchsorted(ranks, np.asarray(qs) * ranks[-1], side='left')
+        return values[order][np.minimum(positions, len(values) - 1)]
+
+
+def valid_payment_mask(amounts, drop_zero=True, max_amount=MAX_PAYMENT_AMOUNT):
+    """Boolean array of the float amounts that are valid payments: not blank (NaN), 0 or above max_amount."""
+    keep = ~np.isnan(amounts)
+    if drop_zero:
+        keep &= amounts != 0
+    if max_amount is not None:
+        keep &= amounts <= max_amount
+    return keep
+
+
+def percentile_window(amounts, keep, percentiles=TRIM_PERCENTILES, sketch=None):
+    """
+    Narrow the boolean array keep (in place, and return it) to the amounts between the percentiles of the kept
+    amounts.
+
+    sketch can be a QuantileSketch of the kept amounts built while they were loaded; if it is no longer exact
+    (and has seen as many amounts as are kept) its percentiles are used, instead of computing them from the
+    whole column again.
+    """
+    kept = int(keep.sum())
+    if not kept:
+        return keep
+    if sketch is not None and not sketch.exact and sketch.count == kept:
+        lower, upper = sketch.quantiles(percentiles)
+    else:
+        lower, upper = np.quantile(amounts[keep], percentiles)
+    keep &= (amounts >= lower) & (amounts <= upper)
+    return keep
+
+
+def loaded_dtypes(arrow_strings=False):
+    """Column dtypes a load should produce: LOADED_DTYPES, plus Arrow strings for ARROW_STRING_COLUMNS if asked."""
+    dtypes = dict(LOADED_DTYPES)
+    if arrow_strings and pyarrow is not None:
+        dtypes.update({column: ARROW_STRING_DTYPE for column in ARROW_STRING_COLUMNS})
+    return dtypes
+
+
+def optimize_dtypes(frame, max_unique_ratio=CATEGORY_MAX_UNIQUE_RATIO, string_columns=()):
+    """
+    Shrink a loaded DataFrame's memory: low-cardinality text columns become categoricals, the payment amount
+    becomes COMPACT_AMOUNT_DTYPE and other integer columns (e.g. program_year) the smallest integer type.
+    Text columns in string_columns become Arrow-backed strings instead (if they aren't already).
+
+    Returns (frame, report), where report has the memory use 'before' and 'after' in bytes and the
+    {column: (old dtype, new dtype)} changes under 'changed'.
+    """
+    before = int(frame.memory_usage(deep=True).sum())
+    columns = {}
+    for column in frame.columns:
+        values = frame[column]
+        if column == AMOUNT_COLUMN and pd.api.types.is_float_dtype(values):
+            columns[column] = values.astype(COMPACT_AMOUNT_DTYPE)
+        elif pd.api.types.is_integer_dtype(values):
+            columns[column] = pd.to_numeric(values, downcast='integer')
+        elif column in string_columns:
+            if values.dtype == object:
+                columns[column] = values.astype(ARROW_STRING_DTYPE)
+        elif values.dtype == object and len(values) and values.nunique() <= max_unique_ratio * len(values):
+            columns[column] = values.astype('category')
+    changed = {column: (str(frame[column].dtype), str(values.dtype)) for column, values in columns.items()
+               if values.dtype != frame[column].dtype}
+    if columns:
+        frame = frame.assign(**columns)
+    after = int(frame.memory_usage(deep=True).sum())
+    return frame, {'before': before, 'after': after, 'changed': changed}
+
+
+def format_memory_report(report):
+    """One-line summary of an optimize_dtypes report, e.g. 'Memory: 14.2 MB -> 2.1 MB (85% less)'."""
+    saved = 1 - report['after'] / report['before'] if report['before'] else 0.0
+    return f"Memory: {report['before'] / 1e6:.1f} MB -> {report['after'] / 1e6:.1f} MB ({saved:.0%} less)"
+
+
+def parse_specialties(specialties):
+    """
+    Split NUCC taxonomy specialties ("grouping|classification|specialization") into a DataFrame with the
+    SPECIALTY_LEVEL_COLUMNS and SPECIALTY_COLUMN (the path below the grouping, e.g. "Internal Medicine|Cardiovascular
+    Disease"), all categoricals lined up with specialties. A value without a "|" is kept as it is, as its grouping.
+
+    Each distinct specialty is parsed once and the results are broadcast back to the rows through the codes.
+    """
+    codes, uniques = pd.factorize(specialties)
+    parts = pd.Series(np.asarray(uniques, dtype=object), dtype=object).str.split('|', n=2, expand=True)
+    parts = parts.reindex(columns=range(3)).astype(object).apply(lambda level: level.str.strip().replace('', None))
+    below_grouping = parts[1].where(parts[2].isna(), parts[1] + '|' + parts[2])
+    levels = dict(zip(SPECIALTY_LEVEL_COLUMNS, (parts[0], parts[1], parts[2])))
+    levels[SPECIALTY_COLUMN] = below_grouping.fillna(parts[0])
+    columns = {}
+    for column, values in levels.items():
+        level_codes, level_values = pd.factorize(values)
+        # Rows without a specialty (code -1) stay blank
+        columns[column] = pd.Categorical.from_codes(
+            np.where(codes >= 0, level_codes[codes] if len(level_codes) else -1, -1), categories=level_values)
+    return pd.DataFrame(columns, index=specialties.index)
+
+
+class InvestigatorDimension:
+    """
+    One row per investigator (name, type, specialty, state, and the specialty levels from parse_specialties once
+    clean_data has run), split off the payment rows by split().
+
+    Every payment row repeats its investigator's attributes, so after cleaning they are stored once here, keyed by
+    a dense integer INVESTIGATOR_KEY (0, 1, 2, ...) that is also the row position in table; the payment table keeps
+    just that key. Investigators are identified by profile ID. The few rows without one are keyed by their
+    attributes instead, so different people without an ID aren't merged. An investigator listed with
+    different attributes on different payments keeps the ones on their first payment.
+
+    Lookups go through hash indexes built once: key_for_profile finds an investigator by profile ID and
+    payment_rows gives the positions of their payments, without scanning the payment table.
+    """
+
+    def __init__(self, table, keys, row_order=None):
+        self.table = table
+        self.profile_index = pd.Index(table[INVESTIGATOR_ID_COLUMN])
+        # Payment row positions grouped by key: rows of key k are row_order[row_starts[k]:row_starts[k + 1]]
+        self.row_order = np.argsort(keys, kind='stable') if row_order is None else row_order
+        self.row_starts = np.searchsorted(keys[self.row_order], np.arange(len(table) + 1))
+
+    @classmethod
+    def split(cls, frame, rows=None):
+        """
+        Split frame (or just the rows at these positions) into (payments, dimension): the rows without
+        INVESTIGATOR_COLUMNS plus an INVESTIGATOR_KEY column, and the InvestigatorDimension it points into.
+        The payments keep frame's row order. The selected rows are copied once, straight into the two tables.
+        """
+        rows = np.arange(len(frame)) if rows is None else np.asarray(rows)
+        # The specialty levels too when frame already has them (a saved snapshot)
+        investigator_columns = [column for column in INVESTIGATOR_COLUMNS + SPECIALTY_LEVEL_COLUMNS
+                                if column in frame.columns]
+        ids = frame[INVESTIGATOR_ID_COLUMN].iloc[rows]
+        has_id = ids.notna().to_numpy()
+        keys = np.empty(len(rows), dtype=np.int64)
+        id_keys, id_uniques = pd.factorize(ids[has_id])
+        keys[has_id] = id_keys
+        if not has_id.all():
+            anonymous = frame[INVESTIGATOR_COLUMNS].iloc[rows[~has_id]]
+            keys[~has_id] = anonymous.groupby(
+                INVESTIGATOR_COLUMNS, dropna=False, sort=False, observed=True).ngroup().to_numpy() + len(id_uniques)
+        # The first payment of each key gives its attributes (the sort is stable, so it comes first in row_order)
+        row_order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[row_order]
+        first_rows = row_order[np.flatnonzero(np.diff(sorted_keys, prepend=-1))]
+        table = frame[investigator_columns].iloc[rows[first_rows]].reset_index(drop=True)
+        # Column by column, so only the kept payment columns are copied (frame.iloc[rows, columns] would copy the
+        # rows of every column first)
+        payments = pd.DataFrame({column: frame[column].array.take(rows) for column in frame.columns
+                                 if column not in investigator_columns}, index=frame.index[rows], copy=False)
+        payments[INVESTIGATOR_KEY] = keys.astype(np.int32)
+        return payments, cls(table, keys, row_order)
+
+    def key_for_profile(self, profile_id):
+        """Key of the investigator with this profile ID, or None."""
+        try:
+            return self.profile_index.get_loc(profile_id)
+        except KeyError:
+            return None
+
+    def find(self, profile_id=None, first_name=None, last_name=None):
+        """
+        Keys of the investigators matching every criterion given: the exact profile ID, and first/last names
+        containing the text (case-insensitive). Only the investigator table is searched, not the payments.
+        """
+        if profile_id:
+            key = self.key_for_profile(profile_id)
+            candidates = self.table.iloc[[] if key is None else [key]]
+        else:
+            candidates = self.table
+        matches = np.ones(len(candidates), dtype=bool)
+        for column, text in (('principal_investigator_1_first_name', first_name),
+                             ('principal_investigator_1_last_name', last_name)):
+            if text:
+                matches &= candidates[column].str.contains(text, case=False, na=False).to_numpy(dtype=bool)
+        return candidates.index[matches].to_numpy()
+
+    def payment_rows(self, keys):
+        """Positions (in the payment table) of every payment made to the investigators with these keys."""
+        keys = np.asarray(keys, dtype=np.int64)
+        starts = self.row_starts[keys]
+        lengths = self.row_starts[keys + 1] - starts
+        # Each key's slice of row_order, gathered in one go: slice i covers starts[i] ... starts[i] + lengths[i] - 1
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        return np.sort(self.row_order[offsets])
+
+    def column(self, payments, column):
+        """An investigator attribute lined up with the payment rows (the on-demand join for a single column)."""
+        values = self.table[column].take(payments[INVESTIGATOR_KEY].to_numpy())
+        return values.set_axis(payments.index)
+
+    def join(self, payments, columns=None):
+        """
+        The payment rows with the investigator attributes (all, or just columns) joined back on, in the original
+        column order and without the key, e.g. for display and export.
+        """
+        columns = self.table.columns if columns is None else columns
+        joined = payments.assign(**{column: self.column(payments, column) for column in columns})
+        order = [column for column in DESIRED_COLUMNS if column in joined.columns]
+        order += [column for column in joined.columns if column not in order and column != INVESTIGATOR_KEY]
+        return joined[order]
+
+
+def take_payments(frame, amounts, rows):
+    """Split the rows of frame at these positions into (payments, InvestigatorDimension), amounts made numeric."""
+    payments, investigators = InvestigatorDimension.split(frame, rows)
+    if payments[AMOUNT_COLUMN].dtype != amounts.dtype:
+        payments[AMOUNT_COLUMN] = amounts.to_numpy()[rows]
+    return payments, investigators
+
+
+class CleaningPipeline:
+    """
+    clean_data's rules as an ordered list of stages, e.g. read from a cleaning rules file (from_file):
+
+        {"stages": [
+            {"stage": "invalid_payments", "drop_zero": true, "max_amount": 1000000},
+            {"stage": "trim_percentiles", "lower": 0.05, "upper": 0.95},
+            {"stage": "specialty_levels"},
+            {"stage": "optimize_dtypes"}
+        ]}
+
+    The stages and their options are listed in ROW_CLEANING_STAGES and TABLE_CLEANING_STAGES; options left out
+    take the defaults there. Row stages only narrow down a mask of the payments to keep, so however many there are
+    the kept rows are copied once, when run() reaches the first table stage (or the end). That copy also splits off
+    the investigators (InvestigatorDimension) and shows up in the report as 'take_rows'.
+    """
+
+    def __init__(self, stages=DEFAULT_CLEANING_STAGES):
+        self.stages = []
+        for stage in stages:
+            if not isinstance(stage, dict) or 'stage' not in stage:
+                raise CleaningConfigError(f"Each cleaning stage needs a 'stage' name, got {stage!r}")
+            name = stage['stage']
+            defaults = {**ROW_CLEANING_STAGES, **TABLE_CLEANING_STAGES}.get(name)
+            if defaults is None:
+                raise CleaningConfigError(f"Unknown cleaning stage {name!r}")
+            unknown = set(stage) - set(defaults) - {'stage'}
+            if unknown:
+                raise CleaningConfigError(f"Unknown options for cleaning stage {name!r}: {', '.join(sorted(unknown))}")
+            if name in ROW_CLEANING_STAGES and any(earlier['stage'] in TABLE_CLEANING_STAGES
+                                                   for earlier in self.stages):
+                raise CleaningConfigError(f"Cleaning stage {name!r} drops rows, so it has to come before "
+                                          f"{', '.join(TABLE_CLEANING_STAGES)}")
+            self.stages.append(self.check_options({'stage': name, **defaults, **stage}))
+
+    @staticmethod
+    def check_options(stage):
+        """Return stage if its option values make sense, raising CleaningConfigError otherwise."""
+        name = stage['stage']
+
+        def is_number(value):
+            return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+        for option in ('drop_zero', 'strip_grouping'):
+            if option in stage and not isinstance(stage[option], bool):
+                raise CleaningConfigError(f"{option} of cleaning stage {name!r} must be true or false, "
+                                          f"got {stage[option]!r}")
+        if 'max_amount' in stage and stage['max_amount'] is not None and not is_number(stage['max_amount']):
+            raise CleaningConfigError(f"max_amount of cleaning stage {name!r} must be a number or null, "
+                                      f"got {stage['max_amount']!r}")
+        if name == 'trim_percentiles':
+            lower, upper = stage['lower'], stage['upper']
+            if not (is_number(lower) and is_number(upper) and 0 <= lower <= upper <= 1):
+                raise CleaningConfigError(f"Cleaning stage {name!r} needs 0 <= lower <= upper <= 1, "
+                                          f"got lower={lower!r}, upper={upper!r}")
+        if 'max_unique_ratio' in stage:
+            ratio = stage['max_unique_ratio']
+            if not (is_number(ratio) and 0 < ratio <= 1):
+                raise CleaningConfigError(f"max_unique_ratio of cleaning stage {name!r} must be above 0 and at "
+                                          f"most 1, got {ratio!r}")
+        return stage
+
+    @classmethod
+    def from_file(cls, path):
+        """Read the stages from a JSON cleaning rules file."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except json.JSONDecodeError as e:
+            raise CleaningConfigError(f"{path} is not valid JSON: {e}") from e
+        if not isinstance(config, dict) or not isinstance(config.get('stages'), list):
+            raise CleaningConfigError(f"{path} needs a list of \"stages\"")
+        return cls(config['stages'])
+
+    def payment_rules(self):
+        """
+        The options of the 'invalid_payments' stage, for drop_invalid_payments and FilterSpec.for_selection (so a
+        load doesn't already drop payments the rules would keep). Without that stage only payments with a blank
+        amount are dropped early: valid_payment_mask never keeps those, whatever the options.
+        """
+        for stage in self.stages:
+            if stage['stage'] == 'invalid_payments':
+                return {'drop_zero': stage['drop_zero'], 'max_amount': stage['max_amount']}
+        return {'drop_zero': False, 'max_amount': None}
+
+    def run(self, frame, sketch=None, string_columns=()):
+        """
+        Clean frame: returns (payments, InvestigatorDimension, report), where report lists each stage's name,
+        'rows_in', 'rows_out' and wall time in 'seconds'. sketch (see percentile_window) is used by
+        'trim_percentiles' and string_columns by 'optimize_dtypes'.
+        """
+        amounts = pd.to_numeric(frame[AMOUNT_COLUMN], errors='coerce')
+        values = amounts.to_numpy(dtype='float64', na_value=np.nan)
+        keep = np.ones(len(frame), dtype=bool)
+        tables = None
+        report = []
+
+        def timed(name, step, rows_in):
+            start = time.perf_counter()
+            step()
+            rows_out = int(keep.sum()) if tables is None else len(tables[0])
+            report.append({'stage': name, 'rows_in': rows_in, 'rows_out': rows_out,
+                           'seconds': time.perf_counter() - start})
+            return rows_out
+
+        def take_rows():
+            nonlocal tables
+            tables = list(take_payments(frame, amounts, np.flatnonzero(keep)))
+
+        rows = len(frame)
+        for stage in self.stages:
+            name = stage['stage']
+            if name == 'invalid_payments':
+                rows = timed(name, lambda: np.logical_and(
+                    keep, valid_payment_mask(values, stage['drop_zero'], stage['max_amount']), out=keep), rows)
+            elif name == 'trim_percentiles':
+                rows = timed(name, lambda: percentile_window(
+                    values, keep, (stage['lower'], stage['upper']), sketch), rows)
+            else:
+                if tables is None:
+                    rows = timed('take_rows', take_rows, rows)
+                if name == 'specialty_levels':
+                    rows = timed(name, lambda: self.add_specialty_levels(tables[1], stage['strip_grouping']), rows)
+                elif name == 'optimize_dtypes':
+                    rows = timed(name, lambda: self.compact_tables(
+                        tables, stage['max_unique_ratio'], string_columns), rows)
+        if tables is None:
+            timed('take_rows', take_rows, rows)
+        return tables[0], tables[1], report
+
+    @staticmethod
+    def add_specialty_levels(investigators, strip_grouping):
+        if SPECIALTY_COLUMN not in investigators.table.columns:
+            return
+        levels = parse_specialties(investigators.table[SPECIALTY_COLUMN])
+        if not strip_grouping:
+            levels = levels.drop(columns=SPECIALTY_COLUMN)
+        investigators.table = investigators.table.assign(**levels)
+
+    @staticmethod
+    def compact_tables(tables, max_unique_ratio, string_columns):
+        payments, investigators = tables
+        tables[0], _ = optimize_dtypes(payments, max_unique_ratio, string_columns)
+        investigators.table, _ = optimize_dtypes(investigators.table, max_unique_ratio, string_columns)
+
+
+def format_stage_report(report):
+    """One line per cleaning stage, e.g. 'trim_percentiles: 29,310 -> 26,379 rows in 0.004 s'."""
+    return '\n'.join(f"{stage['stage']}: {stage['rows_in']:,} -> {stage['rows_out']:,} rows in "
+                     f"{stage['seconds']:.3f} s" for stage in report)
+
+
+def is_numeric_value(value):
+    """True for condition values that have to be compared as numbers (a list counts if its first item does)."""
+    if isinstance(value, (list, tuple)):
+        return bool(value) and is_numeric_value(value[0])
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def condition_mask(frame, condition):
+    """
+    Boolean Series saying which rows of frame meet one condition, evaluated the way the datastore would.
+
+    Numeric values are compared against the column parsed as numbers, 'like' uses SQL wildcards and ignores case,
+    and everything else compares text. Blank (or, for numeric values, unparseable) cells never match.
+    """
+    operator, value = condition.get('operator', '='), condition['value']
+    column = frame[condition['property']]
+    if is_numeric_value(value):
+        column = pd.to_numeric(column, errors='coerce')
+    else:
+        column = column.astype(str).where(column.notna())
+        value = [str(item) for item in value] if isinstance(value, (list, tuple)) else str(value)
+
+    if operator == '=':
+        matched = column == value
+    elif operator == '<>':
+        matched = column != value
+    elif operator == '<':
+        matched = column < value
+    elif operator == '<=':
+        matched = column <= value
+    elif operator == '>':
+        matched = column > value
+    elif operator == '>=':
+        matched = column >= value
+    elif operator == 'in':
+        matched = column.isin(value)
+    elif operator == 'not in':
+        matched = ~column.isin(value)
+    elif operator == 'between':
+        matched = column.between(value[0], value[1])
+    elif operator == 'like':
+        pattern = '^' + '.*'.join(re.escape(part) for part in value.split('%')) + '$'
+        matched = column.str.match(pattern, case=False, na=False)
+    else:
+        raise ValueError(f"Unknown filter operator: {operator}")
+    # Like SQL, a blank cell never meets a condition
+    return matched & column.notna()
+
+
+class FilterSpec:
+    """
+    Row filters for a load, sent to the datastore as query conditions wherever the server can evaluate them.
+
+    Each condition is a {'property', 'operator', 'value'} dict on one of our (research) column names, the
+    same form DatastoreClient.page_params sends. split() works out which conditions a given dataset can take
+    as pushed-down conditions (so the filtered-out rows never cross the network) and which have to be applied
+    locally with apply(); a condition on a field the dataset doesn't have, or a numeric condition on a field the
+    server stores as text, is kept local. File loads and refreshes apply every condition locally.
+    """
+
+    def __init__(self, conditions=None, payment_rules=None):
+        self.conditions = list(conditions or [])
+        # drop_invalid_payments options for the rows that are loaded (the cleaning rules' 'invalid_payments')
+        self.payment_rules = dict(payment_rules or {})
+
+    @classmethod
+    def for_selection(cls, state=None, manufacturer=None, drop_zero=True, max_amount=MAX_PAYMENT_AMOUNT):
+        """
+        The filters behind the main window's options: the payment rules of drop_invalid_payments (0 and
+        over-$1,000,000 payments are never kept, so they needn't be downloaded) plus the optional principal
+        investigator state and manufacturer name (a case-insensitive "contains" match).
+        """
+        conditions = []
+        if drop_zero:
+            conditions.append({'property': AMOUNT_COLUMN, 'operator': '<>', 'value': 0})
+        if max_amount is not None:
+            conditions.append({'property': AMOUNT_COLUMN, 'operator': '<=', 'value': max_amount})
+        if state:
+            conditions.append({'property': 'principal_investigator_1_state', 'operator': '=',
+                               'value': state.strip().upper()})
+        if manufacturer:
+            conditions.append({'property': 'submitting_applicable_manufacturer_or_applicable_gpo_name',
+                               'operator': 'like', 'value': f"%{manufacturer.strip()}%"})
+        return cls(conditions, {'drop_zero': drop_zero, 'max_amount': max_amount})
+
+    def describe(self):
+        """Short text for messages, e.g. "principal_investigator_1_state = 'CA'"."""
+        return ', '.join(f"{condition['property']} {condition.get('operator', '=')} {condition['value']!r}"
+                         for condition in self.conditions)
+
+    def split(self, spec, field_types=None):
+        """
+        Split the conditions into (pushed, local) for a registry dataset.
+
+        pushed uses the dataset's own field names and is ready for page_params; local keeps our column names and
+        is meant for apply() on the renamed rows. field_types is the dataset's {field: type} schema (see
+        DatastoreClient.fetch_field_types); without it every numeric condition is kept local.
+        """
+        fields = PAYMENT_TYPE_FIELDS[spec['payment_type']]
+        field_types = field_types or {}
+        pushed, local = [], []
+        for condition in self.conditions:
+            source = fields.get(condition['property'], condition['property'])
+            numeric_field = str(field_types.get(source, '')).lower() in NUMERIC_FIELD_TYPES
+            if (source is None or condition.get('operator', '=') not in PUSHDOWN_OPERATORS
+                    or (is_numeric_value(condition['value']) and not numeric_field)):
+                local.append(condition)
+            else:
+                pushed.append({**condition, 'property': source})
+        return pushed, local
+
+    def apply(self, frame, conditions=None):
+        """Keep only the rows of frame that meet every condition (or just the given ones)."""
+        conditions = self.conditions if conditions is None else conditions
+        if not conditions or frame.empty:
+            return frame
+        keep = pd.Series(True, index=frame.index)
+        for condition in conditions:
+            keep &= condition_mask(frame, condition)
+        return frame.loc[keep]
+
+
+# The generator stages below are chained page by page: each page is decoded, coerced and filtered as soon as it
+# arrives and then appended to the result, so a load holds one page plus the (already filtered) rows kept so far.
+# Every stage takes and yields (offset, page) pairs in offset order, the way fetch_pages hands them out.
+
+def normalize_pages(pages, spec, columns=DESIRED_COLUMNS):
+    """
+    Decode each (offset, results) page from fetch_pages into a DataFrame with our column names.
+
+    Raises:
+    - MissingColumnsError as soon as a page lacks one of the dataset's fields.
+    """
+    source_columns = dataset_source_columns(spec, columns)
+    for offset, results in pages:
+        page = decode_page(results, source_columns)
+        missing_columns = [column for column in source_columns if column not in page.columns]
+        if missing_columns:
+            raise MissingColumnsError(f"The following columns are missing: {', '.join(missing_columns)}")
+        # Keep only our columns (a no-op when the server honoured the projection, the fallback when it didn't)
+        yield offset, to_canonical_columns(page[source_columns], spec, columns)
+
+
+def coerce_pages(pages):
+    """Parse each page's payment amount to a number; blanks and unparseable text become NaN."""
+    for offset, page in pages:
+        yield offset, page.assign(**{AMOUNT_COLUMN: pd.to_numeric(page[AMOUNT_COLUMN], errors='coerce')})
+
+
+def filter_pages(pages, filters=None, conditions=None):
+    """
+    Drop each page's invalid payments (drop_invalid_payments) and the rows failing filters.
+
+    conditions picks which of the FilterSpec's conditions to apply, e.g. just the ones the server couldn't
+    evaluate; by default all of them are.
+    """
+    for offset, page in pages:
+        page = drop_invalid_payments(page, **(filters.payment_rules if filters is not None else {}))
+        if filters is not None:
+            page = filters.apply(page, conditions)
+        yield offset, page
+
+
+def open_bulk_file(file_path):
+    """
+    Open a CMS bulk download for reading, looking inside it if it is a zip file.
+
+    CMS ships each program year as a zip holding the general, research and ownership CSVs; the research one
+    (with "RSRCH" in its name) is picked when there is more than one CSV inside.
+    """
+    if not zipfile.is_zipfile(file_path):
+        return open(file_path, 'rb')
+    archive = zipfile.ZipFile(file_path)
+    csv_names = [name for name in archive.namelist() if name.lower().endswith('.csv')]
+    if not csv_names:
+        raise ValueError(f"No CSV file found inside {os.path.basename(file_path)}")
+    research_names = [name for name in csv_names if 'RSRCH' in name.upper()]
+    return archive.open((research_names or csv_names)[0])
+
+
+def read_bulk_csv(file_path, columns=DESIRED_COLUMNS, chunksize=BULK_CSV_CHUNKSIZE, dtypes=None):
+    """
+    Read a local CMS research payments CSV (or zipped CSV) in chunks.
+
+    This function:
+    1. Matches the file's headers to our column names ignoring case (the bulk files use
+       'Total_Amount_of_Payment_USDollars' where the API uses 'total_amount_of_payment_usdollars').
+    2. Only parses the wanted columns (usecols) with the explicit BULK_CSV_DTYPES, updated with dtypes if given.
+    3. Yields DataFrames of up to chunksize rows with the API's lower-case column names.
+
+    Raises:
+    - ValueError if any of the wanted columns is not in the file.
+    """
+    with open_bulk_file(file_path) as handle:
+        header = pd.read_csv(handle, nrows=0).columns
+    file_columns = {name.lower(): name for name in header}
+
+    missing_columns = [column for column in columns if column not in file_columns]
+    if missing_columns:
+        raise MissingColumnsError(f"The following columns are missing: {', '.join(missing_columns)}")
+
+    renames = {file_columns[column]: column for column in columns}
+    dtypes = {**BULK_CSV_DTYPES, **(dtypes or {})}
+    dtypes = {file_columns[column]: dtypes.get(column, str) for column in columns}
+
+    with open_bulk_file(file_path) as handle:
+        reader = pd.read_csv(handle, usecols=list(renames), dtype=dtypes, chunksize=chunksize)
+        for chunk in reader:
+            yield chunk.rename(columns=renames)[list(columns)]
+
+
+class ColumnBuffers:
+    """
+    Preallocated column arrays that a load's pages are appended to as they arrive.
+
+    Each page is copied into the next free slice of the arrays, instead of keeping every page as a DataFrame and
+    concatenating them at the end (which briefly needs twice the memory). capacity is an upper bound on the rows,
+    e.g. the row count from a count query; rows past it are dropped. Columns listed in dtypes get arrays of that
+    type (the payment amount is kept as float64), the rest hold Python objects. frame() returns the rows
+    appended so far; columns given a pandas extension dtype (such as Arrow strings) are buffered as objects
+    and converted there. The appended payment amounts are also added to sketch, for clean_data's percentiles.
+    """
+
+    def __init__(self, columns, capacity, dtypes=None):
+        self.dtypes = dtypes or {}
+        self.columns = list(columns)
+        self.capacity = capacity
+        self.arrays = {}
+        for column in self.columns:
+            dtype = pd.api.types.pandas_dtype(self.dtypes.get(column, object))
+            if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+                dtype = object
+            self.arrays[column] = np.empty(capacity, dtype=dtype)
+        self.rows = 0
+        self.sketch = QuantileSketch()
+
+    @property
+    def full(self):
+        return self.rows >= self.capacity
+
+    def append(self, frame):
+        count = min(len(frame), self.capacity - self.rows)
+        if count <= 0:
+            return
+        for column in self.columns:
+            self.arrays[column][self.rows:self.rows + count] = frame[column].to_numpy()[:count]
+        if AMOUNT_COLUMN in self.columns and self.arrays[AMOUNT_COLUMN].dtype.kind == 'f':
+            self.sketch.update(self.arrays[AMOUNT_COLUMN][self.rows:self.rows + count])
+        self.rows += count
+
+    def frame(self):
+        data = {}
+        for column in self.columns:
+            values = self.arrays[column][:self.rows]
+            if values.dtype == object and column in self.dtypes:
+                values = pd.array(values, dtype=self.dtypes[column])
+            data[column] = values
+        return pd.DataFrame(data)
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or touching [start, end) ranges into a sorted, minimal list."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class PageSpool:
+    """
+    Keeps the pages of a full-dataset load on disk instead of in memory.
+
+    Each page is written to its own CSV file named after its offset, so memory use while downloading stays at
+    roughly one page no matter how big the dataset is. The datastore hands every field back as text, so the
+    pages are read back as strings and type conversion is left to clean_data like it is for API loads.
+
+    A manifest.json next to the pages records which row ranges are already on disk and whether the download
+    reached the end of the dataset, so a failed or interrupted load only has to fetch the missing ranges.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = self.load_manifest()
+
+    @classmethod
+    def for_url(cls, api_url, root=CACHE_DIR):
+        """Open the spool directory used for a given API URL."""
+        key = hashlib.sha256(api_url.encode('utf-8')).hexdigest()[:16]
+        return cls(os.path.join(root, key))
+
+    @staticmethod
+    def clear_all(root=CACHE_DIR):
+        """
+        Delete the spool of every URL under root (the directories for_url names), complete or not, so the next
+        full load downloads the dataset again. Returns how many spools were deleted.
+        """
+        if not os.path.isdir(root):
+            return 0
+        spools = [entry.path for entry in os.scandir(root)
+                  if entry.is_dir() and re.fullmatch(r'[0-9a-f]{16}', entry.name)]
+        for path in spools:
+            shutil.rmtree(path, ignore_errors=True)
+        return len(spools)
+
+    def page_path(self, offset):
+        return os.path.join(self.directory, f"page_{offset:012d}.csv")
+
+    def clear(self):
+        """Delete every spooled page and the manifest."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        return {'api_url': None, 'columns': None, 'ranges': [], 'complete': False, 'total': None}
+
+    def save_manifest(self):
+        with open(self.manifest_path + ".tmp", "w") as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def start(self, api_url, columns, conditions=None):
+        """
+        Get the spool ready for a download of api_url with the given columns and pushed-down conditions.
+
+        Pages left over from an earlier download of the same URL, columns and conditions are kept so it can be
+        resumed; anything else in the directory is thrown away (with different conditions the same offsets
+        point at different rows).
+        """
+        conditions = list(conditions or [])
+        if (self.manifest['api_url'] != api_url or self.manifest['columns'] != list(columns)
+                or self.manifest.get('conditions', []) != conditions):
+            self.clear()
+            self.manifest.update({'api_url': api_url, 'columns': list(columns), 'conditions': conditions})
+            self.save_manifest()
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    @property
+    def total(self):
+        """Number of rows the download is expected to produce (from a count query), or None if unknown."""
+        return self.manifest.get('total')
+
+    def set_total(self, total):
+        self.manifest['total'] = total
+        self.save_manifest()
+
+    def rows_on_disk(self):
+        return sum(end - start for start, end in self.manifest['ranges'])
+
+    def write(self, offset, frame):
+        """Save one page and record its row range [offset, offset + len(frame)) as done in the manifest."""
+        # Write to a temporary name first so a crash never leaves a half-written page behind
+        path = self.page_path(offset)
+        frame.to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+        self.manifest['ranges'] = merge_ranges(self.manifest['ranges'] + [[offset, offset + len(frame)]])
+        self.save_manifest()
+
+    def mark_complete(self):
+        """Record that the download reached the end of the dataset."""
+        self.manifest['complete'] = True
+        self.save_manifest()
+
+    def missing_partitions(self, limit=PAGE_LIMIT):
+        """
+        (offset, limit) pages for every row range not on disk yet.
+
+        Gaps between finished ranges are filled first, then pages carry on past the last finished range until
+        the datastore runs out of rows. When the total is known (set_total), the pages up to it are planned up
+        front and only then does one more page check whether rows were added since the count. Nothing is yielded
+        once the spool is marked complete. limit can be a fixed size or a callable, as for page_partitions.
+        """
+        if self.complete:
+            return
+        offset = 0
+        for start, end in self.manifest['ranges']:
+            if offset < start:
+                yield from page_partitions(offset, start, limit)
+            offset = max(offset, end)
+        if self.total is not None and offset < self.total:
+            yield from page_partitions(offset, self.total, limit)
+            offset = self.total
+        yield from page_partitions(offset, None, limit)
+
+    def page_files(self):
+        """Spooled page files in offset order."""
+        return sorted(glob.glob(os.path.join(self.directory, "page_*.csv")))
+
+    def iter_pages(self, columns):
+        """Yield (offset, page) for every spooled page in offset order, reading one page file at a time."""
+        for path in self.page_files():
+            offset = int(os.path.basename(path)[len("page_"):-len(".csv")])
+            yield offset, pd.read_csv(path, dtype=str, usecols=columns)[columns]
+
+
+class ResponseCache:
+    """
+    On-disk cache of raw datastore responses, keyed by URL + query parameters.
+
+    Each entry is a body file plus a small JSON file holding the ETag / Last-Modified headers and the time it was
+    stored. Entries younger than ttl seconds are served straight from disk; older ones are revalidated with a
+    conditional request, and a 304 answer just restarts their clock. When the cache grows past max_bytes the
+    least recently used entries are deleted.
+    """
+
+    def __init__(self, directory, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        # Bytes of the response bodies only, the same thing put and evict add and subtract
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                        if entry.is_file() and entry.name.endswith(".body"))
+
+    @staticmethod
+    def key(url, params):
+        request_id = json.dumps([url, sorted((str(name), str(value)) for name, value in (params or {}).items())])
+        return hashlib.sha256(request_id.encode('utf-8')).hexdigest()
+
+    def paths(self, url, params):
+        key = self.key(url, params)
+        return os.path.join(self.directory, key + ".body"), os.path.join(self.directory, key + ".json")
+
+    def get(self, url, params):
+        """Return the cached entry (a dict with 'body', 'etag', 'last_modified', 'stored_at') or None."""
+        body_path, meta_path = self.paths(url, params)
+        try:
+            with open(meta_path) as meta_file:
+                entry = json.load(meta_file)
+            with open(body_path, 'rb') as body_file:
+                entry['body'] = body_file.read()
+        except (OSError, ValueError):
+            return None
+        # Bump the access time so eviction treats this entry as recently used. Another thread may have evicted it
+        # since it was read, which is fine: the body is already in hand
+        with self.lock:
+            try:
+                os.utime(body_path)
+            except OSError:
+                pass
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored_at'] < self.ttl
+
+    def put(self, url, params, body, headers):
+        """Store a 200 response body together with its validators."""
+        body_path, meta_path = self.paths(url, params)
+        meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'stored_at': time.time(),
+        }
+        with self.lock:
+            old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+            with open(body_path + ".tmp", 'wb') as body_file:
+                body_file.write(body)
+            os.replace(body_path + ".tmp", body_path)
+            with open(meta_path + ".tmp", 'w') as meta_file:
+                json.dump(meta, meta_file)
+            os.replace(meta_path + ".tmp", meta_path)
+            self.size += len(body) - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def refresh(self, url, params):
+        """Restart the TTL of an entry the server confirmed (304) is still current."""
+        body_path, meta_path = self.paths(url, params)
+        with self.lock:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            meta['stored_at'] = time.time()
+            with open(meta_path + ".tmp", 'w') as meta_file:
+                json.dump(meta, meta_file)
+            os.replace(meta_path + ".tmp", meta_path)
+
+    def evict(self):
+        """Delete least recently used entries until the cache is back under 90% of max_bytes (lock held)."""
+        bodies = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".body")]
+        bodies.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in bodies:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+            meta_path = entry.path[:-len(".body")] + ".json"
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+            self.size = 0
+
+
+class RecordStore:
+    """
+    Local copy of every record pulled from one API URL, keyed by record ID, for incremental refreshes.
+
+    The records are kept as a pickled DataFrame indexed by RECORD_KEY, next to a small state.json with
+    the URL and the time and outcome of the last sync.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.records_path = os.path.join(self.directory, "records.pkl")
+        self.state_path = os.path.join(self.directory, "state.json")
+        self.records = pd.read_pickle(self.records_path) if os.path.exists(self.records_path) else None
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                self.state = json.load(state_file)
+        else:
+            self.state = {}
+
+    @classmethod
+    def for_url(cls, api_url, root=RECORD_STORE_DIR):
+        key = hashlib.sha256(api_url.encode('utf-8')).hexdigest()[:16]
+        return cls(os.path.join(root, key))
+
+    def save(self):
+        self.records.to_pickle(self.records_path + ".tmp")
+        os.replace(self.records_path + ".tmp", self.records_path)
+        with open(self.state_path + ".tmp", "w") as state_file:
+            json.dump(self.state, state_file)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+
+class SnapshotStore:
+    """
+    Cleaned DataFrames saved as uncompressed Arrow IPC (Feather v2) files, one per data source and filters.
+    Needs pyarrow.
+
+    Uncompressed files can be memory-mapped, so reopening a multi-million-row snapshot maps the file and converts
+    the columns instead of parsing anything. Each file carries a JSON description in its schema metadata (source
+    name and URL or file path, filters, row count, cleaning rules and when it was saved), which read_metadata
+    gets without loading the data. The investigator table of a cleaned load (InvestigatorDimension) is saved
+    next to it in investigators_path, so the payments are written as they are rather than joined back up.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+
+    def path_for(self, source_name, filters=None):
+        """Snapshot path for a source; loads of the same source with different filters get their own file."""
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', source_name).strip('_').lower()[:80] or "snapshot"
+        if filters:
+            slug += "_" + hashlib.sha256(json.dumps(filters, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.directory, f"{slug}.arrow")
+
+    @staticmethod
+    def investigators_path(path):
+        return path + ".investigators"
+
+    @staticmethod
+    def write_table(frame, path, metadata=None):
+        table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+        if metadata is not None:
+            table = table.replace_schema_metadata(
+                {**(table.schema.metadata or {}), SNAPSHOT_METADATA_KEY: json.dumps(metadata).encode('utf-8')})
+        pyarrow.feather.write_feather(table, path + ".tmp", compression='uncompressed')
+        os.replace(path + ".tmp", path)
+
+    def save(self, frame, metadata, investigators=None):
+        """
+        Write frame with metadata to the snapshot for metadata['source'] and metadata['filters'], replacing any
+        older one. investigators is the InvestigatorDimension table frame's INVESTIGATOR_KEY points into, if any.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(metadata['source'], metadata.get('filters'))
+        if investigators is not None:
+            self.write_table(investigators, self.investigators_path(path))
+        elif os.path.exists(self.investigators_path(path)):
+            os.remove(self.investigators_path(path))
+        self.write_table(frame, path, metadata)
+        return path
+
+    @staticmethod
+    def read_metadata(path):
+        """The description saved with a snapshot (only the file footer is read)."""
+        with pyarrow.memory_map(path) as source:
+            metadata = pyarrow.ipc.open_file(source).schema.metadata or {}
+        return json.loads(metadata.get(SNAPSHOT_METADATA_KEY, b'{}'))
+
+    @staticmethod
+    def load(path):
+        """Memory-map a snapshot back into a DataFrame; returns (frame, metadata)."""
+        with pyarrow.memory_map(path) as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        metadata = json.loads((table.schema.metadata or {}).get(SNAPSHOT_METADATA_KEY, b'{}'))
+        # Text columns come back Arrow-backed rather than as Python str objects
+        string_dtype = pd.StringDtype('pyarrow')
+        frame = table.to_pandas(types_mapper={pyarrow.string(): string_dtype, pyarrow.large_string(): string_dtype}.get)
+        return frame, metadata
+
+    @classmethod
+    def load_investigators(cls, path):
+        """The investigator table saved with a snapshot, or None if the payments were saved with it joined on."""
+        if not os.path.exists(cls.investigators_path(path)):
+            return None
+        frame, _ = cls.load(cls.investigators_path(path))
+        return frame
+
+    def snapshots(self):
+        """(path, metadata) of every saved snapshot, newest first."""
+        paths = sorted(glob.glob(os.path.join(self.directory, "*.arrow")), key=os.path.getmtime, reverse=True)
+        return [(path, self.read_metadata(path)) for path in paths]
+
+
+def sync_records(client, api_url, store, columns=DESIRED_COLUMNS, max_workers=DEFAULT_FETCH_WORKERS,
+                 cancel_event=None, metrics=None, amount_column=AMOUNT_COLUMN, sizer=None):
+    """
+    Bring a RecordStore up to date with the datastore, downloading only what is new or changed.
+
+    This function:
+    1. Scans the whole dataset for just the record ID, CMS's change_type flag and the payment amount
+       (amount_column, the dataset's own name for it; a few short fields per row instead of the full record).
+       Pages follow sizer (an AdaptivePageSizer for api_url, probed here if none is given), so a page the
+       server cuts down to its cap is noticed and the rest of it fetched (see DatastoreClient.fetch_partition)
+       instead of the missing records looking deleted.
+    2. Works out which records are new (ID not stored yet), changed (change_type or amount differs from the
+       stored copy) and deleted (stored but no longer published).
+    3. Fetches the full records for new and changed IDs only, in batches, using an 'in' condition on the ID.
+       When that would take more requests than paging through the whole dataset (the first sync, where every
+       record is new, or a mass republication) the dataset is paged like a full load instead and only the
+       wanted records are kept.
+    4. Drops deleted records, saves the store and returns counts of what happened.
+
+    Every request skips the response cache: a cached key scan would hide exactly the changes this looks for.
+
+    Raises:
+    - DatastoreError / requests.exceptions.RequestException if the datastore can't be read (the store is untouched).
+    - IngestCancelled if cancel_event is set.
+    """
+    scan_columns = [RECORD_KEY, CHANGE_COLUMN, amount_column]
+    fetch_columns = list(dict.fromkeys(scan_columns + list(columns)))
+    if sizer is None:
+        sizer = AdaptivePageSizer()
+        sizer.probe(client, api_url, fetch_columns)
+    scanned = []
+    for offset, results in client.fetch_pages(api_url, page_partitions(0, None, sizer.current), max_workers,
+                                              columns=scan_columns, cancel_event=cancel_event, sizer=sizer,
+                                              use_cache=False):
+        scanned.append(decode_page(results, scan_columns)[scan_columns])
+        if metrics is not None:
+            metrics.record_page(0)
+    current = pd.concat(scanned, ignore_index=True) if scanned else pd.DataFrame(columns=scan_columns)
+    current = current.drop_duplicates(RECORD_KEY).set_index(RECORD_KEY)
+
+    stored = store.records
+    if stored is None:
+        stored = pd.DataFrame(columns=fetch_columns).set_index(RECORD_KEY)
+
+    known = current.index.isin(stored.index)
+    new_ids = current.index[~known]
+    common = current.index[known]
+    differs = ((stored.loc[common, CHANGE_COLUMN].astype(str) != current.loc[common, CHANGE_COLUMN].astype(str)) |
+               (stored.loc[common, amount_column].astype(str) != current.loc[common, amount_column].astype(str)))
+    changed_ids = common[differs.to_numpy()]
+    deleted_ids = stored.index[~stored.index.isin(current.index)]
+
+    # Fetch the full records for everything new or changed, RECORD_FETCH_BATCH IDs per request
+    wanted = list(new_ids) + list(changed_ids)
+    batches = [wanted[start:start + RECORD_FETCH_BATCH] for start in range(0, len(wanted), RECORD_FETCH_BATCH)]
+
+    def fetch_batch(ids):
+        if cancel_event is not None and cancel_event.is_set():
+            raise IngestCancelled()
+        conditions = [{'property': RECORD_KEY, 'operator': 'in', 'value': list(ids)}]
+        results = client.fetch_page(api_url, 0, len(ids), fetch_columns, conditions=conditions, use_cache=False)
+        if metrics is not None:
+            metrics.record_page(len(results))
+        return decode_page(results, fetch_columns)[fetch_columns] if results else None
+
+    if len(batches) > math.ceil(len(current) / sizer.current()):
+        # Cheaper to page through everything and keep the wanted records
+        wanted_ids = set(wanted)
+        fetched = []
+        pages = client.fetch_pages(api_url, page_partitions(0, None, sizer.current), max_workers,
+                                   columns=fetch_columns, cancel_event=cancel_event, sizer=sizer, use_cache=False)
+        for offset, results in pages:
+            page = decode_page(results, fetch_columns)[fetch_columns]
+            fetched.append(page[page[RECORD_KEY].isin(wanted_ids)])
+            if metrics is not None:
+                metrics.record_page(len(results))
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            fetched = [frame for frame in executor.map(fetch_batch, batches) if frame is not None]
+
+    records = stored.drop(index=deleted_ids)
+    if fetched:
+        updates = pd.concat(fetched, ignore_index=True).drop_duplicates(RECORD_KEY, keep='last').set_index(RECORD_KEY)
+        records = pd.concat([records.drop(index=updates.index, errors='ignore'), updates])
+
+    store.records = records
+    summary = {
+        'scanned': len(current),
+        'new': len(new_ids),
+        'changed': len(changed_ids),
+        'deleted': len(deleted_ids),
+        'fetched': sum(len(frame) for frame in fetched),
+    }
+    store.state = {'api_url': api_url, 'last_sync': time.time(), 'last_summary': summary}
+    store.save()
+    return summary
+
+
+class RetryPolicy:
+    """
+    When and how long to wait before retrying a datastore request.
+
+    Connection errors, timeouts, 429 (Too Many Requests) and 5xx answers are retried up to max_attempts
+    times in total. The wait doubles with every attempt (base_delay, 2x, 4x ... up to max_delay) with full
+    random jitter so parallel workers don't retry in lockstep; a Retry-After header from the server takes
+    precedence when there is one.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt, status_code=None):
+        """attempt counts from 0; status_code is None for connection errors and timeouts."""
+        if attempt + 1 >= self.max_attempts:
+            return False
+        return status_code is None or status_code in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before the next attempt."""
+        server_delay = self.parse_retry_after(retry_after)
+        if server_delay is not None:
+            return min(server_delay, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Retry-After is either a number of seconds or an HTTP date; returns seconds or None."""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all fetch workers, so together they send at most rate requests
+    per second (with bursts of up to capacity). pause() holds every worker back, e.g. after a 429.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait_for)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class DatastoreClient:
+    """
+    Talks to the CMS Open Payments datastore over one pooled, keep-alive HTTP session.
+
+    Every page request goes through the same requests.Session, so the TCP/TLS handshake to
+    openpaymentsdata.cms.gov is paid once per pooled connection instead of once per 500-row page.
+    Responses are requested gzip/deflate compressed, and when a ResponseCache is given they are served from
+    (and revalidated against) the local cache first. Network requests wait their turn on the rate_limiter
+    (a TokenBucket shared by all workers) and transient failures are retried following retry_policy;
+    self.retries counts every retry made.
+    """
+
+    def __init__(self, pool_size=DEFAULT_FETCH_WORKERS, timeout=60, cache=None, retry_policy=None, rate_limiter=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.retries = 0
+        self.retries_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        # One connection per worker thread; block instead of opening throwaway connections when the pool is busy
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=max(1, pool_size), pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        """Close every pooled connection."""
+        self.session.close()
+
+    @staticmethod
+    def page_params(offset, limit, columns=None, conditions=None):
+        """
+        Build the query string for one page of the datastore query endpoint.
+
+        When columns is given, only those properties are requested and the row count / schema
+        blocks are switched off, which keeps each page down to the fields we actually use.
+        conditions is a list of {'property', 'value', 'operator'} dicts the server filters rows by;
+        a list value (for 'in') is sent as value[0], value[1], ...
+        """
+        params = {'limit': limit, 'offset': offset}
+        if columns:
+            for index, column in enumerate(columns):
+                params[f'properties[{index}]'] = column
+            params['count'] = 'false'
+            params['schema'] = 'false'
+        for index, condition in enumerate(conditions or []):
+            params[f'conditions[{index}][property]'] = condition['property']
+            params[f'conditions[{index}][operator]'] = condition.get('operator', '=')
+            if isinstance(condition['value'], (list, tuple)):
+                for value_index, value in enumerate(condition['value']):
+                    params[f'conditions[{index}][value][{value_index}]'] = value
+            else:
+                params[f'conditions[{index}][value]'] = condition['value']
+        return params
+
+    def fetch_page(self, api_url, offset, limit, columns=None, stats=None, conditions=None, use_cache=True,
+                   can_split=False):
+        """
+        Fetch a single page of results from the CMS datastore.
+
+        Returns the list stored under 'results' in the API response (empty once we are past the end of the dataset).
+        If columns is given only those fields are requested; callers should still slice the page locally in case
+        the server ignores the projection. If a stats dict is given, the size of the response body is stored
+        in stats['bytes']. use_cache=False skips the response cache (see get_json); can_split is passed on to send.
+
+        Raises:
+        - DatastoreError if the API answers with anything other than 200.
+        """
+        return self.get_json(api_url, self.page_params(offset, limit, columns, conditions), stats,
+                             use_cache, can_split).get('results', [])
+
+    def fetch_count(self, api_url, conditions=None):
+        """
+        Number of rows in the dataset (meeting conditions, if given), from a count-only query.
+
+        Raises:
+        - DatastoreError if the API answers with anything other than 200 or leaves the count out.
+        """
+        params = self.page_params(0, 1, conditions=conditions)
+        params.update({'count': 'true', 'results': 'false', 'schema': 'false'})
+        body = self.get_json(api_url, params)
+        try:
+            return int(body['count'])
+        except (KeyError, TypeError, ValueError):
+            raise DatastoreError(f"The datastore did not return a row count for {api_url}.")
+
+    def fetch_field_types(self, api_url):
+        """
+        The dataset's schema as a {field: type} dict, e.g. {'total_amount_of_payment_usdollars': 'text'}.
+
+        Asks the query endpoint for a single row with the schema block switched on. Used to decide which filter
+        conditions the server can evaluate (see FilterSpec.split).
+
+        Raises:
+        - DatastoreError if the API answers with anything other than 200.
+        """
+        body = self.get_json(api_url, {'limit': 1, 'offset': 0, 'count': 'false', 'schema': 'true'})
+        field_types = {}
+        # The schema block is keyed by the dataset's resource ID, which we don't need
+        for resource in (body.get('schema') or {}).values():
+            for field, info in (resource.get('fields') or {}).items():
+                field_types[field] = info.get('type') if isinstance(info, dict) else info
+        return field_types
+
+    def fetch_partition(self, api_url, offset, limit, columns=None, sizer=None, conditions=None, use_cache=True):
+        """
+        Fetch rows [offset, offset + limit), reporting to an AdaptivePageSizer if one is given.
+
+        When the request errors or times out and the page is bigger than the sizer's minimum, the page is split
+        in two halves that are fetched one after the other (and split again if needed), so backing off never
+        leaves a hole in the data. A page that comes back short is either the end of the data or a page the
+        server cut down to its cap, so the rest of its range is asked for too: if more rows come back it was a
+        cap (AdaptivePageSizer.record_cap) and the rows are joined up; only an empty answer means the end.
+        A page that can still be split gets a single attempt on a timeout or 5xx, so the split happens straight
+        away instead of after the whole retry policy; 429s and minimum-size pages are retried as usual.
+        Without a sizer this is just fetch_page. With conditions, offsets count the rows that meet them.
+        """
+        if sizer is None:
+            return self.fetch_page(api_url, offset, limit, columns, conditions=conditions, use_cache=use_cache)
+
+        stats = {}
+        started = time.monotonic()
+        try:
+            results = self.fetch_page(api_url, offset, limit, columns, stats=stats, conditions=conditions,
+                                      use_cache=use_cache, can_split=limit > sizer.minimum)
+        except (DatastoreError, requests.exceptions.Timeout) as e:
+            status_code = getattr(e, 'status_code', None)
+            # Only server-side trouble is worth retrying smaller; a 404 or 403 won't get better
+            if limit <= sizer.minimum or (status_code is not None and status_code not in (400, 413) and status_code < 500):
+                raise
+            sizer.record_failure(limit)
+            half = limit // 2
+            first_half = self.fetch_partition(api_url, offset, half, columns, sizer, conditions, use_cache)
+            if len(first_half) < half:
+                # Reached the end of the dataset inside the first half
+                return first_half
+            return first_half + self.fetch_partition(api_url, offset + half, limit - half, columns, sizer, conditions,
+                                                     use_cache)
+
+        sizer.record_success(limit, time.monotonic() - started, stats.get('bytes', 0), len(results))
+        if 0 < len(results) < limit:
+            rest = self.fetch_partition(api_url, offset + len(results), limit - len(results), columns, sizer,
+                                        conditions, use_cache)
+            if rest:
+                sizer.record_cap(len(results))
+                results = results + rest
+        return results
+
+    def get_json(self, api_url, params, stats=None, use_cache=True, can_split=False):
+        """
+        GET api_url with params and return the decoded JSON body, going through the response cache if there is one.
+
+        This function:
+        1. Returns a cached body without touching the network while it is younger than the cache TTL.
+        2. Otherwise sends If-None-Match / If-Modified-Since from the cached entry; a 304 reuses the cached body.
+        3. Retries connection errors, timeouts, 429s and 5xx answers as the retry policy allows (see send).
+        4. Stores any fresh 200 response for next time.
+
+        use_cache=False always asks the server and leaves the cache alone, for requests whose whole point is to see
+        what changed (the key scan of sync_records). can_split is passed on to send.
+
+        Raises:
+        - DatastoreError if the API answers with anything other than 200 (or 304 for a cached entry).
+        """
+        if stats is None:
+            stats = {}
+        cache = self.cache if use_cache else None
+        entry = cache.get(api_url, params) if cache else None
+        if entry and self.cache.is_fresh(entry):
+            stats['bytes'] = len(entry['body'])
+            return json.loads(entry['body'])
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.send(api_url, params, headers, can_split)
+        if response.status_code == 304 and entry:
+            self.cache.refresh(api_url, params)
+            stats['bytes'] = len(entry['body'])
+            return json.loads(entry['body'])
+        if response.status_code != 200:
+            raise DatastoreError(f"{response.status_code}. Response: {response.text}", response.status_code)
+
+        stats['bytes'] = len(response.content)
+        if cache:
+            cache.put(api_url, params, response.content, response.headers)
+        return response.json()
+
+    def send(self, api_url, params, headers=None, can_split=False):
+        """
+        GET a URL through the rate limiter, retrying transient failures per the retry policy.
+
+        Returns the last response (which may still be an error status once the attempts run out).
+        can_split=True means the caller will ask again for a smaller page (see fetch_partition), so timeouts and
+        5xx answers are handed back on the first attempt; connection errors and 429s are still retried.
+
+        Raises:
+        - requests.exceptions.RequestException if the last attempt failed to connect or timed out.
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.get(api_url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if self.retry_policy is None or not self.retry_policy.should_retry(attempt):
+                    raise
+                if can_split and isinstance(e, requests.exceptions.Timeout):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+            else:
+                if self.retry_policy is None or not self.retry_policy.should_retry(attempt, response.status_code):
+                    return response
+                if can_split and response.status_code >= 500:
+                    return response
+                delay = self.retry_policy.delay(attempt, response.headers.get('Retry-After'))
+                if response.status_code == 429 and self.rate_limiter is not None:
+                    # The server wants everyone to slow down, not just this worker
+                    self.rate_limiter.pause(delay)
+
+            with self.retries_lock:
+                self.retries += 1
+            time.sleep(delay)
+            attempt += 1
+
+    def fetch_pages(self, api_url, partitions, max_workers=DEFAULT_FETCH_WORKERS, columns=None, cancel_event=None,
+                    sizer=None, conditions=None, use_cache=True):
+        """
+        Fetch the given (offset, limit) partitions with a bounded pool of worker threads.
+
+        This function:
+        1. Keeps at most 2 * max_workers page requests submitted at any time.
+        2. Yields (offset, results) pairs strictly in partition order, no matter which request finishes first.
+        3. Stops at the first empty page, exactly like the sequential loop did.
+
+        Any requests still outstanding when the caller stops iterating (or an error is raised) are cancelled.
+        If cancel_event is set while waiting, requests that haven't started are dropped and IngestCancelled is
+        raised without waiting for the ones already in flight.
+        With an AdaptivePageSizer each page's timing is fed back to it (see fetch_partition); pass partitions that
+        read sizer.current lazily so later pages pick up the new size.
+        conditions (see page_params) are sent with every page, so the server only returns the rows meeting them.
+        use_cache=False skips the response cache (see get_json).
+
+        Raises:
+        - DatastoreError or requests.exceptions.RequestException from the first page (in order) that failed.
+        - IngestCancelled if cancel_event was set.
+        """
+        partitions = iter(partitions)
+        executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        pending = deque()
+
+        def submit_next():
+            partition = next(partitions, None)
+            if partition is None:
+                return False
+            offset, limit = partition
+            pending.append((offset, executor.submit(
+                self.fetch_partition, api_url, offset, limit, columns, sizer, conditions, use_cache)))
+            return True
+
+        cancelled = False
+        try:
+            for _ in range(2 * max(1, max_workers)):
+                if not submit_next():
+                    break
+
+            while pending:
+                offset, future = pending.popleft()
+                if cancel_event is not None:
+                    # Wait in short slices so a Cancel press is noticed quickly
+                    while not wait([future], timeout=0.2).done:
+                        if cancel_event.is_set():
+                            break
+                    if cancel_event.is_set():
+                        cancelled = True
+                        raise IngestCancelled()
+                results = future.result()
+                if not results:
+                    # Past the end of the dataset, anything after this page is empty too
+                    break
+                yield offset, results
+                submit_next()
+        finally:
+            executor.shutdown(wait=not cancelled, cancel_futures=True)
 
 
 class DataAnalysisApp:
@@ -14,24 +2090,68 @@ class DataAnalysisApp:
         self.root = root
         self.root.title("Data Analysis and Visualization Tool")
         self.df = None  # Placeholder for the DataFrame
+        # After cleaning, self.df holds the payments and this the investigators they point to (InvestigatorDimension)
+        self.investigators = None
+        # When switched on, load_api_data pulls every page instead of stopping at MAX_RECORDS
+        self.full_load_var = None
+        # How many pages load_api_data requests at once
+        self.fetch_workers = DEFAULT_FETCH_WORKERS
+        # Hold names, products and trial IDs as Arrow-backed strings (File menu option, needs pyarrow)
+        self.arrow_strings = pyarrow is not None
+        self.arrow_strings_var = None
+        # Page size chosen for each API URL, probed the first time the URL is loaded
+        self.page_sizers = {}
+        # Field types of each API URL's schema, looked up the first time a filtered load needs them
+        self.field_types = {}
+        # State / manufacturer filter boxes (see current_filters)
+        self.state_var = None
+        self.manufacturer_var = None
+        # Background load state (see start_ingest)
+        self.ingest_thread = None
+        self.ingest_queue = None
+        self.cancel_event = None
+        # Cleaned data is saved here after every load and can be reopened with File > Open Snapshot
+        self.snapshots = SnapshotStore(SNAPSHOT_DIR)
+        # clean_data's rules, from CLEANING_CONFIG_FILE if there is one (File > Load Cleaning Rules swaps them)
+        self.cleaning_pipeline = CleaningPipeline()
+        if os.path.exists(CLEANING_CONFIG_FILE):
+            try:
+                self.cleaning_pipeline = CleaningPipeline.from_file(CLEANING_CONFIG_FILE)
+            except (OSError, CleaningConfigError) as e:
+                messagebox.showwarning("Cleaning Rules", f"{e}\nThe default cleaning rules are used instead.")
+        # Shared HTTP client so every request reuses the same pooled connections
+        self.client = DatastoreClient(pool_size=self.fetch_workers, cache=ResponseCache(RESPONSE_CACHE_DIR),
+                                      retry_policy=RetryPolicy(), rate_limiter=TokenBucket())
 
         # Set window size
         self.root.geometry("800x600")
 
-        # Predefined API for "2023 Research Payments"
-        self.api_urls = {
-            "2023 Research Payments API": "https://openpaymentsdata.cms.gov/api/1/datastore/query/60f290ea-f990-5ef0-845f-68b3a91f45a1"
-        }
+        # Datasets offered in the dropdown (program years x research / general / ownership payments).
+        # "2023 Research Payments API" comes first and is the default.
+        self.datasets = DATASET_REGISTRY
 
         # Create and pack widgets
         self.create_widgets()
 
+        # Once the window is up, offer to reopen the last snapshot instead of downloading again
+        self.root.after(INGEST_POLL_MS, self.offer_snapshot)
+
     def create_widgets(self):
         # Create a menu bar
         menu_bar = tk.Menu(self.root)
 
         # Add "File" menu
         file_menu = tk.Menu(menu_bar, tearoff=0)
+        file_menu.add_command(label="Load from File...", command=self.load_file_data)
+        file_menu.add_command(label="Open Snapshot...", command=self.open_snapshot,
+                              state=tk.NORMAL if pyarrow is not None else tk.DISABLED)
+        file_menu.add_command(label="Load Cleaning Rules...", command=self.load_cleaning_rules)
+        file_menu.add_command(label="Clear Download Cache (Responses and Full-Load Pages)",
+                              command=self.clear_download_cache)
+        self.arrow_strings_var = tk.BooleanVar(self.root, value=self.arrow_strings)
+        file_menu.add_checkbutton(label="Arrow-backed Text Columns (next load)", variable=self.arrow_strings_var,
+                                  command=self.toggle_arrow_strings,
+                                  state=tk.NORMAL if pyarrow is not None else tk.DISABLED)
         file_menu.add_command(label="Exit", command=self.root.quit)
         menu_bar.add_cascade(label="File", menu=file_menu)
 
@@ -72,10 +2192,10 @@ class DataAnalysisApp:
         # Dropdown menu to select API
         self.api_var = tk.StringVar(self.root)
         # Default to "2023 Research Payments API"
-        self.api_var.set(list(self.api_urls.keys())[0])
+        self.api_var.set("2023 Research Payments API")
 
         self.api_dropdown = tk.OptionMenu(
-            self.root, self.api_var, *self.api_urls.keys())
+            self.root, self.api_var, *self.datasets.keys())
         self.api_dropdown.pack(pady=10)
 
         # Button to load data
@@ -83,6 +2203,41 @@ class DataAnalysisApp:
             "Arial", 12), command=self.load_api_data)
         self.load_button.pack(pady=20)
 
+        # Button to load several program years / payment types side by side
+        self.load_multiple_button = tk.Button(self.root, text="Load Multiple Datasets...", font=(
+            "Arial", 11), command=self.choose_datasets)
+        self.load_multiple_button.pack(pady=5)
+
+        # Button to refresh a previously synced dataset, downloading only new or changed records
+        self.refresh_button = tk.Button(self.root, text="Refresh (only new/changed records)", font=(
+            "Arial", 11), command=self.refresh_api_data)
+        self.refresh_button.pack(pady=5)
+
+        # Progress bar, status text and Cancel button for background loads
+        self.progress_bar = ttk.Progressbar(self.root, length=400, mode='determinate')
+        self.progress_bar.pack(pady=5)
+        self.progress_label = tk.Label(self.root, text="", font=("Arial", 10))
+        self.progress_label.pack()
+        self.cancel_button = tk.Button(self.root, text="Cancel", font=(
+            "Arial", 11), command=self.cancel_load, state=tk.DISABLED)
+        self.cancel_button.pack(pady=5)
+
+        # Checkbox to pull the whole dataset instead of the first 30,000 rows
+        self.full_load_var = tk.BooleanVar(self.root, value=False)
+        self.full_load_check = tk.Checkbutton(self.root, text="Load full dataset (pages are streamed to disk)",
+                                              variable=self.full_load_var, font=("Arial", 11))
+        self.full_load_check.pack(pady=5)
+
+        # Optional filters, sent to the API so rows outside them are never downloaded
+        filter_frame = tk.Frame(self.root)
+        filter_frame.pack(pady=5)
+        tk.Label(filter_frame, text="Investigator state (e.g. CA):", font=("Arial", 11)).grid(row=0, column=0, sticky=tk.E)
+        self.state_var = tk.StringVar(self.root)
+        tk.Entry(filter_frame, textvariable=self.state_var, width=6).grid(row=0, column=1, sticky=tk.W, padx=5)
+        tk.Label(filter_frame, text="Manufacturer name contains:", font=("Arial", 11)).grid(row=1, column=0, sticky=tk.E)
+        self.manufacturer_var = tk.StringVar(self.root)
+        tk.Entry(filter_frame, textvariable=self.manufacturer_var, width=30).grid(row=1, column=1, sticky=tk.W, padx=5)
+
         # Button to view column options (MITCH ADDITION)
         self.columns_button = tk.Button(self.root, text="View Columns", font=(
             "Arial", 12), command=self.show_columns)
@@ -101,104 +2256,694 @@ class DataAnalysisApp:
     def load_api_data(self):
         """Fetched data from the selected API and loads it into a DataFrame.
         The CMS API gives us a json with 4 dictonary objects. We only need to keep the one labeled 'results'.
-        Uses the json_normalize function to parse the results into a pandas dataframe. 
+        Uses decode_page to parse the results into a pandas dataframe (json_normalize is only needed for nested records). 
         Also limits the columns it pulls in from the results in order to speed up the processing time. 
+        The column list is sent to the API as a projection so the server only returns those fields.
         If a column is not found, raises an error.
         We also limit to the first 30,000 records to speed processing. Could be increased in future iteratons. 
+        Pages are requested in parallel (self.fetch_workers at a time) and stitched back together in offset order,
+        so the result is the same as fetching them one after another.
+        With "Load full dataset" ticked there is no 30,000 cap: every page is written straight to a PageSpool on disk
+        as it arrives and only read back once the download is finished, so memory stays flat while downloading.
+        If a full download fails part way, the pages already on disk are kept and the next "Load Data" (even after
+        restarting the app) only fetches the row ranges that are still missing.
+        The download itself runs on a background thread (see start_ingest) so the window stays responsive,
+        shows progress and can be cancelled.
+        The state / manufacturer filters and the payment rules of clean_data are sent to the API as query
+        conditions (see FilterSpec), so filtered-out rows are never downloaded and the 30,000 rows are all useful.
         """
         selected_api = self.api_var.get()  # Get selected API name from the dropdown
-        api_url = self.api_urls[selected_api]  # Get the corresponding URL
-        desired_columns = [
-            'total_amount_of_payment_usdollars', 'principal_investigator_1_state',
-            'form_of_payment_or_transfer_of_value', 'name_of_drug_or_biological_or_device_or_medical_supply_1',
-            'product_category_or_therapeutic_area_1',
-            'principal_investigator_1_primary_type_1',
-            'principal_investigator_1_specialty_1', 'submitting_applicable_manufacturer_or_applicable_gpo_name',
-            'principal_investigator_1_profile_id', 'principal_investigator_1_first_name', 'principal_investigator_1_last_name',
-            'clinicaltrials_gov_identifier'
-        ]
+        full_load = self.full_load_var is not None and self.full_load_var.get()
+        filters = self.current_filters()
 
-        try:
-            limit = 500
-            offset = 0
-            all_data = []
-            total_records = 0
-
-            self.df = pd.DataFrame()
-
-            while total_records < 30000:
-                # Make the request with the current offset and limit
-                response = requests.get(
-                    api_url, params={'limit': limit, 'offset': offset})
-
-                if response.status_code == 200:
-                    # Extract the results portion from the API response
-                    database = response.json()
-                    results = database.get('results', [])
-
-                    if not results:
-                        # Exit the loop if no results are returned
-                        break
-
-                    # Normalize the results for this page and apply columns filtering
-                    normalized_data = pd.json_normalize(results)
-
-                    # Check if all the desired columns are in the normalized data
-                    missing_columns = [
-                        col for col in desired_columns if col not in normalized_data.columns]
-
-                    if missing_columns:
-                        # If there are missing columns, show an error message and break
-                        missing_columns_str = ', '.join(missing_columns)
-                        messagebox.showerror("Missing Columns", f"The following columns are missing: {
-                                             missing_columns_str}")
-                        return  # Stop if columns are missing
-                    else:
-                        # If no columns are missing, filter the DataFrame to keep only the desired columns
-                        normalized_data = normalized_data[desired_columns]
-
-                        # Append this round of the resluts data to the all_data list
-                        all_data.append(normalized_data)
-                        total_records += len(normalized_data)
-                        print(f"Loaded {len(results)} records, total: {
-                              len(all_data) * limit} records.")
-
-                    offset += limit
-
-                    # If total records exceed 30,000, break out of the loop
-                    if total_records >= 30000:
-                        break
+        self.start_ingest(
+            f"Loading {selected_api}", None if full_load else MAX_RECORDS,
+            lambda metrics, cancel_event: self.ingest_api_data(
+                selected_api, full_load, metrics, cancel_event, filters))
 
-                else:
-                    messagebox.showerror("Error", f"Failed to load data from {selected_api}: {
-                                         response.status_code}. Response: {response.text}")
-                    break
+    def current_filters(self):
+        """The FilterSpec for the filter boxes in the main window (read on the main thread)."""
+        state = self.state_var.get() if self.state_var is not None else None
+        manufacturer = self.manufacturer_var.get() if self.manufacturer_var is not None else None
+        return FilterSpec.for_selection(state, manufacturer, **self.cleaning_pipeline.payment_rules())
 
-            if all_data:
-                # Once all data is collected, concatenate and assign to the DataFrame
-                self.df = pd.concat(all_data, ignore_index=True)
+    def plan_filters(self, spec, api_url, filters):
+        """
+        Split filters into (pushed, local) conditions for one dataset, looking up its schema once per URL.
 
-                # If we have more than 30,000 records, truncate the DataFrame to 30,000 rows
-                if len(self.df) > 30000:
-                    self.df = self.df.head(30000)
+        If the schema can't be fetched the numeric conditions are simply kept local.
+        """
+        if not filters.conditions:
+            return [], []
+        if api_url not in self.field_types:
+            try:
+                self.field_types[api_url] = self.client.fetch_field_types(api_url)
+            except (DatastoreError, requests.exceptions.RequestException) as e:
+                print(f"Could not read the schema of {api_url}, filtering numbers locally: {e}")
+                return filters.split(spec)
+        return filters.split(spec, self.field_types[api_url])
+
+    def count_rows(self, api_url, conditions=None):
+        """Rows the datastore holds for api_url (meeting conditions), or None if the count query fails."""
+        try:
+            return self.client.fetch_count(api_url, conditions)
+        except (DatastoreError, requests.exceptions.RequestException) as e:
+            print(f"Could not count the rows of {api_url}, loading until the pages run out: {e}")
+            return None
+
+    def report_pages(self, pages, metrics):
+        """Pipeline stage that passes pages through unchanged, recording each one in metrics and posting progress."""
+        for offset, page in pages:
+            metrics.record_page(len(page))
+            self.post('progress', metrics.snapshot())
+            yield offset, page
+
+    def ingest_api_data(self, selected_api, full_load, metrics, cancel_event, filters=None):
+        """
+        Download the selected API into a DataFrame. Runs on the ingest worker thread.
+
+        This function never touches Tk widgets or message boxes itself; every message and the finished
+        DataFrame are handed to the main thread through self.post (see poll_ingest_queue).
+        filters is a FilterSpec; the conditions the server can evaluate are sent with every page and the rest
+        are applied locally.
+        The rows are counted first so the pages can be planned up front (plan_load) and the progress bar knows
+        the total. If the count query fails the load falls back to fetching until a page comes back empty.
+        Pages stream through normalize_pages, coerce_pages and filter_pages as they arrive and the kept rows are
+        appended to preallocated ColumnBuffers, so only one page plus the kept rows are held in memory. A full
+        load spools the normalized pages to disk and streams them through the same stages once it's done.
 
-                messagebox.showinfo("Data Loaded", f"Data successfully loaded from {
-                                    selected_api} with {len(self.df)} records.")
-                # Used while we were debugging: see the first 5 rows of the data
-                # print(self.df.head())
-                
-                self.clean_data()
+        Raises:
+        - IngestCancelled if the user pressed Cancel.
+        """
+        spec = self.datasets[selected_api]
+        # The fields to ask the API for; general/ownership datasets call them differently and are renamed per page
+        desired_columns = dataset_source_columns(spec)
+        filters = filters if filters is not None else FilterSpec()
+
+        try:
+            api_url = resolve_dataset_url(self.client, spec)  # Get the corresponding URL
+            pushed, local = self.plan_filters(spec, api_url, filters)
+            if pushed:
+                print(f"Filtering on the server: {FilterSpec(pushed).describe()}")
+
+            # Find out how big a page the server is happy to send (once per URL) and keep adapting while loading
+            sizer = self.page_sizer(api_url, desired_columns)
+            limit = sizer.current
+
+            # Pre-flight count, so the work can be split evenly and the progress bar shows an ETA
+            total_rows = self.count_rows(api_url, pushed)
+
+            if full_load:
+                # No cap: keep going until the API runs out of pages, parking each page on disk.
+                # Ranges already on disk from an earlier (possibly failed) attempt are skipped.
+                spool = PageSpool.for_url(api_url)
+                spool.start(api_url, DESIRED_COLUMNS, pushed)
+                if total_rows is not None:
+                    spool.set_total(total_rows)
+                    metrics.expected_rows = total_rows
+                if spool.rows_on_disk():
+                    print(f"Resuming download: {spool.rows_on_disk()} records already on disk.")
+                    metrics.record_page(spool.rows_on_disk(), pages=0)
+                partitions = spool.missing_partitions(limit)
             else:
-                messagebox.showwarning(
-                    "No Data", "No data was loaded from the API.")
+                partitions = self.plan_capped_load(sizer, total_rows)
+                if total_rows is not None:
+                    metrics.expected_rows = min(total_rows, MAX_RECORDS)
+            if not full_load:
+                # Kept rows are appended here page by page, with the amount already a number
+                buffers = ColumnBuffers(DESIRED_COLUMNS, metrics.expected_rows or MAX_RECORDS,
+                                        loaded_dtypes(self.arrow_strings))
+
+            try:
+                # Each page is normalized (and, for a capped load, coerced and filtered) as soon as it arrives
+                pages = self.client.fetch_pages(
+                    api_url, partitions, self.fetch_workers, columns=desired_columns, cancel_event=cancel_event,
+                    sizer=sizer, conditions=pushed)
+                pages = self.report_pages(normalize_pages(pages, spec), metrics)
+                if full_load:
+                    for offset, page in pages:
+                        # Park the page on disk so only one page at a time is held in memory. Pages are spooled
+                        # as the server sent them so their row ranges line up with the offsets for resuming.
+                        spool.write(offset, page)
+                        print(f"Loaded {len(page)} records, total: {spool.rows_on_disk()} records.")
+                else:
+                    for offset, page in filter_pages(coerce_pages(pages), filters, local):
+                        buffers.append(page)
+                        print(f"Kept {len(page)} records, total: {buffers.rows} records.")
+
+                if full_load:
+                    # Ran off the end of the dataset without an error, so the spool holds everything
+                    spool.mark_complete()
+
+            except (DatastoreError, requests.exceptions.RequestException) as e:
+                if full_load:
+                    # Everything downloaded so far stays on disk; the next attempt picks up from there
+                    self.post('error', "Error", f"Download from {selected_api} stopped: {e}\n"
+                              f"{spool.rows_on_disk()} records are saved. Click Load Data again to resume.")
+                    return
+                if isinstance(e, requests.exceptions.RequestException):
+                    raise
+                # Keep whatever pages arrived before the failed one, same as the sequential loop did
+                self.post('error', "Error", f"Failed to load data from {selected_api}: {e}")
+
+            if full_load and spool.rows_on_disk():
+                # Read the spooled pages back one at a time through the same coerce / filter stages
+                buffers = ColumnBuffers(DESIRED_COLUMNS, spool.rows_on_disk(), loaded_dtypes(self.arrow_strings))
+                for offset, page in filter_pages(coerce_pages(spool.iter_pages(DESIRED_COLUMNS)), filters, local):
+                    buffers.append(page)
+                df = buffers.frame()
+                self.post('loaded', df, "Data Loaded", f"Full dataset loaded from {
+                          selected_api} with {len(df)} records.",
+                          {'source': selected_api, 'url': api_url, 'full_load': True, 'filters': filters.conditions},
+                          buffers.sketch)
+            elif not full_load and buffers.rows:
+                # Every kept row is already in the buffers; the main thread stores the frame in self.df,
+                # tells the user and runs clean_data (which only has the percentile trim left to do)
+                df = buffers.frame()
+                self.post('loaded', df, "Data Loaded", f"Data successfully loaded from {
+                          selected_api} with {len(df)} records.",
+                          {'source': selected_api, 'url': api_url, 'full_load': False, 'filters': filters.conditions},
+                          buffers.sketch)
+            else:
+                self.post('warning', "No Data", "No data was loaded from the API.")
 
+        except IngestCancelled:
+            raise
+        except MissingColumnsError as e:
+            # Stop if columns are missing
+            self.post('error', "Missing Columns", str(e))
         except requests.exceptions.RequestException as e:
             # Handle specific request errors (e.g., connection issues)
-            messagebox.showerror("Error", f"Request failed: {e}")
+            self.post('error', "Error", f"Request failed: {e}")
         except Exception as e:
             # General error handling
-            messagebox.showerror("Error", f"Error fetching data from {
-                                 selected_api}: {e}")
+            self.post('error', "Error", f"Error fetching data from {selected_api}: {e}")
+
+    def choose_datasets(self):
+        """
+        Let the user tick several datasets (e.g. the same payment type over several program years) and load them
+        together into one DataFrame, tagged with 'program_year' and 'payment_type' columns.
+        """
+        choose_window = tk.Toplevel(self.root)
+        choose_window.title("Load Multiple Datasets")
+
+        tk.Label(choose_window, text="Select the datasets to load:", font=("Arial", 12)).pack(pady=10)
+
+        selected = {}
+        for name in self.datasets:
+            selected[name] = tk.BooleanVar(choose_window, value=False)
+            tk.Checkbutton(choose_window, text=name, variable=selected[name],
+                           font=("Arial", 11)).pack(anchor=tk.W, padx=20)
+
+        def load_selected():
+            names = [name for name, var in selected.items() if var.get()]
+            if not names:
+                messagebox.showwarning("No Selection", "Please select at least one dataset.")
+                return
+            choose_window.destroy()
+            filters = self.current_filters()
+            self.start_ingest(f"Loading {len(names)} datasets", MAX_RECORDS * len(names),
+                              lambda metrics, cancel_event: self.ingest_datasets(names, metrics, cancel_event, filters))
+
+        tk.Button(choose_window, text="Load Selected", command=load_selected, font=("Arial", 12)).pack(pady=10)
+        tk.Button(choose_window, text="Close", command=choose_window.destroy, font=("Arial", 12)).pack(pady=10)
+
+    def page_sizer(self, api_url, columns=None):
+        """
+        The AdaptivePageSizer for api_url, probing the server with columns the first time the URL is used. A probe
+        that got no full page back (errors or timeouts) isn't kept, so the next load probes again.
+        """
+        if api_url in self.page_sizers:
+            return self.page_sizers[api_url]
+        sizer = AdaptivePageSizer()
+        sizer.probe(self.client, api_url, columns)
+        if sizer.full_size is not None:
+            self.page_sizers[api_url] = sizer
+        return sizer
+
+    def plan_capped_load(self, sizer, total_rows):
+        """
+        The pages of a load capped at MAX_RECORDS rows. With a row count they are evenly sized over exactly the
+        rows we'll fetch (plan_load); without one the first MAX_RECORDS rows are handed out page by page, each
+        page as big as the sizer says at that moment (fetch_pages still returns them in offset order).
+        """
+        if total_rows is not None:
+            return plan_load(total_rows, sizer.current(), self.fetch_workers, MAX_RECORDS)
+        return page_partitions(0, MAX_RECORDS, sizer.current)
+
+    def fetch_dataset_frame(self, name, metrics, cancel_event, filters=None):
+        """
+        Download the first MAX_RECORDS rows of one registry dataset, with our column names and tagged with its
+        program year and payment type. Used by ingest_datasets, one call per dataset. Pages go through the same
+        streaming stages as ingest_api_data, and filters (a FilterSpec) is pushed down to the dataset as far as
+        its fields allow.
+
+        Raises:
+        - MissingColumnsError if the dataset lacks one of the fields we need.
+        - DatastoreError / requests.exceptions.RequestException if it can't be downloaded.
+        """
+        spec = self.datasets[name]
+        columns = dataset_source_columns(spec)
+        filters = filters if filters is not None else FilterSpec()
+        api_url = resolve_dataset_url(self.client, spec)
+        pushed, local = self.plan_filters(spec, api_url, filters)
+        sizer = self.page_sizer(api_url, columns)
+
+        total_rows = self.count_rows(api_url, pushed)
+        partitions = self.plan_capped_load(sizer, total_rows)
+
+        buffers = ColumnBuffers(DESIRED_COLUMNS, MAX_RECORDS if total_rows is None else min(total_rows, MAX_RECORDS),
+                                loaded_dtypes(self.arrow_strings))
+        pages = self.client.fetch_pages(api_url, partitions, self.fetch_workers, columns=columns,
+                                        cancel_event=cancel_event, sizer=sizer, conditions=pushed)
+        pages = self.report_pages(normalize_pages(pages, spec), metrics)
+        for offset, page in filter_pages(coerce_pages(pages), filters, local):
+            buffers.append(page)
+
+        frame = buffers.frame()
+        frame['program_year'] = spec['program_year']
+        frame['payment_type'] = spec['payment_type']
+        return frame, buffers.sketch
+
+    def ingest_datasets(self, names, metrics, cancel_event, filters=None):
+        """
+        Load several registry datasets in parallel into one DataFrame. Runs on the ingest worker thread.
+
+        Each dataset is fetched on its own thread (fetch_dataset_frame); they all share the app's client, so its
+        connection pool and rate limit apply to the combined load. A dataset that fails is reported and left
+        out, the others are still loaded.
+        """
+        frames = []
+        failures = []
+        # The datasets' amount sketches are merged into one for the combined data
+        sketch = QuantileSketch()
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            futures = {name: executor.submit(self.fetch_dataset_frame, name, metrics, cancel_event, filters)
+                       for name in names}
+            for name, future in futures.items():
+                try:
+                    frame, frame_sketch = future.result()
+                    frames.append(frame)
+                    sketch.merge(frame_sketch)
+                except IngestCancelled:
+                    raise
+                except (ValueError, DatastoreError, requests.exceptions.RequestException) as e:
+                    failures.append(f"{name}: {e}")
+
+        if failures:
+            self.post('error', "Error", "Some datasets could not be loaded:\n" + "\n".join(failures))
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            self.post('warning', "No Data", "No data was loaded from the API.")
+            return
+
+        df = pd.concat(frames, ignore_index=True)
+        years = ', '.join(str(year) for year in sorted(df['program_year'].unique()))
+        self.post('loaded', df, "Data Loaded", f"Loaded {len(df)} records from {len(frames)} datasets "
+                  f"(program years {years}).",
+                  {'source': ' + '.join(names), 'url': None, 'full_load': False,
+                   'filters': filters.conditions if filters is not None else []}, sketch)
+
+    def refresh_api_data(self):
+        """
+        Incrementally sync the selected API into a local record store and load the result.
+
+        The first refresh downloads everything (plus the record IDs); after that only new or changed
+        records are downloaded, see sync_records. Runs in the background like load_api_data.
+        """
+        selected_api = self.api_var.get()
+        filters = self.current_filters()
+        self.start_ingest(f"Refreshing {selected_api}", None,
+                          lambda metrics, cancel_event: self.ingest_refresh(selected_api, metrics, cancel_event, filters))
+
+    def ingest_refresh(self, selected_api, metrics, cancel_event, filters=None):
+        """
+        Worker-thread body for refresh_api_data.
+
+        The record store always mirrors the whole dataset (otherwise changing a filter would look like
+        deletions), so filters are applied locally to the synced records.
+        """
+        filters = filters if filters is not None else FilterSpec()
+        spec = self.datasets[selected_api]
+        try:
+            api_url = resolve_dataset_url(self.client, spec)
+            store = RecordStore.for_url(api_url)
+            summary = sync_records(self.client, api_url, store, dataset_source_columns(spec), self.fetch_workers,
+                                   cancel_event, metrics, amount_column=dataset_source_columns(spec, [AMOUNT_COLUMN])[0],
+                                   sizer=self.page_sizer(api_url, dataset_source_columns(spec)))
+            print(f"Incremental refresh of {selected_api}: {summary}")
+            if store.records is None or store.records.empty:
+                self.post('warning', "No Data", "No data was loaded from the API.")
+                return
+            df = to_canonical_columns(store.records[dataset_source_columns(spec)].reset_index(drop=True), spec)
+            df = filters.apply(df).reset_index(drop=True)
+            self.post('loaded', df, "Data Refreshed", f"{selected_api}: {summary['new']} new, {summary['changed']} "
+                      f"changed and {summary['deleted']} removed records; {len(df)} records in total.",
+                      {'source': selected_api, 'url': api_url, 'full_load': True, 'filters': filters.conditions},
+                      None)
+        except IngestCancelled:
+            raise
+        except (DatastoreError, requests.exceptions.RequestException) as e:
+            self.post('error', "Error", f"Refresh of {selected_api} failed, the local copy was not changed: {e}")
+
+    def load_file_data(self):
+        """
+        Load research payments from a CSV (or zipped CSV) downloaded from the CMS website.
+
+        This function:
+        1. Asks the user for the file.
+        2. Reads it in chunks on the ingest worker thread, parsing only the desired columns with fixed dtypes.
+        3. Drops blank, 0 and over-$1,000,000 payments from each chunk as it is read, so only useful rows stay in memory.
+        4. Hands the combined result to clean_data, the same as an API load.
+
+        Raises:
+        - An error if the file can't be read or is missing one of the desired columns.
+        """
+        file_path = filedialog.askopenfilename(
+            filetypes=[("CSV files", "*.csv"), ("Zipped CSV files", "*.zip"), ("All files", "*.*")],
+            title="Load Research Payments File"
+        )
+        if not file_path:
+            return
+
+        filters = self.current_filters()
+        self.start_ingest(f"Reading {os.path.basename(file_path)}", None,
+                          lambda metrics, cancel_event: self.ingest_file_data(file_path, metrics, cancel_event, filters))
+
+    def ingest_file_data(self, file_path, metrics, cancel_event, filters=None):
+        """
+        Read a bulk CSV file into a DataFrame. Runs on the ingest worker thread, like ingest_api_data.
+
+        There is no server to push filters to, so they are applied to each chunk as it is read.
+        """
+        filters = filters if filters is not None else FilterSpec()
+        try:
+            chunks = []
+            sketch = QuantileSketch()
+            for chunk in read_bulk_csv(file_path, dtypes=loaded_dtypes(self.arrow_strings)):
+                if cancel_event.is_set():
+                    raise IngestCancelled()
+                metrics.record_page(len(chunk))
+                self.post('progress', metrics.snapshot())
+                chunks.append(filters.apply(drop_invalid_payments(chunk, **filters.payment_rules)))
+                sketch.update(chunks[-1][AMOUNT_COLUMN])
+                print(f"Read {metrics.rows} records from {os.path.basename(file_path)}.")
+
+            if not chunks:
+                self.post('warning', "No Data", "No data was found in the file.")
+                return
+
+            df = pd.concat(chunks, ignore_index=True)
+            self.post('loaded', df, "Data Loaded", f"Data successfully loaded from {
+                      os.path.basename(file_path)} with {len(df)} records.",
+                      {'source': os.path.basename(file_path), 'url': file_path, 'full_load': True,
+                       'filters': filters.conditions}, sketch)
+        except IngestCancelled:
+            raise
+        except Exception as e:
+            self.post('error', "Error", f"Error reading {file_path}: {e}")
+
+    def start_ingest(self, description, expected_rows, job):
+        """
+        Run a data load on a background thread so the window doesn't freeze while it downloads.
+
+        This function:
+        1. Creates the queue the worker reports through and the event the Cancel button sets.
+        2. Starts job(metrics, cancel_event) on a daemon thread.
+        3. Polls the queue from the Tk main loop every INGEST_POLL_MS milliseconds (poll_ingest_queue).
+
+        Only one load can run at a time.
+        """
+        if self.ingest_thread is not None and self.ingest_thread.is_alive():
+            messagebox.showwarning("Busy", "A load is already running. Cancel it or wait for it to finish.")
+            return
+
+        self.ingest_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        metrics = IngestMetrics(expected_rows, self.client)
+        self.show_progress(description, expected_rows)
+
+        self.ingest_thread = threading.Thread(
+            target=self.run_ingest, args=(job, metrics), daemon=True)
+        self.ingest_thread.start()
+        self.root.after(INGEST_POLL_MS, self.poll_ingest_queue)
+
+    def run_ingest(self, job, metrics):
+        """Worker thread entry point: runs the job and always finishes with a 'finished' message."""
+        try:
+            job(metrics, self.cancel_event)
+        except IngestCancelled:
+            self.post('warning', "Load Cancelled", f"Load cancelled after {metrics.rows} records.")
+        except Exception as e:
+            self.post('error', "Error", f"Load failed: {e}")
+        finally:
+            self.post('finished', metrics.snapshot())
+
+    def post(self, kind, *args):
+        """
+        Hand a message from the worker thread to the main thread (thread-safe).
+
+        Freshly loaded data posted from the ingest thread is cleaned and snapshotted right here, still on that
+        thread (finish_load), and goes over as 'cleaned', so the window stays responsive while that runs.
+        """
+        if kind == 'loaded' and threading.current_thread() is self.ingest_thread:
+            kind, *args = self.finish_load(*args)
+        self.ingest_queue.put((kind, *args))
+
+    def finish_load(self, df, title, text, source, sketch):
+        """
+        Worker-thread half of a load: clean df (clean_data) and save the snapshot of source.
+
+        Returns the message for the main thread, ('cleaned', payments, investigators, title, text, cleaning_text).
+        """
+        payments, investigators, cleaning_text = self.clean_data(df, sketch)
+        self.save_snapshot(payments, investigators, source)
+        return 'cleaned', payments, investigators, title, text, cleaning_text
+
+    def poll_ingest_queue(self):
+        """
+        Handle everything the worker thread has posted since the last poll. Runs on the Tk main thread.
+
+        Messages are ('progress', snapshot), ('info' | 'warning' | 'error', title, text),
+        ('cleaned', payments, investigators, title, text, cleaning_text) for freshly loaded data (already cleaned
+        on the worker, see finish_load), ('opened', payments, investigators, title, text) for a snapshot
+        and finally ('finished', snapshot).
+
+        A message that can't be handled is reported and skipped; polling carries on either way, so the load
+        buttons always come back.
+        """
+        finished = None
+        try:
+            while True:
+                try:
+                    kind, *args = self.ingest_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                try:
+                    if kind == 'progress':
+                        self.update_progress(args[0])
+                    elif kind == 'info':
+                        messagebox.showinfo(*args)
+                    elif kind == 'warning':
+                        messagebox.showwarning(*args)
+                    elif kind == 'error':
+                        messagebox.showerror(*args)
+                    elif kind == 'cleaned':
+                        self.df, self.investigators, title, text, cleaning_text = args
+                        messagebox.showinfo(title, text)
+                        # Used while we were debugging: see the first 5 rows of the data
+                        # print(self.df.head())
+                        messagebox.showinfo("Data Cleaned", cleaning_text)
+                    elif kind == 'opened':
+                        self.df, self.investigators, title, text = args
+                        messagebox.showinfo(title, text)
+                    elif kind == 'finished':
+                        finished = args[0]
+                except Exception as e:
+                    messagebox.showerror("Error", f"Could not handle the {kind} data: {e}")
+        finally:
+            if finished is None:
+                self.root.after(INGEST_POLL_MS, self.poll_ingest_queue)
+            else:
+                self.hide_progress(finished)
+
+    def cancel_load(self):
+        """Ask the running load to stop; requests that haven't started yet are dropped."""
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.progress_label.config(text="Cancelling...")
+
+    def show_progress(self, description, expected_rows):
+        """Switch the progress bar on for a new load."""
+        self.load_button.config(state=tk.DISABLED)
+        self.refresh_button.config(state=tk.DISABLED)
+        self.load_multiple_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_label.config(text=description)
+        if expected_rows:
+            self.progress_bar.config(mode='determinate', maximum=expected_rows, value=0)
+        else:
+            # Total size unknown: just show that something is happening
+            self.progress_bar.config(mode='indeterminate')
+            self.progress_bar.start(20)
+
+    def update_progress(self, snapshot):
+        if snapshot['expected_rows']:
+            # The total may only be known once the load's count query is back, so switch the bar over then
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', maximum=snapshot['expected_rows'],
+                                     value=min(snapshot['rows'], snapshot['expected_rows']))
+        self.progress_label.config(text=format_progress(snapshot))
+
+    def hide_progress(self, snapshot):
+        """Put the progress area back to idle once a load has finished, failed or been cancelled."""
+        self.progress_bar.stop()
+        self.progress_bar.config(mode='determinate', value=0)
+        self.progress_label.config(
+            text=f"Last load: {snapshot['rows']:,} records in {snapshot['elapsed']:.1f} s, {snapshot['retries']} retries")
+        self.load_button.config(state=tk.NORMAL)
+        self.refresh_button.config(state=tk.NORMAL)
+        self.load_multiple_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        self.cancel_event = None
+
+    def save_snapshot(self, payments, investigators, source):
+        """
+        Save cleaned payments and their InvestigatorDimension as a snapshot of source (a dict with at least
+        'source', the name it was loaded from). Runs on the ingest worker thread (finish_load). Does nothing
+        without pyarrow; a failed save is only reported on the console.
+        """
+        if pyarrow is None:
+            return
+        # The two tables are written as they are; joining them first would need a second copy of every payment
+        columns = [column for column in payments.columns if column != INVESTIGATOR_KEY]
+        metadata = {**source, 'rows': len(payments), 'columns': columns + list(investigators.table.columns),
+                    'cleaning': self.cleaning_pipeline.stages,
+                    'saved': time.strftime('%Y-%m-%d %H:%M')}
+        try:
+            path = self.snapshots.save(payments, metadata, investigators.table)
+            print(f"Saved a snapshot of {source['source']} to {path}")
+        except (OSError, pyarrow.ArrowException, TypeError, ValueError) as e:
+            print(f"Could not save a snapshot of {source['source']}: {e}")
+
+    def offer_snapshot(self):
+        """At startup: if a snapshot was saved in an earlier session, ask whether to open it."""
+        if pyarrow is None or self.df is not None:
+            return
+        try:
+            snapshots = self.snapshots.snapshots()
+        except (OSError, pyarrow.ArrowException, ValueError) as e:
+            print(f"Could not read the saved snapshots: {e}")
+            return
+        if not snapshots:
+            return
+        path, metadata = snapshots[0]
+        # The amount conditions are the cleaning rules every load has; the state / manufacturer ones are a choice
+        selection = FilterSpec([condition for condition in metadata.get('filters') or []
+                                if condition['property'] != AMOUNT_COLUMN])
+        filtered = f", filtered on {selection.describe()}" if selection.conditions else ""
+        if messagebox.askyesno("Open Snapshot", f"Open the saved data from {metadata.get('source', path)} "
+                               f"({metadata.get('rows', 0):,} records{filtered}, saved "
+                               f"{metadata.get('saved', 'earlier')}) instead of loading it again?"):
+            self.open_snapshot_file(path)
+
+    def open_snapshot(self):
+        """Let the user pick a saved snapshot and open it (already cleaned, so clean_data isn't run again)."""
+        file_path = filedialog.askopenfilename(
+            initialdir=SNAPSHOT_DIR if os.path.isdir(SNAPSHOT_DIR) else None,
+            filetypes=[("Snapshots", "*.arrow"), ("All files", "*.*")],
+            title="Open Snapshot"
+        )
+        if file_path:
+            self.open_snapshot_file(file_path)
+
+    def open_snapshot_file(self, file_path):
+        self.start_ingest(f"Opening {os.path.basename(file_path)}", None,
+                          lambda metrics, cancel_event: self.ingest_snapshot(file_path, metrics, cancel_event))
+
+    def ingest_snapshot(self, file_path, metrics, cancel_event):
+        """Worker-thread body for open_snapshot_file."""
+        try:
+            df, metadata = SnapshotStore.load(file_path)
+            table = SnapshotStore.load_investigators(file_path)
+        except (OSError, pyarrow.ArrowException) as e:
+            self.post('error', "Error", f"Could not open snapshot {file_path}: {e}")
+            return
+        metrics.record_page(len(df))
+        if table is None:
+            # Saved as one joined table (older snapshots)
+            payments, investigators = InvestigatorDimension.split(df)
+        else:
+            payments, investigators = df, InvestigatorDimension(table, df[INVESTIGATOR_KEY].to_numpy())
+        self.post('opened', payments, investigators, "Snapshot Opened", f"{metadata.get('source', os.path.basename(file_path))}: "
+                  f"{len(df)} cleaned records, saved {metadata.get('saved', 'earlier')}.")
+
+    def joined_frame(self):
+        """self.df with the investigator attributes joined back on (self.df itself before cleaning)."""
+        if self.investigators is None:
+            return self.df
+        return self.investigators.join(self.df)
+
+    def data_columns(self):
+        """The columns to offer the user: the payment columns plus the investigator attributes, minus the key."""
+        columns = [column for column in self.df.columns if column != INVESTIGATOR_KEY]
+        if self.investigators is not None:
+            columns += list(self.investigators.table.columns)
+        return [column for column in DESIRED_COLUMNS if column in columns] + \
+            [column for column in columns if column not in DESIRED_COLUMNS]
+
+    def column_data(self, column):
+        """One column lined up with the payment rows, joined from the investigator table if it lives there."""
+        if self.investigators is not None and column in self.investigators.table.columns:
+            return self.investigators.column(self.df, column)
+        return self.df[column]
+
+    def find_investigator_payments(self, profile_id=None, first_name=None, last_name=None):
+        """
+        The payments (with investigator attributes joined on) to investigators matching the search_by_pi criteria.
+        The investigator table is searched and the payments are then picked by key, so the payment table is
+        never scanned.
+        """
+        if self.investigators is None:
+            payments, investigators = InvestigatorDimension.split(self.df)
+        else:
+            payments, investigators = self.df, self.investigators
+        keys = investigators.find(profile_id, first_name, last_name)
+        return investigators.join(payments.iloc[investigators.payment_rows(keys)])
+
+    def toggle_arrow_strings(self):
+        """Switch Arrow-backed text columns on or off for the next load."""
+        self.arrow_strings = self.arrow_strings_var.get() and pyarrow is not None
+
+    def load_cleaning_rules(self):
+        """Let the user pick a cleaning rules file (see CleaningPipeline) to use from the next load on."""
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Cleaning rules", "*.json"), ("All files", "*.*")],
+            title="Load Cleaning Rules"
+        )
+        if not file_path:
+            return
+        try:
+            self.cleaning_pipeline = CleaningPipeline.from_file(file_path)
+        except (OSError, CleaningConfigError) as e:
+            messagebox.showerror("Cleaning Rules", f"Could not use {file_path}: {e}")
+            return
+        stages = ', '.join(stage['stage'] for stage in self.cleaning_pipeline.stages)
+        messagebox.showinfo("Cleaning Rules", f"The next load is cleaned with: {stages}.")
+
+    def clear_download_cache(self):
+        """
+        Delete every cached API response and every full-load spool (PageSpool.clear_all), so the next load goes
+        back to the server. A complete spool is otherwise reused as it is by every later full load.
+        """
+        if self.ingest_thread is not None and self.ingest_thread.is_alive():
+            messagebox.showwarning("Busy", "A load is running. Cancel it or wait for it to finish first.")
+            return
+        self.client.cache.clear()
+        spools = PageSpool.clear_all()
+        messagebox.showinfo("Cache Cleared", f"Cached API responses and the pages of {spools} full-dataset "
+                            f"downloads have been deleted.")
 
 
 #######
@@ -207,77 +2952,42 @@ class DataAnalysisApp:
 # Ensure the USD payments are numbers, then remove rows with blank, 0 or more than 1,000,000
 # Also we remove top and bottom 5th percentiles. 
 # Also we cut out a portion of the investigator clinical specialty string that is not useful. 
+# The rules and their thresholds are read from cleaning_rules.json (see CleaningPipeline). 
 
 ######
 
 
-    def clean_data(self):
-        
-        if self.df is not None:
-            print("Starting data cleaning...")
-            # Remove rows with NaN in 'total_amount_of_payment_usdollars'. Needed to convert to numeric type bc
-            # something about the json-normalize function was changing how variables were typecast
-
-            self.df['total_amount_of_payment_usdollars'] = pd.to_numeric(
-                self.df['total_amount_of_payment_usdollars'], errors='coerce')
-            
-            self.df = self.df.dropna(
-                subset=['total_amount_of_payment_usdollars'])
-
-            # Remove rows where 'total_amount_of_payment_usdollars' is 0
-            self.df = self.df[self.df['total_amount_of_payment_usdollars'] != 0]
-            # Remove rows where 'total_amount_of_payment_usdollars' is above 1,000,000
-            self.df = self.df[self.df['total_amount_of_payment_usdollars'] <= 1000000]
-
-            # Remove outliers: Keep values between 5th and 95th percentiles
-            lower_percentile = self.df['total_amount_of_payment_usdollars'].quantile(
-                0.05)
-            upper_percentile = self.df['total_amount_of_payment_usdollars'].quantile(
-                0.95)
-
-            self.df = self.df[(self.df['total_amount_of_payment_usdollars'] >= lower_percentile) &
-                              (self.df['total_amount_of_payment_usdollars'] <= upper_percentile)]
-
-            
-        
-        # Check if the required column exists in the DataFrame
-            if 'principal_investigator_1_specialty_1' not in self.df.columns:
-                messagebox.showwarning("Missing Column", "'principal_investigator_1_specialty_1' column is missing!")
-                return
-            
-            # Print column names and data types for diagnostic purposes
-            # used for testing bugs as we wrote
-            # print("Column Names:", self.df.columns)
-            # print("Data Types:\n", self.df.dtypes)
-            
-            # Check first few rows to inspect the content
-            #print("Sample Data (first 5 rows):\n", self.df['principal_investigator_1_specialty_1'].head())
-    
-            # Check if there are any NaN values in the column
-            #print("NaN values in 'principal_investigator_1_specialty_1':", self.df['principal_investigator_1_specialty_1'].isna().sum())
-    
-            # Clean the 'principal_investigator_1_specialty_1' column by removing the first 25 characters (if valid)
-            if 'principal_investigator_1_specialty_1' in self.df.columns:
-                # Ensure all values are strings and slice after 25th character
-                # this is because each specialty included "Allopathic and Osteopathic Physician" on the front and thats 
-                #really bvaluable to the user
-                self.df['principal_investigator_1_specialty_1'] = self.df['principal_investigator_1_specialty_1'].apply(
-                    lambda x: str(x)[36:] if isinstance(x, str) else x
-                )
-
-        # Print the cleaned data to verify while we wrote 
-            #fyi I think i finally resolved the error with the outliers elimination...
-            #print("Cleaned Data:\n", self.df['principal_investigator_1_specialty_1'].head())
-
-            messagebox.showinfo(
-                "Data Cleaned", "Rows with NaN values and outliers have been removed.")
-        else:
-            messagebox.showwarning("No Data", "Please load data first!")
+    def clean_data(self, df, sketch=None):
+        """
+        Clean a freshly loaded df; returns (payments, InvestigatorDimension, text for the user). Runs on the ingest
+        worker thread (finish_load), so it doesn't touch self.df or any widgets.
+        """
+        print("Starting data cleaning...")
+        memory_before = int(df.memory_usage(deep=True).sum())
+        # Remove rows with NaN, 0 or above 1,000,000 in 'total_amount_of_payment_usdollars' and outliers
+        # (keep values between 5th and 95th percentiles), move the investigator attributes repeated on every
+        # payment into their own table, split the specialty into its levels and store the repeated text values
+        # as categoricals. The rules and thresholds come from the cleaning rules file (self.cleaning_pipeline).
+        # On big loads the percentiles come from the sketch the loader kept of the amounts
+        string_columns = ARROW_STRING_COLUMNS if self.arrow_strings and pyarrow is not None else ()
+        payments, investigators, stage_report = self.cleaning_pipeline.run(df, sketch, string_columns)
+        memory_report = {'before': memory_before,
+                         'after': int(payments.memory_usage(deep=True).sum() +
+                                      investigators.table.memory_usage(deep=True).sum())}
+        print(format_stage_report(stage_report))
+        print(format_memory_report(memory_report))
+
+        # Print the cleaned data to verify while we wrote
+        #fyi I think i finally resolved the error with the outliers elimination...
+        #print("Cleaned Data:\n", payments['principal_investigator_1_specialty_1'].head())
+
+        return payments, investigators, (f"Rows with NaN values and outliers have been removed.\n"
+                                         f"{format_stage_report(stage_report)}\n{format_memory_report(memory_report)}")
 
     def show_basic_stats(self):
         """Display basic stats of the data."""
         if self.df is not None:
-            stats = self.df.describe()
+            stats = self.df.drop(columns=INVESTIGATOR_KEY, errors='ignore').describe()
             print(stats)
             messagebox.showinfo("Basic Statistics", str(stats))
         else:
@@ -330,9 +3040,10 @@ class DataAnalysisApp:
 
             # Dropdown for column selection
             column_var = tk.StringVar(histogram_window)
-            column_var.set(self.df.columns[0])  # Default to the first column
+            columns = self.data_columns()
+            column_var.set(columns[0])  # Default to the first column
             column_dropdown = tk.OptionMenu(
-                histogram_window, column_var, *self.df.columns)
+                histogram_window, column_var, *columns)
             column_dropdown.pack(pady=10)
 
             # Entry for bin width
@@ -374,7 +3085,7 @@ class DataAnalysisApp:
 
                 selected_column = column_var.get()
                 # Drop NaN values for clean plotting
-                data = self.df[selected_column].dropna()
+                data = self.column_data(selected_column).dropna()
 
                 try:
                     # Attempt to convert data to numeric, coercing errors
@@ -495,9 +3206,10 @@ class DataAnalysisApp:
 
             # Dropdown for variable selection (all columns in the dataframe)
             variable_var = tk.StringVar(count_window)
-            variable_var.set(self.df.columns[0])  # Default to the first column
+            columns = self.data_columns()
+            variable_var.set(columns[0])  # Default to the first column
             variable_dropdown = tk.OptionMenu(
-                count_window, variable_var, *self.df.columns)
+                count_window, variable_var, *columns)
             variable_dropdown.pack(pady=10)
 
             # Add entry fields for minimum and maximum counts
@@ -534,20 +3246,28 @@ class DataAnalysisApp:
                 """
 
                 selected_variable = variable_var.get()
-                if selected_variable not in self.df.columns:
+                if selected_variable not in self.data_columns():
                     messagebox.showwarning("Invalid Column", f"{
                                            selected_variable} is not a valid column.")
                     return
 
-                investigator_column = 'principal_investigator_1_profile_id'
-                if investigator_column not in self.df.columns:
+                investigator_column = INVESTIGATOR_ID_COLUMN
+                if investigator_column not in self.data_columns():
                     messagebox.showwarning("Missing Data", f"Column for investigators not found: {
                                            investigator_column}.")
                     return
 
                 # Group by the selected variable and count unique investigators
-                investigator_counts = self.df.groupby(
-                    selected_variable)[investigator_column].nunique().reset_index()
+                # (observed=True: categorical columns shouldn't get bars for values no longer in the data).
+                # Investigator attributes are grouped in the investigator table, one row per investigator;
+                # payment columns get the profile IDs joined on first
+                if self.investigators is not None and selected_variable in self.investigators.table.columns:
+                    grouped = self.investigators.table.groupby(selected_variable, observed=True)
+                else:
+                    grouped = pd.DataFrame({selected_variable: self.column_data(selected_variable),
+                                            investigator_column: self.column_data(investigator_column)}
+                                           ).groupby(selected_variable, observed=True)
+                investigator_counts = grouped[investigator_column].nunique().reset_index()
                 investigator_counts.columns = [
                     selected_variable, 'Investigator Count']
 
@@ -569,6 +3289,11 @@ class DataAnalysisApp:
                         "Invalid Input", "Please enter valid numbers for minimum and maximum counts.")
                     return
 
+                # Seaborn draws a slot for every category of a categorical column, so drop the filtered-out ones
+                if isinstance(investigator_counts[selected_variable].dtype, pd.CategoricalDtype):
+                    investigator_counts[selected_variable] = \
+                        investigator_counts[selected_variable].cat.remove_unused_categories()
+
                 # Plot the result using seaborn barplot
                 plt.figure(figsize=(10, 6))
                 sns.barplot(
@@ -661,16 +3386,10 @@ class DataAnalysisApp:
                 first_name = first_name_entry.get().strip()
                 last_name = last_name_entry.get().strip()
 
-                # Apply filters dynamically based on entered values
-                filtered_df = self.df.copy()
-                if profile_id:
-                    filtered_df = filtered_df[filtered_df['principal_investigator_1_profile_id'] == profile_id]
-                if first_name:
-                    filtered_df = filtered_df[filtered_df['principal_investigator_1_first_name'].str.contains(
-                        first_name, case=False, na=False)]
-                if last_name:
-                    filtered_df = filtered_df[filtered_df['principal_investigator_1_last_name'].str.contains(
-                        last_name, case=False, na=False)]
+                # Apply filters dynamically based on entered values. Only the investigator table (one row per
+                # investigator) is searched; their payments are then looked up by key and joined with the
+                # investigator attributes for display and export
+                filtered_df = self.find_investigator_payments(profile_id, first_name, last_name)
 
                 # Check if any rows match the criteria
                 if filtered_df.empty:
@@ -703,7 +3422,7 @@ class DataAnalysisApp:
                     - A warning if the user cancels the save dialog.
                     """
 
-                    file_path = tk.filedialog.asksaveasfilename(
+                    file_path = filedialog.asksaveasfilename(
                         defaultextension=".csv",
                         filetypes=[("CSV files", "*.csv"),
                                    ("Excel files", "*.xlsx")],
@@ -761,7 +3480,7 @@ class DataAnalysisApp:
         if self.df is not None:
             column = simpledialog.askstring(
                 "Input", "Enter column name for the histogram:")
-            if column and column in self.df.columns:
+            if column and column in self.data_columns():
                 return column
             else:
                 messagebox.showwarning(
@@ -797,7 +3516,7 @@ class DataAnalysisApp:
 
             # Add a listbox to display the column names
             columns_listbox = tk.Listbox(columns_window, height=15, width=50)
-            for column in self.df.columns:
+            for column in self.data_columns():
                 columns_listbox.insert(tk.END, column)
             columns_listbox.pack(pady=10)
 
@@ -0,0 +1,194 @@
+"""
+Small measurements for the data loading side of Final_Submission.py.
+
+Run one of the sub-commands, e.g.
+
+    python bench_ingest.py page-bytes
+
+Each one prints a short before/after table to stdout.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from Final_Submission import (DEFAULT_CLEANING_STAGES, DESIRED_COLUMNS, PAGE_LIMIT, CleaningPipeline, DatastoreClient,
+                              FilterSpec, RetryPolicy, TokenBucket, coerce_pages, decode_page, filter_pages,
+                              normalize_pages, plan_load)
+from fake_datastore import FakeDatastore, synthetic_records
+
+RESEARCH_2023_URL = "https://openpaymentsdata.cms.gov/api/1/datastore/query/60f290ea-f990-5ef0-845f-68b3a91f45a1"
+
+
+def measure_page_bytes(client, api_url, limit=PAGE_LIMIT):
+    """
+    Download the first page twice, once with every field and once with only DESIRED_COLUMNS.
+
+    Returns a dict with the decoded JSON size and the on-the-wire size (Content-Length, which is the
+    compressed size when the server gzips the response) for each variant.
+    """
+    sizes = {}
+    for label, columns in (("all fields", None), ("projected", DESIRED_COLUMNS)):
+        response = client.session.get(
+            api_url, params=client.page_params(0, limit, columns), timeout=client.timeout)
+        response.raise_for_status()
+        decoded = len(response.content)
+        wire = int(response.headers.get('Content-Length', decoded))
+        sizes[label] = {'decoded': decoded, 'wire': wire, 'fields': len(response.json()['results'][0])}
+    return sizes
+
+
+def time_decoder(decoder, records, limit=PAGE_LIMIT):
+    """Decode records page by page like load_api_data does; returns (seconds, rows)."""
+    start = time.perf_counter()
+    rows = 0
+    for offset in range(0, len(records), limit):
+        rows += len(decoder(records[offset:offset + limit]))
+    return time.perf_counter() - start, rows
+
+
+def decode(args):
+    decoders = {
+        'json_normalize': lambda page: pd.json_normalize(page)[DESIRED_COLUMNS],
+        'decode_page': lambda page: decode_page(page, DESIRED_COLUMNS),
+    }
+    print(f"{'records':>10}{'decoder':>16}{'seconds':>10}{'records/s':>14}")
+    for count in args.sizes:
+        records = synthetic_records(count)
+        for name, decoder in decoders.items():
+            seconds, rows = time_decoder(decoder, records, args.limit)
+            print(f"{rows:>10,}{name:>16}{seconds:>10.2f}{rows / seconds:>14,.0f}")
+
+
+def time_fake_load(server, workers, page_limit, filters=None):
+    """
+    Load every row of a FakeDatastore through the app's streaming stages; returns (seconds, rows kept, retries).
+
+    Mirrors ingest_api_data: count query, planned pages, then fetch -> normalize -> coerce -> filter.
+    """
+    client = DatastoreClient(pool_size=workers, retry_policy=RetryPolicy(base_delay=0.05, max_delay=0.5),
+                             rate_limiter=TokenBucket(rate=1000))
+    spec = {'program_year': 2023, 'payment_type': 'research', 'url': server.url}
+    pushed, local = filters.split(spec, client.fetch_field_types(server.url)) if filters else ([], [])
+    start = time.perf_counter()
+    total = client.fetch_count(server.url, pushed)
+    pages = client.fetch_pages(server.url, plan_load(total, page_limit, workers), workers,
+                               columns=DESIRED_COLUMNS, conditions=pushed)
+    rows = sum(len(page) for _, page in filter_pages(coerce_pages(normalize_pages(pages, spec)), filters, local))
+    seconds = time.perf_counter() - start
+    client.close()
+    return seconds, rows, client.retries
+
+
+def fake_load(args):
+    filters = FilterSpec.for_selection(state=args.state) if args.state else None
+    print(f"{'workers':>8}{'page':>7}{'seconds':>10}{'rows kept':>11}{'rows sent':>11}{'retries':>9}{'records/s':>12}")
+    for workers in args.workers:
+        with FakeDatastore(count=args.records, latency=args.latency, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, retry_after=0,
+                           field_types={'total_amount_of_payment_usdollars': 'numeric'}) as server:
+            seconds, rows, retries = time_fake_load(server, workers, args.limit, filters)
+            print(f"{workers:>8}{args.limit:>7}{seconds:>10.2f}{rows:>11,}{server.rows_sent:>11,}{retries:>9}"
+                  f"{args.records / seconds:>12,.0f}")
+
+
+def chained_clean(frame):
+    """The cleaning clean_data used to do: one filtered copy per rule, then the specialty lambda on every row."""
+    frame = frame.copy()
+    frame['total_amount_of_payment_usdollars'] = pd.to_numeric(
+        frame['total_amount_of_payment_usdollars'], errors='coerce')
+    frame = frame.dropna(subset=['total_amount_of_payment_usdollars'])
+    frame = frame[frame['total_amount_of_payment_usdollars'] != 0]
+    frame = frame[frame['total_amount_of_payment_usdollars'] <= 1000000]
+    lower, upper = frame['total_amount_of_payment_usdollars'].quantile([0.05, 0.95])
+    frame = frame[(frame['total_amount_of_payment_usdollars'] >= lower) &
+                  (frame['total_amount_of_payment_usdollars'] <= upper)]
+    frame['principal_investigator_1_specialty_1'] = frame['principal_investigator_1_specialty_1'].apply(
+        lambda x: str(x)[36:] if isinstance(x, str) else x)
+    return frame
+
+
+def fused_clean(frame):
+    """What clean_data does now, up to optimize_dtypes: the default cleaning pipeline without its last stage."""
+    payments, _, _ = CleaningPipeline(DEFAULT_CLEANING_STAGES[:-1]).run(frame)
+    return payments
+
+
+def time_clean(cleaner, frame):
+    """
+    Run cleaner on frame; returns (seconds, peak bytes allocated on top of frame, rows kept). The peak comes from
+    a second run under tracemalloc, which would slow down the timed one.
+    """
+    start = time.perf_counter()
+    rows = len(cleaner(frame))
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    cleaner(frame)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, rows
+
+
+def clean(args):
+    cleaners = {'chained': chained_clean, 'fused mask': fused_clean}
+    # Decoding millions of synthetic records takes a while, so larger frames repeat the first 100,000 rows.
+    # The amount is made numeric first, as coerce_pages does during an API load
+    sample = decode_page(synthetic_records(min(max(args.sizes), 100000), investigators=args.investigators))
+    sample['total_amount_of_payment_usdollars'] = pd.to_numeric(sample['total_amount_of_payment_usdollars'])
+    print(f"{'records':>10}{'cleaning':>12}{'seconds':>10}{'peak MB':>10}{'rows kept':>11}")
+    for count in args.sizes:
+        frame = sample.iloc[np.arange(count) % len(sample)].reset_index(drop=True)
+        for name, cleaner in cleaners.items():
+            seconds, peak, rows = time_clean(cleaner, frame)
+            print(f"{count:>10,}{name:>12}{seconds:>10.2f}{peak / 1e6:>10.1f}{rows:>11,}")
+
+
+def page_bytes(args):
+    client = DatastoreClient()
+    sizes = measure_page_bytes(client, args.url, args.limit)
+    print(f"{'':12}{'fields':>8}{'decoded bytes':>16}{'wire bytes':>14}")
+    for label, size in sizes.items():
+        print(f"{label:12}{size['fields']:>8}{size['decoded']:>16,}{size['wire']:>14,}")
+    saved = 1 - sizes['projected']['decoded'] / sizes['all fields']['decoded']
+    print(f"Projection saves {saved:.0%} of the decoded bytes per {args.limit}-row page.")
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    bytes_parser = subparsers.add_parser('page-bytes', help="bytes per page with and without column projection")
+    bytes_parser.add_argument('--url', default=RESEARCH_2023_URL)
+    bytes_parser.add_argument('--limit', type=int, default=PAGE_LIMIT)
+    bytes_parser.set_defaults(func=page_bytes)
+
+    decode_parser = subparsers.add_parser('decode', help="json_normalize vs decode_page on synthetic pages")
+    decode_parser.add_argument('--sizes', type=int, nargs='+', default=[30000, 1000000])
+    decode_parser.add_argument('--limit', type=int, default=PAGE_LIMIT)
+    decode_parser.set_defaults(func=decode)
+
+    load_parser = subparsers.add_parser('fake-load', help="whole-dataset load from a local fake datastore")
+    load_parser.add_argument('--records', type=int, default=30000)
+    load_parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    load_parser.add_argument('--limit', type=int, default=PAGE_LIMIT)
+    load_parser.add_argument('--latency', type=float, default=0.05, help="seconds the server waits per request")
+    load_parser.add_argument('--error-rate', type=float, default=0.0)
+    load_parser.add_argument('--throttle-rate', type=float, default=0.0)
+    load_parser.add_argument('--state', help="only load this investigator state (pushed down as a condition)")
+    load_parser.set_defaults(func=fake_load)
+
+    clean_parser = subparsers.add_parser('clean', help="chained filter copies vs the cleaning pipeline's single mask")
+    clean_parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 2000000])
+    clean_parser.add_argument('--investigators', type=int, default=5000)
+    clean_parser.set_defaults(func=clean)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""
+A local stand-in for the CMS Open Payments datastore, for offline tests and benchmarks.
+
+It serves synthetic research payment records with the real field names over the same query API the app uses:
+limit / offset paging, properties[i] projections, conditions[i][...] filters and the count / results / schema
+flags, plus the metastore dataset list. Latency, server errors and 429 "slow down" answers can be injected.
+
+Run it on its own and point the app (or bench_ingest.py) at the printed URL:
+
+    python fake_datastore.py --records 100000 --latency 0.05 --error-rate 0.01
+
+or start it from a test:
+
+    with FakeDatastore(records=synthetic_records(5000)) as server:
+        client.fetch_page(server.url, 0, 500)
+"""
+
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from Final_Submission import DESIRED_COLUMNS, MAX_PAGE_LIMIT
+
+# Identifier the fake research dataset is published under
+DATASET_ID = "fake-research-2023"
+DATASET_TITLE = "2023 Research Payment Data"
+
+STATES = ['CA', 'NY', 'TX', 'MA', 'PA', 'FL', 'OH', 'IL', 'NC', 'MI', 'WA', 'GA', 'NJ', 'MD', 'MN']
+FORMS = ["Cash or cash equivalent", "In-kind items and services"]
+PRIMARY_TYPES = ["Medical Doctor", "Doctor of Osteopathy", "Nurse Practitioner", "Physician Assistant"]
+SPECIALTIES = [
+    "Allopathic & Osteopathic Physicians|Internal Medicine|Cardiovascular Disease",
+    "Allopathic & Osteopathic Physicians|Internal Medicine|Medical Oncology",
+    "Allopathic & Osteopathic Physicians|Internal Medicine|Hematology & Oncology",
+    "Allopathic & Osteopathic Physicians|Psychiatry & Neurology|Neurology",
+    "Allopathic & Osteopathic Physicians|Dermatology",
+    "Allopathic & Osteopathic Physicians|Pediatrics",
+    "Allopathic & Osteopathic Physicians|Surgery|Surgical Oncology",
+    "Allopathic & Osteopathic Physicians|Ophthalmology",
+]
+MANUFACTURERS = [
+    "Pfizer Inc.", "Merck Sharp & Dohme LLC", "Genentech, Inc.", "AbbVie Inc.", "Novartis Pharmaceuticals Corporation",
+    "Bristol-Myers Squibb Company", "Eli Lilly and Company", "AstraZeneca Pharmaceuticals LP", "Amgen Inc.",
+    "Medtronic USA, Inc.",
+]
+PRODUCTS = ["KEYTRUDA", "OPDIVO", "HUMIRA", "ENTRESTO", "DUPIXENT", "TAGRISSO", "VERZENIO", "PROLIA"]
+AREAS = ["Oncology", "Cardiology", "Immunology", "Neurology", "Dermatology"]
+FIRST_NAMES = ["JOHN", "MARY", "DAVID", "SARAH", "MICHAEL", "LINDA", "JAMES", "KAREN", "ROBERT", "SUSAN"]
+LAST_NAMES = ["SMITH", "JOHNSON", "WILLIAMS", "BROWN", "JONES", "GARCIA", "MILLER", "DAVIS", "WILSON", "MOORE"]
+
+# A few of the other fields a real record carries, so projections have something to leave out
+EXTRA_FIELDS = [
+    'change_type', 'covered_recipient_type', 'noncovered_recipient_entity_name', 'teaching_hospital_ccn',
+    'principal_investigator_1_middle_name', 'principal_investigator_1_business_street_address_line1',
+    'principal_investigator_1_city', 'principal_investigator_1_zip_code', 'principal_investigator_1_country',
+    'date_of_payment', 'payment_publication_date', 'dispute_status_for_publication', 'expenditure_category1',
+    'preclinical_research_indicator', 'delay_in_publication_indicator', 'name_of_study', 'program_year',
+]
+
+
+def synthetic_records(count, seed=0, investigators=None):
+    """
+    Research payment records with the datastore's field names, every value as text like the real API.
+
+    Amounts follow a log-normal spread with a few $0 and over-$1,000,000 rows mixed in, and each investigator
+    (there are count // 10 of them unless given) always has the same name, state and specialty.
+    """
+    rng = random.Random(seed)
+    investigators = investigators or max(1, count // 10)
+    records = []
+    for index in range(count):
+        investigator = rng.randrange(investigators)
+        person = random.Random(investigator)
+        roll = rng.random()
+        if roll < 0.01:
+            amount = "0"
+        elif roll < 0.015:
+            amount = f"{rng.uniform(1000001, 5000000):.2f}"
+        else:
+            amount = f"{rng.lognormvariate(7, 2):.2f}"
+        record = {
+            'record_id': str(1000000 + index),
+            'total_amount_of_payment_usdollars': amount,
+            'principal_investigator_1_state': person.choice(STATES),
+            'form_of_payment_or_transfer_of_value': rng.choice(FORMS),
+            'name_of_drug_or_biological_or_device_or_medical_supply_1': rng.choice(PRODUCTS),
+            'product_category_or_therapeutic_area_1': rng.choice(AREAS),
+            'principal_investigator_1_primary_type_1': person.choice(PRIMARY_TYPES),
+            'principal_investigator_1_specialty_1': person.choice(SPECIALTIES),
+            'submitting_applicable_manufacturer_or_applicable_gpo_name': rng.choice(MANUFACTURERS),
+            'principal_investigator_1_profile_id': str(100000 + investigator),
+            'principal_investigator_1_first_name': person.choice(FIRST_NAMES),
+            'principal_investigator_1_last_name': person.choice(LAST_NAMES),
+            'clinicaltrials_gov_identifier': f"NCT{rng.randrange(10000000, 99999999)}",
+        }
+        for field in EXTRA_FIELDS:
+            record[field] = f"{field[:10]}_{rng.randrange(1000)}"
+        record['change_type'] = "UNCHANGED"
+        record['program_year'] = "2023"
+        records.append(record)
+    return records
+
+
+def parse_query(query):
+    """
+    Turn the query string into (params, properties, conditions).
+
+    properties is the list from properties[i]; conditions is a list of {'property', 'operator', 'value'} dicts
+    from conditions[i][...], where a value given as value[j] becomes a list.
+    """
+    params, properties, conditions = {}, {}, {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key.startswith('properties['):
+            properties[int(key[len('properties['):-1])] = value
+        elif key.startswith('conditions['):
+            parts = key[len('conditions['):-1].split('][')
+            condition = conditions.setdefault(int(parts[0]), {'operator': '='})
+            if parts[1] == 'value' and len(parts) > 2:
+                condition.setdefault('values', {})[int(parts[2])] = value
+            else:
+                condition[parts[1]] = value
+        else:
+            params[key] = value
+    for condition in conditions.values():
+        if 'values' in condition:
+            condition['value'] = [value for _, value in sorted(condition.pop('values').items())]
+    return (params, [column for _, column in sorted(properties.items())],
+            [condition for _, condition in sorted(conditions.items())])
+
+
+def compare_value(value, field_type):
+    """Value as the server would compare it: a float for numeric fields, otherwise the text itself."""
+    if field_type == 'numeric':
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    return value
+
+
+def record_matches(record, condition, field_types):
+    """SQL-like evaluation of one condition against one record. Text fields compare as text, like the real thing."""
+    field_type = field_types.get(condition['property'], 'text')
+    cell = record.get(condition['property'])
+    if cell is None or cell == '':
+        return False
+    cell = compare_value(cell, field_type)
+    if cell is None:
+        return False
+    operator = condition['operator'].lower()
+    raw = condition['value']
+    if operator in ('in', 'not in', 'between'):
+        values = [compare_value(item, field_type) for item in (raw if isinstance(raw, list) else [raw])]
+        if operator == 'in':
+            return cell in values
+        if operator == 'not in':
+            return cell not in values
+        return values[0] <= cell <= values[1]
+    if operator == 'like':
+        parts = str(raw).lower().split('%')
+        text = str(cell).lower()
+        if not text.startswith(parts[0]) or not text.endswith(parts[-1]):
+            return False
+        position = len(parts[0])
+        for part in parts[1:-1]:
+            position = text.find(part, position)
+            if position < 0:
+                return False
+            position += len(part)
+        return position <= len(text) - len(parts[-1])
+    value = compare_value(raw, field_type)
+    if value is None:
+        return False
+    if operator == '=':
+        return cell == value
+    if operator == '<>':
+        return cell != value
+    if operator == '<':
+        return cell < value
+    if operator == '<=':
+        return cell <= value
+    if operator == '>':
+        return cell > value
+    if operator == '>=':
+        return cell >= value
+    raise ValueError(f"Unknown operator {condition['operator']}")
+
+
+class FakeDatastore:
+    """
+    A threaded HTTP server answering datastore query and metastore requests from an in-memory list of records.
+
+    Options:
+    - max_limit: largest page the server hands out; bigger limit values are cut down to it, like the real cap.
+    - latency: seconds every request waits before it is answered (plus up to jitter seconds at random).
+    - error_rate / throttle_rate: share of query requests answered with a 500 / a 429 with Retry-After.
+    - field_types: {field: 'text' | 'numeric'}; every field is text unless listed, as on the real datastore.
+
+    Counters of requests served, errors and 429s injected and rows sent are kept on the object.
+    """
+
+    def __init__(self, records=None, count=10000, seed=0, max_limit=MAX_PAGE_LIMIT, latency=0.0, jitter=0.0,
+                 error_rate=0.0, throttle_rate=0.0, retry_after=1, field_types=None, host='127.0.0.1', port=0):
+        self.records = records if records is not None else synthetic_records(count, seed)
+        self.max_limit = max_limit
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.field_types = dict(field_types or {})
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.rows_sent = 0
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def url(self):
+        """Query URL of the fake dataset, the counterpart of the app's API URLs."""
+        return f"{self.base_url}/api/1/datastore/query/{DATASET_ID}/0"
+
+    @property
+    def metastore_url(self):
+        return f"{self.base_url}/api/1/metastore/schemas/dataset/items"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def roll(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def query(self, query):
+        """The JSON body for one datastore query, as the real endpoint would build it."""
+        params, properties, conditions = parse_query(query)
+        for condition in conditions:
+            if 'property' not in condition or 'value' not in condition:
+                raise ValueError("Every condition needs a property and a value.")
+        limit = min(int(params.get('limit', 500)), self.max_limit)
+        offset = int(params.get('offset', 0))
+
+        matching = self.records
+        if conditions:
+            matching = [record for record in matching
+                        if all(record_matches(record, condition, self.field_types) for condition in conditions)]
+
+        body = {}
+        if params.get('results', 'true') != 'false':
+            page = matching[offset:offset + limit]
+            if properties:
+                page = [{column: record.get(column) for column in properties} for record in page]
+            body['results'] = page
+            with self.lock:
+                self.rows_sent += len(page)
+        if params.get('count', 'true') != 'false':
+            body['count'] = len(matching)
+        if params.get('schema', 'true') != 'false':
+            fields = self.records[0].keys() if self.records else DESIRED_COLUMNS
+            body['schema'] = {DATASET_ID: {'fields': {
+                field: {'type': self.field_types.get(field, 'text')} for field in fields}}}
+        body['query'] = {'limit': limit, 'offset': offset, 'properties': properties, 'conditions': conditions}
+        return body
+
+    def handler_class(self):
+        datastore = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open between requests, like the real server, so pooled sessions reuse them
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                # Keep test and benchmark output quiet
+                pass
+
+            def send_json(self, status, body, headers=None):
+                payload = json.dumps(body).encode('utf-8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    payload = gzip.compress(payload, compresslevel=1)
+                    headers = {**(headers or {}), 'Content-Encoding': 'gzip'}
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                with datastore.lock:
+                    datastore.requests += 1
+                delay = datastore.latency + (datastore.random.uniform(0, datastore.jitter) if datastore.jitter else 0)
+                if delay:
+                    time.sleep(delay)
+
+                parts = urlsplit(self.path)
+                if parts.path.rstrip('/') == '/api/1/metastore/schemas/dataset/items':
+                    self.send_json(200, [{'title': DATASET_TITLE, 'identifier': DATASET_ID}])
+                    return
+                if not parts.path.startswith(f'/api/1/datastore/query/{DATASET_ID}'):
+                    self.send_json(404, {'message': f"No dataset at {parts.path}"})
+                    return
+
+                if datastore.roll(datastore.throttle_rate):
+                    with datastore.lock:
+                        datastore.throttled += 1
+                    self.send_json(429, {'message': "Too many requests"}, {'Retry-After': str(datastore.retry_after)})
+                    return
+                if datastore.roll(datastore.error_rate):
+                    with datastore.lock:
+                        datastore.errors += 1
+                    self.send_json(500, {'message': "Injected server error"})
+                    return
+
+                try:
+                    body = datastore.query(parts.query)
+                except ValueError as e:
+                    self.send_json(400, {'message': str(e)})
+                    return
+                self.send_json(200, body)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000, help="number of synthetic records to serve")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-limit', type=int, default=MAX_PAGE_LIMIT, help="largest page the server hands out")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument('--numeric-amounts', action='store_true',
+                        help="report the payment amount as a numeric field, so numeric conditions can be pushed down")
+    args = parser.parse_args()
+
+    field_types = {'total_amount_of_payment_usdollars': 'numeric'} if args.numeric_amounts else None
+    server = FakeDatastore(count=args.records, seed=args.seed, max_limit=args.max_limit, latency=args.latency,
+                           jitter=args.jitter, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                           field_types=field_types, port=args.port)
+    print(f"Serving {len(server.records):,} records at {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1243 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import time
+import threading
+import tempfile
+import itertools
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+import requests
+
+import Final_Submission as app_module
+from fake_datastore import FakeDatastore, synthetic_records
+
+
+def fake_response(results, status_code=200):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = {'results': results}
+    response.text = ''
+    return response
+
+
+def paged_get(total_rows, delay_for=None):
+    """Build a stand-in for Session.get that serves total_rows numbered records."""
+    def get(url, params=None, **kwargs):
+        offset, limit = params['offset'], params['limit']
+        if delay_for:
+            time.sleep(delay_for(offset))
+        rows = [{'row': i} for i in range(offset, min(offset + limit, total_rows))]
+        return fake_response(rows)
+    return get
+
+
+def headless_app():
+    # The worker side of a load never touches Tk, so it can run without a window
+    app = app_module.DataAnalysisApp.__new__(app_module.DataAnalysisApp)
+    app.client = app_module.DatastoreClient()
+    app.fetch_workers = 4
+    app.arrow_strings = False
+    # Skip the page size probe so pages stay at 500 rows
+    app.page_sizers = {'http://x': app_module.AdaptivePageSizer()}
+    app.field_types = {}
+    app.cleaning_pipeline = app_module.CleaningPipeline()
+    # Not the ingest thread, so posted loads stay uncleaned and tests see what the loader produced
+    app.ingest_thread = None
+    app.datasets = {'test': {'program_year': 2023, 'payment_type': 'research', 'url': 'http://x'}}
+    app.ingest_queue = app_module.queue.Queue()
+    return app
+
+
+def drain(app):
+    messages = []
+    while not app.ingest_queue.empty():
+        messages.append(app.ingest_queue.get())
+    return messages
+
+
+class TestFetchPages(unittest.TestCase):
+    @patch('requests.Session.get')
+    def test_pages_come_back_in_offset_order(self, mock_get):
+        # Early pages are the slowest, so they finish last
+        mock_get.side_effect = paged_get(2300, delay_for=lambda offset: 0.02 if offset < 1000 else 0)
+        pages = list(app_module.DatastoreClient().fetch_pages('http://x', app_module.plan_load(5000, 500),
+                                                              max_workers=4))
+
+        self.assertEqual([offset for offset, _ in pages], [0, 500, 1000, 1500, 2000])
+        rows = [record['row'] for _, results in pages for record in results]
+        self.assertEqual(rows, list(range(2300)))
+
+    @patch('requests.Session.get')
+    def test_parallel_matches_sequential(self, mock_get):
+        mock_get.side_effect = paged_get(1750)
+        partitions = app_module.plan_load(3000, 500, 1)
+        sequential = list(app_module.DatastoreClient().fetch_pages('http://x', partitions, max_workers=1))
+        parallel = list(app_module.DatastoreClient().fetch_pages('http://x', partitions, max_workers=6))
+        self.assertEqual(sequential, parallel)
+
+    def test_page_params_projection(self):
+        params = app_module.DatastoreClient.page_params(500, 500, ['a', 'b'])
+        self.assertEqual(params['properties[0]'], 'a')
+        self.assertEqual(params['properties[1]'], 'b')
+        self.assertEqual(params['offset'], 500)
+        self.assertNotIn('properties[0]', app_module.DatastoreClient.page_params(0, 500))
+
+    def test_client_pools_and_compresses(self):
+        client = app_module.DatastoreClient(pool_size=6)
+        self.assertIn('gzip', client.session.headers['Accept-Encoding'])
+        self.assertEqual(client.session.get_adapter('https://openpaymentsdata.cms.gov')._pool_maxsize, 6)
+        client.close()
+
+    @patch('requests.Session.get')
+    def test_error_page_raises(self, mock_get):
+        def get(url, params=None, **kwargs):
+            if params['offset'] == 500:
+                return fake_response([], status_code=500)
+            return fake_response([{'row': params['offset']}])
+        mock_get.side_effect = get
+
+        pages = app_module.DatastoreClient().fetch_pages('http://x', app_module.plan_load(2000, 500, 1), max_workers=3)
+        self.assertEqual(next(pages)[0], 0)
+        with self.assertRaises(app_module.DatastoreError):
+            next(pages)
+
+
+class TestLoadPlanning(unittest.TestCase):
+    def test_plan_is_even_and_covers_every_row(self):
+        plan = app_module.plan_load(2300, page_limit=500, workers=4)
+        self.assertEqual(plan, [(0, 460), (460, 460), (920, 460), (1380, 460), (1840, 460)])
+        # Small loads are still spread over the workers, but not into tiny pages
+        self.assertEqual(len(app_module.plan_load(800, page_limit=500, workers=8)), 8)
+        self.assertEqual(len(app_module.plan_load(250, page_limit=500, workers=8)), 3)
+        plan = app_module.plan_load(100000, page_limit=500, workers=8, max_records=30000)
+        self.assertEqual(sum(limit for _, limit in plan), 30000)
+        self.assertEqual(app_module.plan_load(0, 500, 8), [])
+
+    @patch('requests.Session.get')
+    def test_count_query(self, mock_get):
+        response = fake_response([])
+        response.json.return_value = {'count': '1234'}
+        mock_get.return_value = response
+        self.assertEqual(app_module.DatastoreClient().fetch_count('http://x'), 1234)
+        params = mock_get.call_args.kwargs['params']
+        self.assertEqual((params['count'], params['results']), ('true', 'false'))
+
+    @patch('requests.Session.get')
+    def test_counted_load_fills_buffers_in_planned_pages(self, mock_get):
+        requested = []
+
+        def get(url, params=None, **kwargs):
+            if params.get('results') == 'false':
+                response = fake_response([])
+                response.json.return_value = {'count': 1200}
+                return response
+            requested.append((params['offset'], params['limit']))
+            offset = params['offset']
+            rows = [{column: str(row) for column in app_module.DESIRED_COLUMNS}
+                    for row in range(offset, min(offset + params['limit'], 1200))]
+            return fake_response(rows)
+        mock_get.side_effect = get
+
+        app = headless_app()
+        metrics = app_module.IngestMetrics()
+        app.ingest_api_data('test', False, metrics, threading.Event())
+
+        self.assertEqual(sorted(requested), app_module.plan_load(1200, 500, app.fetch_workers, app_module.MAX_RECORDS))
+        self.assertEqual(metrics.expected_rows, 1200)
+        kind, df, *_ = drain(app)[-1]
+        self.assertEqual(kind, 'loaded')
+        # Row 0 is a $0 payment, dropped as its page streams in
+        self.assertEqual(df['principal_investigator_1_state'].tolist(), [str(row) for row in range(1, 1200)])
+
+    def test_spool_plans_up_to_the_counted_total(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = app_module.PageSpool(directory)
+            spool.start('http://x', ['a'])
+            spool.set_total(1100)
+            spool.write(0, pd.DataFrame({'a': ['x'] * 500}))
+            partitions = list(itertools.islice(spool.missing_partitions(500), 3))
+            # One extra page past the total checks for rows added since the count
+            self.assertEqual(partitions, [(500, 500), (1000, 100), (1100, 500)])
+
+
+class TestAdaptivePageSizer(unittest.TestCase):
+    @patch('requests.Session.get')
+    def test_probe_stops_at_server_cap(self, mock_get):
+        # A server that never returns more than 1,500 rows per page
+        mock_get.side_effect = lambda url, params=None, **kwargs: fake_response(
+            [{'row': i} for i in range(min(params['limit'], 1500))])
+        sizer = app_module.AdaptivePageSizer(initial=500)
+        self.assertEqual(sizer.probe(app_module.DatastoreClient(), 'http://x'), 1500)
+
+    @patch('requests.Session.get')
+    def test_failed_page_is_split_without_gaps(self, mock_get):
+        def get(url, params=None, **kwargs):
+            if params['limit'] > 250:
+                return fake_response([], status_code=504)
+            return fake_response([{'row': i} for i in range(params['offset'], params['offset'] + params['limit'])])
+        mock_get.side_effect = get
+
+        sizer = app_module.AdaptivePageSizer(initial=1000, minimum=100)
+        results = app_module.DatastoreClient().fetch_partition('http://x', 0, 1000, sizer=sizer)
+        self.assertEqual([record['row'] for record in results], list(range(1000)))
+        self.assertEqual(sizer.current(), 250)
+
+    def test_slow_pages_shrink_and_fast_pages_grow_to_ceiling(self):
+        sizer = app_module.AdaptivePageSizer(initial=2000, target_seconds=1.0)
+        sizer.record_success(2000, seconds=5.0, nbytes=1000)
+        self.assertEqual(sizer.current(), 1000)
+        sizer.record_success(1000, seconds=0.1, nbytes=1000)
+        sizer.record_success(2000, seconds=0.1, nbytes=1000)
+        self.assertEqual(sizer.current(), 2000)
+
+    def test_ceiling_recovers_after_quick_pages(self):
+        sizer = app_module.AdaptivePageSizer(initial=1000, minimum=100, target_seconds=1.0)
+        sizer.record_success(1000, seconds=0.1, nbytes=1000)
+        sizer.record_failure(1000)
+        sizer.record_failure(500)
+        self.assertEqual((sizer.ceiling, sizer.current()), (250, 250))
+
+        for _ in range(app_module.CEILING_RECOVERY_PAGES - 1):
+            sizer.record_success(250, seconds=0.1, nbytes=1000)
+        self.assertEqual(sizer.current(), 250)
+        sizer.record_success(250, seconds=0.1, nbytes=1000)
+        self.assertEqual((sizer.ceiling, sizer.current()), (500, 500))
+
+        # ...and back to 1,000 rows, the largest page seen full, but no further
+        for _ in range(3 * app_module.CEILING_RECOVERY_PAGES):
+            sizer.record_success(sizer.current(), seconds=0.1, nbytes=1000)
+        self.assertEqual(sizer.current(), 1000)
+
+    def test_capped_pages_are_joined_up_during_a_download(self):
+        with FakeDatastore(count=60000, max_limit=1500) as server:
+            sizer = app_module.AdaptivePageSizer(initial=1000)
+            sizer.record_success(1000, seconds=0.1, nbytes=1000)
+            sizer.full_size = 4000  # as if the server had sent bigger pages before it started capping
+            client = app_module.DatastoreClient()
+            partitions = app_module.page_partitions(0, None, sizer.current)
+            rows = [record['record_id'] for _, results in client.fetch_pages(
+                server.url, partitions, max_workers=4, sizer=sizer, columns=['record_id']) for record in results]
+            client.close()
+
+        self.assertEqual(len(rows), 60000)
+        self.assertEqual(len(set(rows)), 60000)
+        self.assertEqual(sizer.server_cap, 1500)
+        self.assertLessEqual(sizer.current(), 1500)
+
+    @patch('requests.Session.get')
+    def test_ceiling_never_passes_the_server_cap(self, mock_get):
+        mock_get.side_effect = lambda url, params=None, **kwargs: fake_response(
+            [{'row': i} for i in range(min(params['limit'], 1500))])
+        sizer = app_module.AdaptivePageSizer(initial=500)
+        sizer.probe(app_module.DatastoreClient(), 'http://x')
+        for _ in range(3 * app_module.CEILING_RECOVERY_PAGES):
+            sizer.record_success(1500, seconds=0.1, nbytes=1000)
+        self.assertEqual(sizer.current(), 1500)
+
+    def test_partitions_follow_the_current_size(self):
+        sizes = iter([500, 1000, 1000])
+        self.assertEqual(list(app_module.page_partitions(0, 2000, lambda: next(sizes))),
+                         [(0, 500), (500, 1000), (1500, 500)])
+
+
+class TestRetries(unittest.TestCase):
+    def status_response(self, status_code, retry_after=None):
+        response = fake_response([{'row': 1}], status_code=status_code)
+        response.headers = {'Retry-After': retry_after} if retry_after else {}
+        response.content = b'{"results": [{"row": 1}]}'
+        return response
+
+    @patch('time.sleep')
+    @patch('requests.Session.get')
+    def test_transient_errors_are_retried_and_counted(self, mock_get, mock_sleep):
+        mock_get.side_effect = [
+            self.status_response(503),
+            requests.exceptions.ConnectionError("reset"),
+            self.status_response(429, retry_after='7'),
+            self.status_response(200),
+        ]
+        client = app_module.DatastoreClient(retry_policy=app_module.RetryPolicy(base_delay=0.1))
+        metrics = app_module.IngestMetrics(client=client)
+
+        self.assertEqual(client.fetch_page('http://x', 0, 500), [{'row': 1}])
+        self.assertEqual(metrics.snapshot()['retries'], 3)
+        # The 429's Retry-After is honoured
+        self.assertIn(7.0, [call.args[0] for call in mock_sleep.call_args_list])
+
+    @patch('time.sleep')
+    @patch('requests.Session.get')
+    def test_gives_up_after_max_attempts(self, mock_get, mock_sleep):
+        mock_get.return_value = self.status_response(500)
+        client = app_module.DatastoreClient(retry_policy=app_module.RetryPolicy(max_attempts=3))
+        with self.assertRaises(app_module.DatastoreError):
+            client.fetch_page('http://x', 0, 500)
+        self.assertEqual(mock_get.call_count, 3)
+
+    @patch('time.sleep')
+    @patch('requests.Session.get')
+    def test_splittable_pages_split_before_retrying(self, mock_get, mock_sleep):
+        def get(url, params=None, **kwargs):
+            if params['limit'] > 250:
+                return self.status_response(504)
+            if params['offset'] == 0 and not mock_sleep.called:
+                return self.status_response(429)
+            return fake_response([{'row': i} for i in range(params['offset'], params['offset'] + params['limit'])])
+        mock_get.side_effect = get
+
+        client = app_module.DatastoreClient(retry_policy=app_module.RetryPolicy())
+        sizer = app_module.AdaptivePageSizer(initial=1000, minimum=250)
+        results = client.fetch_partition('http://x', 0, 1000, sizer=sizer)
+        self.assertEqual([record['row'] for record in results], list(range(1000)))
+        # 1000 and both 500s fail once each; the 429 on the first 250 is still retried
+        self.assertEqual(mock_get.call_count, 3 + 1 + 4)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_client_errors_are_not_retried(self, mock_get):
+        mock_get.return_value = self.status_response(404)
+        client = app_module.DatastoreClient(retry_policy=app_module.RetryPolicy())
+        with self.assertRaises(app_module.DatastoreError):
+            client.fetch_page('http://x', 0, 500)
+        self.assertEqual(mock_get.call_count, 1)
+
+    def test_backoff_grows_and_is_capped(self):
+        policy = app_module.RetryPolicy(base_delay=1, max_delay=5)
+        for attempt in range(6):
+            self.assertLessEqual(policy.delay(attempt), min(5, 2 ** attempt))
+        self.assertEqual(policy.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+
+    def test_token_bucket_limits_rate(self):
+        bucket = app_module.TokenBucket(rate=50, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # First token is free, the other five need 1/50 s each
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+
+class TestIncrementalRefresh(unittest.TestCase):
+    def serve(self, records):
+        """Stand-in for Session.get over a list of records, honouring projection and 'in' conditions."""
+        requested = []
+
+        def get(url, params=None, **kwargs):
+            rows = records
+            if 'conditions[0][property]' in params:
+                wanted = {value for name, value in params.items() if name.startswith('conditions[0][value]')}
+                rows = [record for record in rows if record['record_id'] in wanted]
+            rows = rows[params['offset']:params['offset'] + params['limit']]
+            columns = [value for name, value in params.items() if name.startswith('properties[')]
+            rows = [{column: record[column] for column in columns} for record in rows]
+            requested.extend(rows)
+            return fake_response(rows)
+        return get, requested
+
+    def make_records(self, count):
+        return [dict({column: f'{column}-{i}' for column in app_module.DESIRED_COLUMNS},
+                     record_id=str(i), change_type='NEW', total_amount_of_payment_usdollars=str(100 + i))
+                for i in range(count)]
+
+    @patch('requests.Session.get')
+    def test_second_sync_fetches_only_changes(self, mock_get):
+        records = self.make_records(50)
+        get, requested = self.serve(records)
+        mock_get.side_effect = get
+
+        with tempfile.TemporaryDirectory() as root:
+            client = app_module.DatastoreClient()
+            store = app_module.RecordStore.for_url('http://x', root=root)
+            sizer = app_module.AdaptivePageSizer()
+            first = app_module.sync_records(client, 'http://x', store, max_workers=2, sizer=sizer)
+            self.assertEqual((first['new'], first['fetched']), (50, 50))
+
+            # CMS republishes: one record corrected, one withdrawn, one added
+            records[3] = dict(records[3], change_type='CHANGED', total_amount_of_payment_usdollars='999')
+            del records[10]
+            records.append(dict(self.make_records(51)[50]))
+            requested.clear()
+
+            reopened = app_module.RecordStore.for_url('http://x', root=root)
+            second = app_module.sync_records(client, 'http://x', reopened, max_workers=2, sizer=sizer)
+            self.assertEqual((second['new'], second['changed'], second['deleted'], second['fetched']), (1, 1, 1, 2))
+
+            # Only two full records crossed the wire; the rest of the traffic was the 3-field key scan
+            full_rows = [row for row in requested if 'principal_investigator_1_state' in row]
+            self.assertEqual(len(full_rows), 2)
+            self.assertEqual(len(reopened.records), 50)
+            self.assertEqual(reopened.records.loc['3', 'total_amount_of_payment_usdollars'], '999')
+            self.assertNotIn('10', reopened.records.index)
+
+    @patch('requests.Session.get')
+    def test_sync_compares_the_datasets_own_amount_field(self, mock_get):
+        spec = {'payment_type': 'ownership'}
+        columns = app_module.dataset_source_columns(spec)
+        amount_column = app_module.dataset_source_columns(spec, [app_module.AMOUNT_COLUMN])[0]
+        records = [dict({column: f'{column}-{i}' for column in columns},
+                        record_id=str(i), change_type='NEW', total_amount_invested_usdollars=str(100 + i))
+                   for i in range(5)]
+        get, requested = self.serve(records)
+        mock_get.side_effect = get
+
+        with tempfile.TemporaryDirectory() as root:
+            client = app_module.DatastoreClient()
+            store = app_module.RecordStore.for_url('http://x', root=root)
+            app_module.sync_records(client, 'http://x', store, columns, max_workers=2, amount_column=amount_column)
+
+            # An investment amount corrected without touching change_type still counts as a change
+            records[2] = dict(records[2], total_amount_invested_usdollars='5000')
+            second = app_module.sync_records(client, 'http://x', store, columns, max_workers=2,
+                                             amount_column=amount_column)
+            self.assertEqual((second['new'], second['changed'], second['fetched']), (0, 1, 1))
+            self.assertEqual(store.records.loc['2', 'total_amount_invested_usdollars'], '5000')
+
+    def test_scan_follows_a_server_page_cap(self):
+        with FakeDatastore(count=5000, max_limit=500) as server, tempfile.TemporaryDirectory() as root:
+            client = app_module.DatastoreClient()
+            store = app_module.RecordStore.for_url(server.url, root=root)
+            first = app_module.sync_records(client, server.url, store, max_workers=4)
+            self.assertEqual((first['scanned'], first['new']), (5000, 5000))
+
+            # A sizer that never saw the cap asks for bigger pages; the short ones mustn't look like deletions
+            second = app_module.sync_records(client, server.url, store, max_workers=4,
+                                             sizer=app_module.AdaptivePageSizer(initial=2000))
+            client.close()
+        self.assertEqual((second['scanned'], second['deleted'], second['fetched']), (5000, 0, 0))
+        self.assertEqual(len(store.records), 5000)
+
+    @patch('requests.Session.get')
+    def test_sync_bypasses_the_response_cache(self, mock_get):
+        records = self.make_records(20)
+        get, requested = self.serve(records)
+        mock_get.side_effect = get
+
+        with tempfile.TemporaryDirectory() as root:
+            cache = app_module.ResponseCache(os.path.join(root, 'cache'))
+            client = app_module.DatastoreClient(cache=cache)
+            store = app_module.RecordStore.for_url('http://x', root=root)
+            sizer = app_module.AdaptivePageSizer()
+            app_module.sync_records(client, 'http://x', store, max_workers=2, sizer=sizer)
+
+            # Refreshing again straight away (well inside the cache TTL) still sees the new record
+            records.append(self.make_records(21)[20])
+            second = app_module.sync_records(client, 'http://x', store, max_workers=2, sizer=sizer)
+            self.assertEqual((second['new'], second['fetched']), (1, 1))
+            self.assertEqual(len(store.records), 21)
+            self.assertEqual(os.listdir(cache.directory), [])
+
+    @patch('requests.Session.get')
+    def test_first_sync_pages_instead_of_id_batches(self, mock_get):
+        records = self.make_records(1200)
+        get, requested = self.serve(records)
+        mock_get.side_effect = get
+
+        with tempfile.TemporaryDirectory() as root:
+            client = app_module.DatastoreClient()
+            store = app_module.RecordStore.for_url('http://x', root=root)
+            summary = app_module.sync_records(client, 'http://x', store, max_workers=2)
+
+            self.assertEqual((summary['new'], summary['fetched']), (1200, 1200))
+            self.assertEqual(len(store.records), 1200)
+            # 3 pages of 500 (plus the empty end page) rather than 12 batches of 100 IDs
+            batched = [call for call in mock_get.call_args_list if 'conditions[0][property]' in call.kwargs['params']]
+            self.assertEqual(batched, [])
+
+
+class TestBackgroundIngest(unittest.TestCase):
+    @patch('requests.Session.get')
+    def test_worker_posts_progress_and_frame(self, mock_get):
+        def get(url, params=None, **kwargs):
+            offset = params['offset']
+            rows = [{column: str(offset + i) for column in app_module.DESIRED_COLUMNS}
+                    for i in range(min(500, 1200 - offset) if offset < 1200 else 0)]
+            return fake_response(rows)
+        mock_get.side_effect = get
+
+        app = headless_app()
+        metrics = app_module.IngestMetrics(app_module.MAX_RECORDS)
+        app.ingest_api_data('test', False, metrics, threading.Event())
+
+        messages = drain(app)
+        self.assertEqual([kind for kind, *_ in messages], ['progress', 'progress', 'progress', 'loaded'])
+        # Every row but the $0 payment in row 0 is kept, with the amount already numeric
+        self.assertEqual(len(messages[-1][1]), 1199)
+        self.assertEqual(messages[-1][1]['total_amount_of_payment_usdollars'].dtype, 'float64')
+        self.assertEqual(metrics.snapshot()['pages'], 3)
+
+    def test_loads_are_cleaned_and_saved_on_the_worker(self):
+        app = headless_app()
+        frame = app_module.decode_page(synthetic_records(500))
+        with tempfile.TemporaryDirectory() as directory:
+            app.snapshots = app_module.SnapshotStore(directory)
+            app.cancel_event = threading.Event()
+
+            def job(metrics, cancel_event):
+                app.post('loaded', frame, "Data Loaded", "done", {'source': 'test'}, None)
+            app.ingest_thread = threading.Thread(target=app.run_ingest, args=(job, app_module.IngestMetrics()))
+            app.ingest_thread.start()
+            app.ingest_thread.join()
+            saved = app.snapshots.snapshots() if app_module.pyarrow is not None else None
+
+        (kind, payments, investigators, title, text, cleaning_text), (finished, _) = drain(app)
+        self.assertEqual((kind, finished), ('cleaned', 'finished'))
+        self.assertLess(len(payments), len(frame))
+        self.assertIn('take_rows', cleaning_text)
+        if saved is not None:
+            self.assertEqual(saved[0][1]['rows'], len(payments))
+
+    def test_poll_keeps_going_when_a_message_fails(self):
+        app = headless_app()
+        app.root = MagicMock()
+        app.hide_progress = MagicMock()
+        # An 'opened' message missing its investigators can't be unpacked
+        app.post('opened', pd.DataFrame(), "Snapshot Opened", "text")
+        app.post('finished', app_module.IngestMetrics().snapshot())
+        with patch.object(app_module.messagebox, 'showerror') as showerror:
+            app.poll_ingest_queue()
+        showerror.assert_called_once()
+        app.hide_progress.assert_called_once()
+
+        app.hide_progress.reset_mock()
+        app.post('cleaned', None)
+        with patch.object(app_module.messagebox, 'showerror'):
+            app.poll_ingest_queue()
+        app.hide_progress.assert_not_called()
+        app.root.after.assert_called_once()
+
+    @patch('requests.Session.get')
+    def test_full_load_streams_spooled_pages_back(self, mock_get):
+        def get(url, params=None, **kwargs):
+            offset = params['offset']
+            rows = [{column: str(offset + i) for column in app_module.DESIRED_COLUMNS}
+                    for i in range(min(params['limit'], 1200 - offset) if offset < 1200 else 0)]
+            return fake_response(rows)
+        mock_get.side_effect = get
+
+        app = headless_app()
+        with tempfile.TemporaryDirectory() as root, patch.object(
+                app_module.PageSpool, 'for_url', staticmethod(lambda api_url: app_module.PageSpool(root))):
+            app.ingest_api_data('test', True, app_module.IngestMetrics(), threading.Event())
+
+        kind, df, *_, sketch = drain(app)[-1]
+        self.assertEqual(kind, 'loaded')
+        self.assertEqual(len(df), 1199)
+        self.assertEqual(df['total_amount_of_payment_usdollars'].iloc[0], 1.0)
+        # The amounts were sketched as the pages were read back
+        self.assertEqual(sketch.count, 1199)
+
+    @patch('requests.Session.get')
+    def test_cancel_stops_fetching(self, mock_get):
+        cancel_event = threading.Event()
+
+        def get(url, params=None, **kwargs):
+            time.sleep(0.05)
+            return fake_response([{'row': params['offset']}])
+        mock_get.side_effect = get
+
+        pages = app_module.DatastoreClient().fetch_pages(
+            'http://x', app_module.plan_load(100000, 1), max_workers=2, cancel_event=cancel_event)
+        next(pages)
+        cancel_event.set()
+        with self.assertRaises(app_module.IngestCancelled):
+            next(pages)
+        # Only the small submission window was ever requested, not all 100,000 pages
+        self.assertLess(mock_get.call_count, 10)
+
+    def test_progress_text(self):
+        snapshot = {'rows': 12500, 'pages_per_second': 8.25, 'eta': 72.4}
+        self.assertEqual(app_module.format_progress(snapshot), '12,500 records | 8.2 pages/s | ETA 1:12')
+        snapshot['eta'] = None
+        self.assertEqual(app_module.format_progress(snapshot), '12,500 records | 8.2 pages/s')
+
+
+class TestDatasetRegistry(unittest.TestCase):
+    def test_registry_covers_years_and_payment_types(self):
+        registry = app_module.build_dataset_registry(years=(2023, 2022))
+        self.assertEqual(len(registry), 6)
+        self.assertTrue(registry["2023 Research Payments API"]['url'].endswith('60f290ea-f990-5ef0-845f-68b3a91f45a1'))
+        self.assertIsNone(registry["2022 General Payments API"]['url'])
+
+    def test_general_payments_are_renamed_to_research_columns(self):
+        spec = {'program_year': 2022, 'payment_type': 'general', 'url': None}
+        source_columns = app_module.dataset_source_columns(spec)
+        self.assertIn('covered_recipient_profile_id', source_columns)
+        self.assertNotIn('clinicaltrials_gov_identifier', source_columns)
+
+        frame = pd.DataFrame({column: ['v'] for column in source_columns})
+        canonical = app_module.to_canonical_columns(frame, spec)
+        self.assertEqual(list(canonical.columns), app_module.DESIRED_COLUMNS)
+        self.assertTrue(canonical['clinicaltrials_gov_identifier'].isna().all())
+
+    @patch('requests.Session.get')
+    def test_url_is_looked_up_in_metastore(self, mock_get):
+        response = MagicMock(status_code=200, content=b'[]')
+        response.json.return_value = [
+            {'title': '2022 General Payment Data', 'identifier': 'gen-22'},
+            {'title': '2022 Research Payment Data', 'identifier': 'rsrch-22'},
+        ]
+        mock_get.return_value = response
+        spec = {'program_year': 2022, 'payment_type': 'research', 'url': None}
+        self.assertEqual(app_module.resolve_dataset_url(app_module.DatastoreClient(), spec),
+                         'https://openpaymentsdata.cms.gov/api/1/datastore/query/rsrch-22/0')
+
+    @patch('requests.Session.get')
+    def test_multiple_datasets_load_into_one_tagged_frame(self, mock_get):
+        sizes = {'http://y2023': 700, 'http://y2022': 300}
+
+        def get(url, params=None, **kwargs):
+            offset = params['offset']
+            count = max(0, min(params['limit'], sizes[url] - offset))
+            return fake_response([{column: '1' for column in app_module.DESIRED_COLUMNS}] * count)
+        mock_get.side_effect = get
+
+        app = headless_app()
+        app.datasets = {
+            'a': {'program_year': 2023, 'payment_type': 'research', 'url': 'http://y2023'},
+            'b': {'program_year': 2022, 'payment_type': 'research', 'url': 'http://y2022'},
+        }
+        app.page_sizers = {url: app_module.AdaptivePageSizer() for url in sizes}
+        app.ingest_datasets(['a', 'b'], app_module.IngestMetrics(), threading.Event())
+
+        messages = drain(app)
+        kind, df, *_ = messages[-1]
+        self.assertEqual(kind, 'loaded')
+        self.assertEqual(df.groupby('program_year').size().to_dict(), {2022: 300, 2023: 700})
+
+
+class TestFilterPushdown(unittest.TestCase):
+    research = {'program_year': 2023, 'payment_type': 'research', 'url': 'http://x'}
+
+    def test_numeric_conditions_need_a_numeric_field(self):
+        filters = app_module.FilterSpec.for_selection(state='ca')
+        pushed, local = filters.split(self.research, {'total_amount_of_payment_usdollars': 'text'})
+        self.assertEqual(pushed, [{'property': 'principal_investigator_1_state', 'operator': '=', 'value': 'CA'}])
+        self.assertEqual(len(local), 2)
+
+        pushed, local = filters.split(self.research, {'total_amount_of_payment_usdollars': 'numeric'})
+        self.assertEqual(len(pushed), 3)
+        self.assertEqual(local, [])
+
+    def test_conditions_use_the_dataset_field_names(self):
+        filters = app_module.FilterSpec([
+            {'property': 'principal_investigator_1_state', 'operator': '=', 'value': 'NY'},
+            {'property': 'clinicaltrials_gov_identifier', 'operator': '=', 'value': 'NCT1'},
+        ])
+        pushed, local = filters.split({'program_year': 2022, 'payment_type': 'general', 'url': None})
+        self.assertEqual(pushed[0]['property'], 'recipient_state')
+        # General payments have no trial identifier, so that condition can only be checked locally
+        self.assertEqual(local[0]['property'], 'clinicaltrials_gov_identifier')
+
+    def test_local_fallback_matches_server_semantics(self):
+        frame = pd.DataFrame({
+            'total_amount_of_payment_usdollars': ['0', '12.5', '2000000', None, 'abc', '900'],
+            'principal_investigator_1_state': ['CA', 'CA', 'CA', 'CA', 'CA', 'NY'],
+            'submitting_applicable_manufacturer_or_applicable_gpo_name': ['Pfizer Inc.'] * 5 + ['PFIZER'],
+        })
+        filters = app_module.FilterSpec.for_selection(state=' ca ', manufacturer='pfizer')
+        self.assertEqual(filters.apply(frame).index.tolist(), [1])
+        like = {'property': 'submitting_applicable_manufacturer_or_applicable_gpo_name', 'operator': 'like',
+                'value': 'pfizer%'}
+        self.assertEqual(app_module.condition_mask(frame, like).sum(), 6)
+
+    @patch('requests.Session.get')
+    def test_load_sends_conditions_and_filters_the_rest_locally(self, mock_get):
+        rows = [{column: 'CA' for column in app_module.DESIRED_COLUMNS} for _ in range(300)]
+        for index, row in enumerate(rows):
+            row['total_amount_of_payment_usdollars'] = str(index)
+        requested = []
+
+        def get(url, params=None, **kwargs):
+            if params.get('schema') == 'true':
+                response = fake_response([])
+                response.json.return_value = {'schema': {'abc': {'fields': {
+                    'total_amount_of_payment_usdollars': {'type': 'text'}}}}}
+                return response
+            requested.append(params)
+            # The fake server honours the state condition only
+            state = params.get('conditions[0][value]')
+            matching = [row for row in rows if row['principal_investigator_1_state'] == state]
+            return fake_response(matching[params['offset']:params['offset'] + params['limit']])
+        mock_get.side_effect = get
+
+        app = headless_app()
+        filters = app_module.FilterSpec.for_selection(state='CA')
+        app.ingest_api_data('test', False, app_module.IngestMetrics(), threading.Event(), filters)
+
+        self.assertEqual(requested[0]['conditions[0][property]'], 'principal_investigator_1_state')
+        self.assertNotIn('conditions[1][property]', requested[0])
+        kind, df, *_ = drain(app)[-1]
+        self.assertEqual(kind, 'loaded')
+        # Row 0 has a $0 payment and is dropped by the local fallback
+        self.assertEqual(len(df), 299)
+
+
+class TestStreamingPipeline(unittest.TestCase):
+    def test_stages_filter_each_page_as_it_arrives(self):
+        spec = {'program_year': 2023, 'payment_type': 'research', 'url': 'http://x'}
+        amounts = ['10', '0', '', '2000000', 'abc', '5.5']
+        pages = [(offset, [{column: amount if column == 'total_amount_of_payment_usdollars' else 'CA'
+                            for column in app_module.DESIRED_COLUMNS} for amount in amounts])
+                 for offset in (0, 6)]
+        seen = []
+
+        def source():
+            for page in pages:
+                seen.append(page[0])
+                yield page
+
+        stream = app_module.filter_pages(app_module.coerce_pages(app_module.normalize_pages(source(), spec)))
+        offset, first = next(stream)
+        # The second page hasn't been pulled yet when the first one comes out filtered
+        self.assertEqual(seen, [0])
+        self.assertEqual(first['total_amount_of_payment_usdollars'].tolist(), [10.0, 5.5])
+
+        buffers = app_module.ColumnBuffers(app_module.DESIRED_COLUMNS, 3, app_module.LOADED_DTYPES)
+        buffers.append(first)
+        buffers.append(next(stream)[1])
+        frame = buffers.frame()
+        self.assertEqual(frame['total_amount_of_payment_usdollars'].tolist(), [10.0, 5.5, 10.0])
+        self.assertTrue(buffers.full)
+
+    def test_missing_column_stops_the_stream(self):
+        spec = {'program_year': 2023, 'payment_type': 'research', 'url': 'http://x'}
+        with self.assertRaises(app_module.MissingColumnsError):
+            next(app_module.normalize_pages(iter([(0, [{'row': 1}])]), spec))
+
+
+class TestFakeDatastore(unittest.TestCase):
+    def test_paging_projection_conditions_and_count(self):
+        records = synthetic_records(1000)
+        with FakeDatastore(records=records) as server:
+            client = app_module.DatastoreClient()
+            page = client.fetch_page(server.url, 100, 50, ['record_id', 'principal_investigator_1_state'])
+            self.assertEqual([row['record_id'] for row in page], [record['record_id'] for record in records[100:150]])
+            self.assertEqual(set(page[0]), {'record_id', 'principal_investigator_1_state'})
+
+            conditions = [{'property': 'principal_investigator_1_state', 'operator': 'in', 'value': ['CA', 'NY']}]
+            expected = sum(record['principal_investigator_1_state'] in ('CA', 'NY') for record in records)
+            self.assertEqual(client.fetch_count(server.url, conditions), expected)
+            # Amounts are text unless the server says otherwise, so the app keeps numeric filters local
+            self.assertEqual(client.fetch_field_types(server.url)['total_amount_of_payment_usdollars'], 'text')
+            client.close()
+
+    def test_load_survives_injected_errors_and_throttling(self):
+        with FakeDatastore(count=5000, error_rate=0.2, throttle_rate=0.2, retry_after=0, seed=3,
+                           field_types={'total_amount_of_payment_usdollars': 'numeric'}) as server:
+            app = headless_app()
+            app.client = app_module.DatastoreClient(retry_policy=app_module.RetryPolicy(
+                max_attempts=20, base_delay=0.001, max_delay=0.01))
+            app.datasets = {'fake': {'program_year': 2023, 'payment_type': 'research', 'url': server.url}}
+            app.page_sizers = {server.url: app_module.AdaptivePageSizer()}
+            filters = app_module.FilterSpec.for_selection(state='TX')
+            app.ingest_api_data('fake', False, app_module.IngestMetrics(), threading.Event(), filters)
+
+            kind, df, *_ = drain(app)[-1]
+            expected = [record for record in server.records if record['principal_investigator_1_state'] == 'TX'
+                        and 0 < float(record['total_amount_of_payment_usdollars']) <= 1000000]
+            self.assertEqual(kind, 'loaded')
+            self.assertEqual(len(df), len(expected))
+            self.assertGreater(server.errors + server.throttled, 0)
+            self.assertGreater(app.client.retries, 0)
+            app.client.close()
+
+
+class TestCompactDtypes(unittest.TestCase):
+    def test_repeated_text_becomes_categorical(self):
+        frame = app_module.drop_invalid_payments(app_module.decode_page(synthetic_records(2000)))
+        frame['program_year'] = 2023
+        compact, report = app_module.optimize_dtypes(frame)
+
+        self.assertEqual(compact['principal_investigator_1_state'].dtype, 'category')
+        self.assertEqual(compact['total_amount_of_payment_usdollars'].dtype, 'float32')
+        self.assertEqual(compact['program_year'].dtype, 'int16')
+        # Trial identifiers are nearly all distinct, so a categorical wouldn't save anything
+        self.assertEqual(compact['clinicaltrials_gov_identifier'].dtype, object)
+        self.assertLess(report['after'], report['before'] / 3)
+        self.assertEqual(report['changed']['principal_investigator_1_state'], ('object', 'category'))
+
+        # Same values, just stored differently
+        for column in ('principal_investigator_1_state', 'principal_investigator_1_specialty_1'):
+            self.assertEqual(compact[column].tolist(), frame[column].tolist())
+        self.assertTrue(((compact['total_amount_of_payment_usdollars'] - frame['total_amount_of_payment_usdollars'])
+                         .abs() <= frame['total_amount_of_payment_usdollars'] * 1e-7).all())
+        self.assertIn('less', app_module.format_memory_report(report))
+
+
+@unittest.skipIf(app_module.pyarrow is None, "pyarrow is not installed")
+class TestArrowStrings(unittest.TestCase):
+    def test_load_builds_arrow_columns_and_cleaning_keeps_them(self):
+        with FakeDatastore(count=3000) as server:
+            app = headless_app()
+            app.arrow_strings = True
+            app.datasets = {'fake': {'program_year': 2023, 'payment_type': 'research', 'url': server.url}}
+            app.page_sizers = {server.url: app_module.AdaptivePageSizer()}
+            app.ingest_api_data('fake', False, app_module.IngestMetrics(), threading.Event())
+            app.client.close()
+
+        kind, df, *_ = drain(app)[-1]
+        self.assertEqual(kind, 'loaded')
+        for column in app_module.ARROW_STRING_COLUMNS:
+            self.assertEqual(df[column].dtype, app_module.ARROW_STRING_DTYPE)
+
+        compact, _ = app_module.optimize_dtypes(df, string_columns=app_module.ARROW_STRING_COLUMNS)
+        self.assertEqual(compact['principal_investigator_1_last_name'].dtype, app_module.ARROW_STRING_DTYPE)
+        self.assertEqual(compact['principal_investigator_1_state'].dtype, 'category')
+        matches = compact['principal_investigator_1_last_name'].str.contains('smi', case=False, na=False)
+        expected = df['principal_investigator_1_last_name'].astype(object).str.contains('smi', case=False, na=False)
+        self.assertEqual(matches.astype(bool).tolist(), expected.astype(bool).tolist())
+
+    def test_buffers_convert_extension_dtypes(self):
+        buffers = app_module.ColumnBuffers(['name', 'total_amount_of_payment_usdollars'], 4,
+                                           app_module.loaded_dtypes(True) | {'name': app_module.ARROW_STRING_DTYPE})
+        buffers.append(pd.DataFrame({'name': ['a', None], 'total_amount_of_payment_usdollars': [1.0, 2.0]}))
+        frame = buffers.frame()
+        self.assertEqual(frame['name'].dtype, app_module.ARROW_STRING_DTYPE)
+        self.assertTrue(frame['name'].isna().iloc[1])
+        self.assertEqual(frame['total_amount_of_payment_usdollars'].dtype, 'float64')
+
+
+@unittest.skipIf(app_module.pyarrow is None, "pyarrow is not installed")
+class TestSnapshots(unittest.TestCase):
+    def test_round_trip_keeps_dtypes_and_metadata(self):
+        frame = app_module.drop_invalid_payments(app_module.decode_page(synthetic_records(2000)))
+        frame, _ = app_module.optimize_dtypes(frame, string_columns=app_module.ARROW_STRING_COLUMNS)
+        with tempfile.TemporaryDirectory() as directory:
+            store = app_module.SnapshotStore(directory)
+            path = store.save(frame, {'source': "2023 Research Payments API", 'url': 'http://x', 'rows': len(frame)})
+            self.assertTrue(path.endswith('2023_research_payments_api.arrow'))
+
+            self.assertEqual(store.read_metadata(path)['rows'], len(frame))
+            reopened, metadata = app_module.SnapshotStore.load(path)
+            pd.testing.assert_frame_equal(reopened, frame.reset_index(drop=True))
+            self.assertEqual(metadata['url'], 'http://x')
+            self.assertEqual([saved for saved, _ in store.snapshots()], [path])
+
+    def test_worker_opens_snapshot_without_recleaning(self):
+        frame = app_module.decode_page(synthetic_records(2))
+        with tempfile.TemporaryDirectory() as directory:
+            path = app_module.SnapshotStore(directory).save(frame, {'source': 'test', 'saved': 'today'})
+            app = headless_app()
+            app.ingest_snapshot(path, app_module.IngestMetrics(), threading.Event())
+        kind, payments, investigators, title, text = drain(app)[-1]
+        self.assertEqual(kind, 'opened')
+        self.assertEqual(len(payments), 2)
+        # Split on the worker, so the main thread only stores the tables
+        self.assertNotIn('principal_investigator_1_last_name', payments.columns)
+        self.assertIn('principal_investigator_1_last_name', investigators.table.columns)
+        self.assertIn('saved today', text)
+
+    def test_cleaned_tables_are_saved_apart_and_per_filter(self):
+        app = headless_app()
+        payments, investigators, _ = app.clean_data(app_module.decode_page(synthetic_records(2000, investigators=50)))
+        filters = app_module.FilterSpec.for_selection(state='CA').conditions
+        with tempfile.TemporaryDirectory() as directory:
+            app.snapshots = app_module.SnapshotStore(directory)
+            app.save_snapshot(payments, investigators, {'source': 'test', 'filters': []})
+            app.save_snapshot(payments, investigators, {'source': 'test', 'filters': filters})
+            saved = app.snapshots.snapshots()
+            self.assertEqual(len(saved), 2)
+            filtered = next(path for path, metadata in saved if metadata['filters'])
+
+            app.ingest_snapshot(filtered, app_module.IngestMetrics(), threading.Event())
+        kind, reopened, reopened_investigators, title, text = drain(app)[-1]
+        self.assertEqual(kind, 'opened')
+        self.assertNotIn('principal_investigator_1_last_name', reopened.columns)
+        # Same values; text comes back Arrow-backed (see SnapshotStore.load)
+        pd.testing.assert_frame_equal(reopened_investigators.join(reopened),
+                                      investigators.join(payments).reset_index(drop=True), check_dtype=False)
+        self.assertEqual(reopened_investigators.payment_rows(reopened_investigators.find(last_name='a')).tolist(),
+                         investigators.payment_rows(investigators.find(last_name='a')).tolist())
+
+
+class TestCleaning(unittest.TestCase):
+    def test_single_mask_matches_rule_by_rule_filtering(self):
+        frame = app_module.decode_page(synthetic_records(3000))
+        payments, investigators, _ = app_module.CleaningPipeline(app_module.DEFAULT_CLEANING_STAGES[:2]).run(frame)
+
+        amounts = pd.to_numeric(frame['total_amount_of_payment_usdollars'], errors='coerce')
+        expected = frame.assign(total_amount_of_payment_usdollars=amounts).dropna(
+            subset=['total_amount_of_payment_usdollars'])
+        expected = expected[(expected['total_amount_of_payment_usdollars'] != 0) &
+                            (expected['total_amount_of_payment_usdollars'] <= 1000000)]
+        lower, upper = expected['total_amount_of_payment_usdollars'].quantile(app_module.TRIM_PERCENTILES)
+        expected = expected[(expected['total_amount_of_payment_usdollars'] >= lower) &
+                            (expected['total_amount_of_payment_usdollars'] <= upper)]
+
+        joined = investigators.join(payments)
+        pd.testing.assert_frame_equal(joined, expected[joined.columns])
+        self.assertEqual(payments['total_amount_of_payment_usdollars'].dtype, 'float64')
+
+    def test_specialties_split_into_taxonomy_levels(self):
+        specialties = pd.Series(['Allopathic & Osteopathic Physicians|Internal Medicine|Cardiovascular Disease', None,
+                                 'Allopathic & Osteopathic Physicians|Pediatrics', 'Nursing Providers|Nurse Practitioner',
+                                 'Unknown', 'Allopathic & Osteopathic Physicians|Pediatrics'], index=range(10, 16))
+        levels = app_module.parse_specialties(specialties)
+        levels = levels.astype(object).where(levels.notna(), None)
+
+        self.assertEqual(list(levels.index), list(specialties.index))
+        self.assertEqual(levels['principal_investigator_1_specialty_1'].tolist(),
+                         ['Internal Medicine|Cardiovascular Disease', None, 'Pediatrics', 'Nurse Practitioner',
+                          'Unknown', 'Pediatrics'])
+        self.assertEqual(levels['principal_investigator_1_specialty_grouping'].tolist(),
+                         ['Allopathic & Osteopathic Physicians', None, 'Allopathic & Osteopathic Physicians',
+                          'Nursing Providers', 'Unknown', 'Allopathic & Osteopathic Physicians'])
+        self.assertEqual(levels['principal_investigator_1_specialty_specialization'].tolist(),
+                         ['Cardiovascular Disease'] + [None] * 5)
+        self.assertTrue((app_module.parse_specialties(specialties).dtypes == 'category').all())
+        self.assertEqual(len(app_module.parse_specialties(pd.Series([], dtype=object))), 0)
+
+    def test_nothing_valid_keeps_nothing(self):
+        frame = app_module.decode_page(synthetic_records(3))
+        frame['total_amount_of_payment_usdollars'] = ['', '0', '2000000']
+        payments, investigators, report = app_module.CleaningPipeline().run(frame)
+        self.assertEqual(len(payments), 0)
+        self.assertEqual(report[-1]['rows_out'], 0)
+
+
+class TestCleaningPipeline(unittest.TestCase):
+    def write_rules(self, directory, stages):
+        path = os.path.join(directory, 'rules.json')
+        with open(path, 'w') as f:
+            f.write(stages if isinstance(stages, str) else json.dumps({'stages': stages}))
+        return path
+
+    def test_default_rules_match_the_shipped_file(self):
+        pipeline = app_module.CleaningPipeline.from_file(app_module.CLEANING_CONFIG_FILE)
+        self.assertEqual(pipeline.stages, app_module.CleaningPipeline().stages)
+
+        frame = app_module.decode_page(synthetic_records(3000))
+        payments, investigators, report = pipeline.run(frame)
+        # The table stages don't drop rows, so the kept payments are exactly those the row stages pass
+        expected_payments, _, _ = app_module.CleaningPipeline(app_module.DEFAULT_CLEANING_STAGES[:2]).run(frame)
+        self.assertEqual(payments.index.tolist(), expected_payments.index.tolist())
+        self.assertEqual([stage['stage'] for stage in report],
+                         ['invalid_payments', 'trim_percentiles', 'take_rows', 'specialty_levels', 'optimize_dtypes'])
+        self.assertEqual(report[0]['rows_in'], 3000)
+        self.assertEqual(report[-1]['rows_out'], len(payments))
+        for stage, following in zip(report, report[1:]):
+            self.assertEqual(stage['rows_out'], following['rows_in'])
+        self.assertIn('principal_investigator_1_specialty_classification', investigators.table.columns)
+        self.assertIn('take_rows: ', app_module.format_stage_report(report))
+
+    def test_rules_from_a_file(self):
+        frame = app_module.decode_page(synthetic_records(3000))
+        frame.loc[0, 'total_amount_of_payment_usdollars'] = '2500000'
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline = app_module.CleaningPipeline.from_file(self.write_rules(directory, [
+                {'stage': 'invalid_payments', 'max_amount': None}, {'stage': 'specialty_levels',
+                                                                    'strip_grouping': False}]))
+        payments, investigators, report = pipeline.run(frame)
+
+        self.assertEqual([stage['stage'] for stage in report], ['invalid_payments', 'take_rows', 'specialty_levels'])
+        self.assertIn(2500000, payments['total_amount_of_payment_usdollars'].tolist())
+        self.assertTrue(investigators.table['principal_investigator_1_specialty_1'].str.contains('|',
+                                                                                                regex=False).all())
+        self.assertEqual(pipeline.payment_rules(), {'drop_zero': True, 'max_amount': None})
+        conditions = app_module.FilterSpec.for_selection(**pipeline.payment_rules()).conditions
+        self.assertEqual([condition['operator'] for condition in conditions], ['<>'])
+
+    def test_bad_rules_are_rejected(self):
+        bad = [[{'stage': 'drop_everything'}], [{'stage': 'trim_percentiles', 'median': 0.5}], [{'lower': 0.1}],
+               [{'stage': 'optimize_dtypes'}, {'stage': 'invalid_payments'}], '{"stages": [', '[]']
+        with tempfile.TemporaryDirectory() as directory:
+            for stages in bad:
+                with self.assertRaises(app_module.CleaningConfigError):
+                    app_module.CleaningPipeline.from_file(self.write_rules(directory, stages))
+
+    def test_bad_option_values_are_rejected(self):
+        bad = [{'stage': 'invalid_payments', 'drop_zero': 'no'}, {'stage': 'invalid_payments', 'max_amount': '1e6'},
+               {'stage': 'trim_percentiles', 'lower': 0.9, 'upper': 0.1},
+               {'stage': 'trim_percentiles', 'lower': -0.1}, {'stage': 'trim_percentiles', 'upper': 95},
+               {'stage': 'optimize_dtypes', 'max_unique_ratio': 0},
+               {'stage': 'optimize_dtypes', 'max_unique_ratio': 1.5}]
+        for stage in bad:
+            with self.assertRaises(app_module.CleaningConfigError):
+                app_module.CleaningPipeline([stage])
+        app_module.CleaningPipeline([{'stage': 'invalid_payments', 'max_amount': None},
+                                     {'stage': 'trim_percentiles', 'lower': 0, 'upper': 1},
+                                     {'stage': 'optimize_dtypes', 'max_unique_ratio': 1}])
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def amounts(self, count, seed):
+        return np.random.default_rng(seed).lognormal(6, 1.5, count)
+
+    def assert_rank_error(self, sketch, values):
+        ordered = np.sort(values)
+        for q, value in zip((0.05, 0.25, 0.5, 0.95), sketch.quantiles([0.05, 0.25, 0.5, 0.95])):
+            self.assertLessEqual(abs(np.searchsorted(ordered, value) / len(values) - q), sketch.rank_error)
+
+    def test_small_loads_are_exact(self):
+        values = self.amounts(5000, 0)
+        sketch = app_module.QuantileSketch()
+        for start in range(0, len(values), 500):
+            sketch.update(values[start:start + 500])
+        self.assertTrue(sketch.exact)
+        np.testing.assert_array_equal(sketch.quantiles(app_module.TRIM_PERCENTILES),
+                                      pd.Series(values).quantile(app_module.TRIM_PERCENTILES).to_numpy())
+
+    def test_large_loads_stay_within_the_rank_error(self):
+        values = self.amounts(200000, 1)
+        sketch = app_module.QuantileSketch(k=200, exact_limit=1000, seed=0)
+        for start in range(0, len(values), 500):
+            sketch.update(values[start:start + 500])
+        self.assertFalse(sketch.exact)
+        self.assertEqual(sketch.count, len(values))
+        self.assertLess(sum(len(level) for level in sketch.levels), 2000)
+        self.assert_rank_error(sketch, values)
+
+    def test_merged_sketches_summarize_both(self):
+        values = self.amounts(100000, 2)
+        first, second = (app_module.QuantileSketch(k=200, exact_limit=1000, seed=seed) for seed in (0, 1))
+        first.update(values[:30000])
+        second.update(values[30000:])
+        first.merge(second)
+        self.assertEqual(first.count, len(values))
+        self.assert_rank_error(first, values)
+
+    def test_buffers_sketch_the_appended_amounts(self):
+        buffers = app_module.ColumnBuffers([app_module.AMOUNT_COLUMN], 10, app_module.loaded_dtypes())
+        buffers.append(pd.DataFrame({app_module.AMOUNT_COLUMN: [1.0, 2.0, np.nan, 4.0]}))
+        self.assertEqual(buffers.sketch.count, 3)
+        self.assertEqual(buffers.sketch.quantiles([0.5])[0], 2.0)
+
+    def test_cleaning_uses_an_approximate_sketch(self):
+        amounts = pd.Series(self.amounts(50000, 3))
+        sketch = app_module.QuantileSketch(exact_limit=1000, seed=0)
+        sketch.update(amounts)
+        lower, upper = sketch.quantiles(app_module.TRIM_PERCENTILES)
+        keep = app_module.percentile_window(amounts.to_numpy(), np.ones(len(amounts), dtype=bool), sketch=sketch)
+        self.assertEqual(keep.tolist(), ((amounts >= lower) & (amounts <= upper)).tolist())
+        self.assertAlmostEqual(keep.mean(), 0.9, delta=2 * sketch.rank_error)
+
+
+class TestInvestigatorDimension(unittest.TestCase):
+    def payments(self):
+        frame = app_module.drop_invalid_payments(app_module.decode_page(synthetic_records(3000, investigators=200)))
+        # Two payments to investigators without a profile ID: they must not be merged with each other
+        frame.loc[0, app_module.INVESTIGATOR_COLUMNS] = [None, 'Ann', 'Lee', 'MD', 'x', 'CA']
+        frame.loc[1, app_module.INVESTIGATOR_COLUMNS] = [None, 'Bob', 'Ray', 'MD', 'x', 'NY']
+        return frame
+
+    def test_split_stores_each_investigator_once_and_joins_back(self):
+        frame = self.payments()
+        payments, investigators = app_module.InvestigatorDimension.split(frame)
+
+        self.assertEqual(len(investigators.table), frame[app_module.INVESTIGATOR_ID_COLUMN].nunique() + 2)
+        self.assertFalse(set(app_module.INVESTIGATOR_COLUMNS) & set(payments.columns))
+        self.assertEqual(payments[app_module.INVESTIGATOR_KEY].dtype, 'int32')
+        pd.testing.assert_frame_equal(investigators.join(payments), frame[investigators.join(payments).columns])
+        self.assertEqual(investigators.column(payments, 'principal_investigator_1_state').tolist(),
+                         frame['principal_investigator_1_state'].tolist())
+
+    def test_lookups_use_the_investigator_table(self):
+        frame = self.payments()
+        payments, investigators = app_module.InvestigatorDimension.split(frame)
+        profile_id = frame[app_module.INVESTIGATOR_ID_COLUMN].iloc[5]
+
+        key = investigators.key_for_profile(profile_id)
+        self.assertEqual(investigators.table[app_module.INVESTIGATOR_ID_COLUMN].iloc[key], profile_id)
+        self.assertIsNone(investigators.key_for_profile('no such id'))
+        rows = investigators.payment_rows([key])
+        self.assertEqual(rows.tolist(),
+                         (frame[app_module.INVESTIGATOR_ID_COLUMN] == profile_id).to_numpy().nonzero()[0].tolist())
+        self.assertEqual(len(investigators.payment_rows([])), 0)
+
+        keys = investigators.find(last_name='RAY')
+        expected = frame['principal_investigator_1_last_name'].str.contains('ray', case=False, na=False)
+        self.assertEqual(investigators.payment_rows(keys).tolist(), expected.to_numpy().nonzero()[0].tolist())
+        self.assertEqual(len(investigators.find(profile_id='no such id', last_name='ray')), 0)
+
+    def test_clean_data_splits_and_search_joins(self):
+        app = headless_app()
+        app.df, app.investigators, _ = app.clean_data(self.payments())
+
+        self.assertNotIn('principal_investigator_1_last_name', app.df.columns)
+        self.assertIn('principal_investigator_1_last_name', app.data_columns())
+        self.assertNotIn(app_module.INVESTIGATOR_KEY, app.data_columns())
+        specialties = app.column_data('principal_investigator_1_specialty_1').dropna()
+        self.assertFalse(specialties.str.startswith('Allopathic').any())
+        self.assertIn('principal_investigator_1_specialty_classification', app.data_columns())
+
+        found = app.find_investigator_payments(first_name='bob')
+        self.assertEqual(found['principal_investigator_1_last_name'].tolist(), ['Ray'] * len(found))
+        self.assertEqual(list(found.columns), app.data_columns())
+        self.assertEqual(len(app.joined_frame()), len(app.df))
+
+
+class TestDecodePage(unittest.TestCase):
+    def test_matches_json_normalize_for_flat_records(self):
+        results = [{'a': '1', 'b': 'x', 'extra': 'y'}, {'a': '2', 'b': None, 'extra': 'z'}]
+        expected = pd.json_normalize(results)[['a', 'b']]
+        pd.testing.assert_frame_equal(app_module.decode_page(results, ['a', 'b']), expected)
+
+    def test_nested_records_fall_back_to_json_normalize(self):
+        results = [{'a': {'inner': '1'}, 'b': 'x'}]
+        frame = app_module.decode_page(results, ['a', 'b'])
+        self.assertIn('a.inner', frame.columns)
+
+
+class TestPageSpool(unittest.TestCase):
+    def test_round_trip_in_offset_order(self):
+        with tempfile.TemporaryDirectory() as root:
+            spool = app_module.PageSpool.for_url('http://x', root=root)
+            # Written out of order, with an ID that would lose its leading zero if parsed as a number
+            spool.write(500, pd.DataFrame({'id': ['0042'], 'amount': ['7.5']}))
+            spool.write(0, pd.DataFrame({'id': ['0001', '0002'], 'amount': ['1', '2']}))
+
+            pages = list(spool.iter_pages(['id', 'amount']))
+            self.assertEqual([offset for offset, _ in pages], [0, 500])
+            self.assertEqual([value for _, page in pages for value in page['id']], ['0001', '0002', '0042'])
+
+            spool.clear()
+            self.assertEqual(list(spool.iter_pages(['id', 'amount'])), [])
+
+    def test_resume_fetches_only_missing_ranges(self):
+        with tempfile.TemporaryDirectory() as root:
+            spool = app_module.PageSpool.for_url('http://x', root=root)
+            spool.start('http://x', ['id'])
+            spool.write(0, pd.DataFrame({'id': [str(i) for i in range(500)]}))
+            spool.write(1000, pd.DataFrame({'id': [str(i) for i in range(500)]}))
+
+            # A fresh spool object (as after an app restart) sees the same manifest
+            reopened = app_module.PageSpool.for_url('http://x', root=root)
+            reopened.start('http://x', ['id'])
+            self.assertEqual(reopened.rows_on_disk(), 1000)
+            missing = list(itertools.islice(reopened.missing_partitions(500), 3))
+            self.assertEqual(missing, [(500, 500), (1500, 500), (2000, 500)])
+
+            reopened.mark_complete()
+            self.assertEqual(list(reopened.missing_partitions(500)), [])
+
+            # Asking for different columns throws the old pages away
+            reopened.start('http://x', ['id', 'amount'])
+            self.assertEqual(reopened.rows_on_disk(), 0)
+            self.assertEqual(reopened.page_files(), [])
+
+    def test_clear_all_removes_only_spools(self):
+        with tempfile.TemporaryDirectory() as root:
+            spool = app_module.PageSpool.for_url('http://x', root=root)
+            spool.start('http://x', ['id'])
+            spool.write(0, pd.DataFrame({'id': ['1']}))
+            spool.mark_complete()
+            os.makedirs(os.path.join(root, 'responses'))
+
+            self.assertEqual(app_module.PageSpool.clear_all(root), 1)
+            self.assertEqual(os.listdir(root), ['responses'])
+            # The next full load starts from nothing
+            reopened = app_module.PageSpool.for_url('http://x', root=root)
+            reopened.start('http://x', ['id'])
+            self.assertEqual(reopened.rows_on_disk(), 0)
+
+    def test_merge_ranges(self):
+        self.assertEqual(app_module.merge_ranges([[500, 1000], [0, 500], [2000, 2100]]), [[0, 1000], [2000, 2100]])
+
+
+class TestResponseCache(unittest.TestCase):
+    def cached_response(self, body, status_code=200, etag='"v1"'):
+        response = MagicMock()
+        response.status_code = status_code
+        response.content = body
+        response.headers = {'ETag': etag}
+        response.json.side_effect = lambda: json.loads(body)
+        return response
+
+    def test_fresh_entry_skips_network(self):
+        with tempfile.TemporaryDirectory() as root:
+            client = app_module.DatastoreClient(cache=app_module.ResponseCache(root))
+            with patch('requests.Session.get') as mock_get:
+                mock_get.return_value = self.cached_response(b'{"results": [{"a": "1"}]}')
+                self.assertEqual(client.fetch_page('http://x', 0, 500), [{'a': '1'}])
+                self.assertEqual(client.fetch_page('http://x', 0, 500), [{'a': '1'}])
+                self.assertEqual(mock_get.call_count, 1)
+
+    def test_stale_entry_is_revalidated(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = app_module.ResponseCache(root, ttl=0)
+            client = app_module.DatastoreClient(cache=cache)
+            with patch('requests.Session.get') as mock_get:
+                mock_get.return_value = self.cached_response(b'{"results": [{"a": "1"}]}')
+                client.fetch_page('http://x', 0, 500)
+
+                mock_get.return_value = self.cached_response(b'', status_code=304)
+                self.assertEqual(client.fetch_page('http://x', 0, 500), [{'a': '1'}])
+                self.assertEqual(mock_get.call_args.kwargs['headers']['If-None-Match'], '"v1"')
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = app_module.ResponseCache(root, max_bytes=250)
+            for offset in range(3):
+                cache.put('http://x', {'offset': offset}, b'x' * 100, {})
+                # Make sure the access times differ
+                time.sleep(0.01)
+            self.assertIsNone(cache.get('http://x', {'offset': 0}))
+            self.assertIsNotNone(cache.get('http://x', {'offset': 2}))
+            self.assertLessEqual(cache.size, 250)
+
+    def test_size_counts_only_bodies(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = app_module.ResponseCache(root)
+            cache.put('http://x', {'offset': 0}, b'x' * 100, {'ETag': '"v1"'})
+            with open(os.path.join(root, 'left_over.body.tmp'), 'wb') as f:
+                f.write(b'y' * 1000)
+
+            reopened = app_module.ResponseCache(root)
+            self.assertEqual((cache.size, reopened.size), (100, 100))
+
+    def test_entry_evicted_while_read_is_still_returned(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = app_module.ResponseCache(root)
+            cache.put('http://x', {'offset': 0}, b'{}', {})
+            with patch.object(app_module.os, 'utime', side_effect=FileNotFoundError):
+                self.assertEqual(cache.get('http://x', {'offset': 0})['body'], b'{}')
+
+
+class TestBulkFile(unittest.TestCase):
+    def write_bulk_csv(self, directory, rows):
+        # The bulk files use Title_Case headers and carry extra columns we don't want
+        frame = pd.DataFrame({column.title(): ['x'] * len(rows) for column in app_module.DESIRED_COLUMNS})
+        frame['Total_Amount_Of_Payment_Usdollars'] = rows
+        frame['Principal_Investigator_1_Profile_Id'] = ['007'] * len(rows)
+        frame['Record_ID'] = range(len(rows))
+        path = os.path.join(directory, 'OP_DTL_RSRCH_PGYR2023.csv')
+        frame.to_csv(path, index=False)
+        return path
+
+    def test_reads_desired_columns_in_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_bulk_csv(directory, [10.5, 0, 20, 2000000, 30])
+            chunks = list(app_module.read_bulk_csv(path, chunksize=2))
+
+            self.assertEqual(len(chunks), 3)
+            frame = pd.concat(chunks, ignore_index=True)
+            self.assertEqual(list(frame.columns), app_module.DESIRED_COLUMNS)
+            self.assertEqual(frame[app_module.AMOUNT_COLUMN].dtype, 'float64')
+            self.assertEqual(frame['principal_investigator_1_profile_id'][0], '007')
+
+            kept = app_module.drop_invalid_payments(frame)
+            self.assertEqual(kept[app_module.AMOUNT_COLUMN].tolist(), [10.5, 20, 30])
+
+    def test_reads_research_csv_from_zip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_bulk_csv(directory, [1, 2, 3])
+            zip_path = os.path.join(directory, 'PGYR2023.zip')
+            with zipfile.ZipFile(zip_path, 'w') as archive:
+                archive.writestr('OP_DTL_GNRL_PGYR2023.csv', 'not,the,research,file\n')
+                archive.write(path, 'OP_DTL_RSRCH_PGYR2023.csv')
+
+            frame = pd.concat(app_module.read_bulk_csv(zip_path))
+            self.assertEqual(len(frame), 3)
+
+    def test_missing_column_raises(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bad.csv')
+            pd.DataFrame({'Total_Amount_of_Payment_USDollars': [1]}).to_csv(path, index=False)
+            with self.assertRaises(ValueError):
+                list(app_module.read_bulk_csv(path))
+
+
+if __name__ == "__main__":
+    unittest.main()